@@ -0,0 +1,154 @@
+"""Logging for the services: JSON lines on disk, the familiar tags on the console.
+
+    from applog import get_logger, setup
+    log = get_logger('car_entry')
+    setup('car_entry')                      # once, in the script's entry point
+    log.debug("[SENSOR] Distance: %s cm", distance)
+    log.info("[VALID] Plate detected %s", plate, extra={'conf': conf})
+
+Loggers only hand records to a QueueHandler; a QueueListener thread formats
+them and does the console and file I/O, so a slow Windows console or disk no
+longer stalls the camera loop. The file is logs/<name>.jsonl, rotated at
+MAX_BYTES, one JSON object per line with time, level, logger, message, thread
+and any extra= fields, which makes it searchable with jq or a log shipper.
+
+Every message is rate limited on its template (the format string, before the
+% arguments), RATE_LIMIT_BURST at once then RATE_LIMIT_BURST per
+RATE_LIMIT_PERIOD; the next one that gets through carries a 'suppressed' count.
+Pass arguments %-style on the hot path so repeats share a template, and use
+debug for per-frame chatter: below LOG_LEVEL it costs a level check.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime
+
+LOG_DIR = 'logs'
+LOG_LEVEL = 'INFO'          # console and file; DEBUG adds per-frame sensor readings
+MAX_BYTES = 10 * 1024 * 1024
+BACKUP_COUNT = 5
+RATE_LIMIT_BURST = 5        # messages with the same template let through at once...
+RATE_LIMIT_PERIOD = 10.0    # ...and refilled over this many seconds
+
+# Attributes every LogRecord has; anything else came in through extra=
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'suppressed'}
+
+_listener = None
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per (logger, level, message template)"""
+
+    def __init__(self, burst=RATE_LIMIT_BURST, period=RATE_LIMIT_PERIOD, max_keys=10000):
+        super().__init__()
+        self.burst = burst
+        self.rate = burst / period
+        self.max_keys = max_keys
+        self.buckets = {}           # key -> [tokens, last refill, suppressed since last pass]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= self.max_keys:
+                    self.buckets.clear()    # unbounded f-string messages; start over
+                bucket = self.buckets[key] = [self.burst, now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName,
+        }
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        for name, value in vars(record).items():
+            if name not in _RECORD_FIELDS and not name.startswith('_'):
+                entry[name] = value
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class ConsoleFormatter(logging.Formatter):
+    """The message as the scripts used to print it, plus a note of suppressed repeats"""
+
+    def format(self, record):
+        text = super().format(record)
+        if getattr(record, 'suppressed', 0):
+            text += f" (+{record.suppressed} similar suppressed)"
+        return text
+
+
+class _ListenerQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Unlike the stock QueueHandler, leave the %-formatting to the listener
+        # thread. Only a traceback is rendered here, while its frames still exist.
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def get_logger(name):
+    return logging.getLogger(name)
+
+
+def setup(name, level=LOG_LEVEL, log_dir=LOG_DIR, log_file=True, console=True):
+    """Route every logger of this process through the queue to console and logs/<name>.jsonl"""
+    global _listener
+    if _listener is not None:
+        return
+    handlers = []
+    if console:
+        stream = logging.StreamHandler(sys.stdout)
+        stream.setFormatter(ConsoleFormatter('%(message)s'))
+        handlers.append(stream)
+    if log_file:
+        os.makedirs(log_dir, exist_ok=True)
+        rotating = logging.handlers.RotatingFileHandler(os.path.join(log_dir, f"{name}.jsonl"),
+                                                        maxBytes=MAX_BYTES, backupCount=BACKUP_COUNT,
+                                                        encoding='utf-8')
+        rotating.setFormatter(JsonFormatter())
+        handlers.append(rotating)
+
+    records = queue.SimpleQueue()
+    queue_handler = _ListenerQueueHandler(records)
+    queue_handler.addFilter(RateLimitFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """Flush the queue; runs at exit"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
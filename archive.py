@@ -0,0 +1,280 @@
+"""Move closed sessions out of the live database into monthly Parquet files.
+
+    python archive.py run                      # archive, drop emptied partitions, add new ones
+    python archive.py run --daemon             # the same every ARCHIVE_EVERY_HOURS
+    python archive.py report --since 2023-01-01 --until 2025-01-01
+
+parking_sessions and session_events are partitioned by month (web/db.py), and
+the gates only ever work in the newest partitions. Sessions that have exited
+(payment_status 2) and entered more than HOT_MONTHS months ago are written,
+with their events, to archive/parking_sessions/YYYY-MM.parquet and
+archive/session_events/YYYY-MM.parquet, then deleted. Partitions older than
+the cutoff that are left empty are dropped. Sessions still open stay in the
+database however old they are. What each month archived is added up in
+session_archive, so the dashboard's all-time revenue doesn't change.
+
+Files are written before any row is deleted and merged with what they
+already hold, so an interrupted run is simply run again. Files older than
+ARCHIVE_YEARS are deleted. `run` also adds the coming months' partitions;
+keep it scheduled (or --daemon) so new rows never land in the catch-all one.
+
+report, and load_sessions() for other scripts, read the Parquet files of the
+requested months together with the live table.
+"""
+import argparse
+import os
+import time
+from datetime import datetime
+import pandas as pd
+from mysql.connector import Error
+from web.db import connect_db, ensure_partitions, month_start, add_months, PARTITIONED_TABLES
+from applog import get_logger, setup as setup_logging
+
+log = get_logger('archive')
+
+# Configuration
+ARCHIVE_DIR = 'archive'
+HOT_MONTHS = 6              # closed sessions stay in MySQL for the current month and this many before it
+ARCHIVE_YEARS = 7           # Parquet files are kept this long; None keeps them forever
+ARCHIVE_EVERY_HOURS = 24
+DELETE_BATCH = 1000         # rows per delete transaction, so the gates never wait long on a lock
+
+SESSION_COLUMNS = ['id', 'plate_number', 'payment_status', 'amount', 'timestamp', 'gate']
+EVENT_COLUMNS = ['id', 'session_id', 'plate_number', 'event', 'amount', 'timestamp']
+
+
+def archive_path(table, month, archive_dir=ARCHIVE_DIR):
+    return os.path.join(archive_dir, table, f"{month:%Y-%m}.parquet")
+
+
+def fetch_frame(cursor, query, params, columns):
+    cursor.execute(query, params)
+    frame = pd.DataFrame.from_records(cursor.fetchall(), columns=columns)
+    frame['amount'] = frame['amount'].astype(float)
+    return frame
+
+
+def write_parquet(frame, path):
+    """Merge frame into the file at path by id and replace the file in one step"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        frame = pd.concat([pd.read_parquet(path), frame]).drop_duplicates('id', keep='last')
+    tmp = path + '.tmp'
+    frame.sort_values('id').to_parquet(tmp, index=False, compression='zstd')
+    os.replace(tmp, path)
+
+
+def chunks(items, size=DELETE_BATCH):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def placeholders(items):
+    return ', '.join(['%s'] * len(items))
+
+
+def archive_month(conn, month, archive_dir=ARCHIVE_DIR):
+    """Archive the closed sessions that entered in month; returns how many"""
+    start, end = month, add_months(month, 1)
+    cursor = conn.cursor()
+    try:
+        sessions = fetch_frame(cursor, f'''
+            SELECT {', '.join(SESSION_COLUMNS)} FROM parking_sessions
+            WHERE timestamp >= %s AND timestamp < %s AND payment_status = 2
+        ''', (start, end), SESSION_COLUMNS)
+        ids = sessions['id'].tolist()
+        events = [fetch_frame(cursor, f'''
+            SELECT {', '.join(EVENT_COLUMNS)} FROM session_events WHERE session_id IN ({placeholders(chunk)})
+        ''', chunk, EVENT_COLUMNS) for chunk in chunks(ids)]
+        # Denied exits of cars that never entered belong to no session; they go by their own month
+        orphans = fetch_frame(cursor, f'''
+            SELECT {', '.join(EVENT_COLUMNS)} FROM session_events
+            WHERE session_id IS NULL AND timestamp >= %s AND timestamp < %s
+        ''', (start, end), EVENT_COLUMNS)
+        events = pd.concat(events + [orphans], ignore_index=True)
+        if sessions.empty and events.empty:
+            return 0
+
+        write_parquet(sessions, archive_path('parking_sessions', month, archive_dir))
+        write_parquet(events, archive_path('session_events', month, archive_dir))
+
+        # Each batch is deleted and counted in session_archive in one transaction
+        denied = events[events['event'] == 'denied']
+        for chunk in chunks(ids):
+            batch = sessions[sessions['id'].isin(chunk)]
+            cursor.execute(f"DELETE FROM session_events WHERE session_id IN ({placeholders(chunk)})", chunk)
+            cursor.execute(f'''
+                DELETE FROM parking_sessions
+                WHERE id IN ({placeholders(chunk)}) AND timestamp >= %s AND timestamp < %s
+            ''', chunk + [start, end])
+            add_totals(cursor, month, len(batch), batch['amount'].sum(), denied['session_id'].isin(chunk).sum())
+            conn.commit()
+        orphan_ids = orphans['id'].tolist()
+        for chunk in chunks(orphan_ids):
+            cursor.execute(f'''
+                DELETE FROM session_events
+                WHERE id IN ({placeholders(chunk)}) AND timestamp >= %s AND timestamp < %s
+            ''', chunk + [start, end])
+            add_totals(cursor, month, 0, 0.0, len(chunk))
+            conn.commit()
+        log.info("[ARCHIVE] %s: %s sessions and %s events archived", month.strftime('%Y-%m'), len(ids), len(events))
+        return len(ids)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def add_totals(cursor, month, sessions, revenue, alerts):
+    cursor.execute('''
+        INSERT INTO session_archive (month, sessions, revenue, alerts, archived_at)
+        VALUES (%s, %s, %s, %s, NOW())
+        ON DUPLICATE KEY UPDATE sessions = sessions + VALUES(sessions), revenue = revenue + VALUES(revenue),
+                                alerts = alerts + VALUES(alerts), archived_at = VALUES(archived_at)
+    ''', (f"{month:%Y-%m}", int(sessions), float(revenue), int(alerts)))
+
+
+def months_to_archive(cursor, cutoff):
+    cursor.execute('''
+        SELECT DATE_FORMAT(timestamp, '%%Y-%%m-01') FROM parking_sessions
+        WHERE timestamp < %s AND payment_status = 2
+        UNION
+        SELECT DATE_FORMAT(timestamp, '%%Y-%%m-01') FROM session_events
+        WHERE timestamp < %s AND session_id IS NULL
+    ''', (cutoff, cutoff))
+    return sorted(datetime.strptime(row[0], '%Y-%m-%d') for row in cursor.fetchall())
+
+
+def drop_empty_partitions(conn, cutoff):
+    """Drop the monthly partitions before cutoff that archiving has emptied"""
+    cursor = conn.cursor()
+    try:
+        for table in PARTITIONED_TABLES:
+            cursor.execute('''
+                SELECT partition_name FROM information_schema.partitions
+                WHERE table_schema = DATABASE() AND table_name = %s AND partition_name IS NOT NULL
+            ''', (table,))
+            names = [name for (name,) in cursor.fetchall()
+                     if name != 'pmax' and add_months(datetime.strptime(name, 'p%Y%m'), 1) <= cutoff]
+            for name in sorted(names):
+                cursor.execute(f"SELECT 1 FROM {table} PARTITION ({name}) LIMIT 1")
+                if cursor.fetchone() is None:
+                    cursor.execute(f"ALTER TABLE {table} DROP PARTITION {name}")
+                    log.info("[ARCHIVE] Dropped empty partition %s.%s", table, name)
+    finally:
+        cursor.close()
+
+
+def expire_files(archive_dir=ARCHIVE_DIR, years=ARCHIVE_YEARS):
+    if not years:
+        return
+    oldest = add_months(month_start(datetime.now()), -12 * years)
+    for table in PARTITIONED_TABLES:
+        folder = os.path.join(archive_dir, table)
+        if not os.path.isdir(folder):
+            continue
+        for name in os.listdir(folder):
+            try:
+                month = datetime.strptime(name, '%Y-%m.parquet')
+            except ValueError:
+                continue
+            if month < oldest:
+                os.remove(os.path.join(folder, name))
+                log.info("[ARCHIVE] Retention: deleted %s/%s", table, name)
+
+
+def run_once(hot_months=HOT_MONTHS, archive_dir=ARCHIVE_DIR):
+    conn = connect_db()
+    if not conn:
+        return 0
+    archived = 0
+    try:
+        cursor = conn.cursor()
+        for table in PARTITIONED_TABLES:
+            ensure_partitions(cursor, table, rewrite=True)
+        cutoff = add_months(month_start(datetime.now()), -hot_months)
+        months = months_to_archive(cursor, cutoff)
+        cursor.close()
+        for month in months:
+            archived += archive_month(conn, month, archive_dir)
+        drop_empty_partitions(conn, cutoff)
+        expire_files(archive_dir)
+        log.info("[ARCHIVE] Done: %s sessions before %s archived", archived, cutoff.strftime('%Y-%m'))
+    except Error as e:
+        log.error("[DB ERROR] Archiving stopped after %s sessions: %s", archived, e)
+    finally:
+        conn.close()
+    return archived
+
+
+# ---------- long-range reads ----------
+def load_archive(table, since, until, archive_dir=ARCHIVE_DIR):
+    """Archived rows of table whose file month overlaps [since, until)"""
+    frames = []
+    month = month_start(since)
+    while month < until:
+        path = archive_path(table, month, archive_dir)
+        if os.path.exists(path):
+            frames.append(pd.read_parquet(path))
+        month = add_months(month, 1)
+    columns = SESSION_COLUMNS if table == 'parking_sessions' else EVENT_COLUMNS
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+
+
+def load_sessions(since, until, archive_dir=ARCHIVE_DIR):
+    """Every session that entered in [since, until), archived or live"""
+    archived = load_archive('parking_sessions', since, until, archive_dir)
+    live = pd.DataFrame(columns=SESSION_COLUMNS)
+    conn = connect_db(read_only=True)
+    if conn:
+        cursor = conn.cursor()
+        try:
+            live = fetch_frame(cursor, f'''
+                SELECT {', '.join(SESSION_COLUMNS)} FROM parking_sessions
+                WHERE timestamp >= %s AND timestamp < %s
+            ''', (since, until), SESSION_COLUMNS)
+        finally:
+            cursor.close()
+            conn.close()
+    sessions = pd.concat([archived, live], ignore_index=True).drop_duplicates('id', keep='last')
+    sessions['timestamp'] = pd.to_datetime(sessions['timestamp'])
+    return sessions[(sessions['timestamp'] >= since) & (sessions['timestamp'] < until)]
+
+
+def report(since, until):
+    sessions = load_sessions(since, until)
+    paid = sessions['payment_status'].isin([1, 2])
+    monthly = pd.DataFrame({
+        'vehicles': sessions.groupby(sessions['timestamp'].dt.strftime('%Y-%m')).size(),
+        'revenue': sessions[paid].groupby(sessions[paid]['timestamp'].dt.strftime('%Y-%m'))['amount'].sum(),
+        'unpaid': sessions[sessions['payment_status'] == 0].groupby(
+            sessions['timestamp'].dt.strftime('%Y-%m')).size(),
+    }).fillna(0)
+    print(f"[REPORT] {since:%Y-%m-%d} to {until:%Y-%m-%d}: {len(sessions)} sessions, "
+          f"{sessions[paid]['amount'].sum():,.0f} RWF")
+    print(f"{'month':<10}{'vehicles':>10}{'revenue RWF':>14}{'unpaid':>8}")
+    for month, row in monthly.sort_index().iterrows():
+        print(f"{month:<10}{int(row['vehicles']):>10}{row['revenue']:>14,.0f}{int(row['unpaid']):>8}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive old parking sessions to Parquet and report across them")
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help="archive closed sessions older than --hot-months")
+    run.add_argument('--hot-months', type=int, default=HOT_MONTHS)
+    run.add_argument('--daemon', action='store_true', help=f"repeat every {ARCHIVE_EVERY_HOURS} h")
+    rep = commands.add_parser('report', help="monthly totals over archived and live sessions")
+    rep.add_argument('--since', required=True, type=datetime.fromisoformat)
+    rep.add_argument('--until', default=datetime.now(), type=datetime.fromisoformat)
+    args = parser.parse_args()
+
+    if args.command == 'report':
+        report(args.since, args.until)
+    else:
+        setup_logging('archive')
+        while True:
+            run_once(args.hot_months)
+            if not args.daemon:
+                break
+            time.sleep(ARCHIVE_EVERY_HOURS * 3600)
@@ -1,51 +1,278 @@
+import argparse
+import hashlib
+import json
 import os
+import re
 import shutil
-import random
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
 # Path to mixed files (images + labels)
-mixed_dir = 'images/cars'
+MIXED_DIR = 'images/cars'
 
-# Output directories
-train_img_dir = 'dataset/train/images'
-train_lbl_dir = 'dataset/train/labels'
-val_img_dir = 'dataset/val/images'
-val_lbl_dir = 'dataset/val/labels'
+# Output dataset root (train/val images and labels go underneath)
+DATASET_DIR = 'dataset'
+DATA_YAML = 'license_plate.yaml'
+CLASS_NAMES = ['license_plate']
 
-# Create output directories if they don't exist
-for d in [train_img_dir, train_lbl_dir, val_img_dir, val_lbl_dir]:
-    os.makedirs(d, exist_ok=True)
+VAL_FRACTION = 0.2
+SEED = 42
+SESSION_GAP = 60            # seconds without a frame that start a new capture session
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+MANIFEST_NAME = '.manifest.json'
 
-# Get all image files (.jpg) in the mixed directory
-image_files = [f for f in os.listdir(mixed_dir) if f.lower().endswith('.jpg')]
-image_files.sort()
+# car_20250324_104717.jpg (capture frames) or RAF287E_20250602_121513.jpg (plate crops)
+TIMESTAMP = re.compile(r'(\d{8}_\d{6})')
+PLATE_PREFIX = re.compile(r'^(RA[A-Z]\d{3}[A-Z])_')
 
-# Shuffle and split 80% train, 20% val
-random.seed(42)
-random.shuffle(image_files)
 
-total = len(image_files)
-split_idx = int(0.8 * total)
-train_images = image_files[:split_idx]
-val_images = image_files[split_idx:]
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
 
-print(f"📊 Total: {total} | Train: {len(train_images)} | Val: {len(val_images)}")
 
-# Helper to move image and matching label
-def move_files(image_list, img_dst, lbl_dst):
-    for img_file in image_list:
-        img_src = os.path.join(mixed_dir, img_file)
-        lbl_file = os.path.splitext(img_file)[0] + '.txt'
-        lbl_src = os.path.join(mixed_dir, lbl_file)
+def validate_label(path, n_classes):
+    """Return (box count, dominant class, error) for a YOLO label file; a missing one has no boxes"""
+    if not os.path.exists(path):
+        return 0, None, None
+    counts = defaultdict(int)
+    with open(path) as f:
+        for line_no, line in enumerate(f, 1):
+            parts = line.split()
+            if not parts:
+                continue
+            if len(parts) != 5:
+                return 0, None, f'line {line_no}: expected 5 values, got {len(parts)}'
+            try:
+                cls = int(parts[0])
+                x, y, w, h = map(float, parts[1:])
+            except ValueError:
+                return 0, None, f'line {line_no}: not numeric'
+            if not 0 <= cls < n_classes:
+                return 0, None, f'line {line_no}: class {cls} out of range'
+            if not (0 <= x <= 1 and 0 <= y <= 1 and 0 < w <= 1 and 0 < h <= 1):
+                return 0, None, f'line {line_no}: box outside 0..1'
+            counts[cls] += 1
+    if not counts:
+        return 0, None, None
+    return sum(counts.values()), max(counts, key=counts.get), None
 
-        shutil.copy2(img_src, os.path.join(img_dst, img_file))
 
-        if os.path.exists(lbl_src):
-            shutil.copy2(lbl_src, os.path.join(lbl_dst, lbl_file))
+def inspect(mixed_dir, name, cached, n_classes):
+    """Hash an image (unless unchanged since the last run) and validate its label"""
+    img_path = os.path.join(mixed_dir, name)
+    lbl_path = os.path.splitext(img_path)[0] + '.txt'
+    stat = os.stat(img_path)
+    lbl_mtime = os.path.getmtime(lbl_path) if os.path.exists(lbl_path) else None
+    if (cached and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime
+            and cached.get('label_mtime') == lbl_mtime):
+        return name, cached
+    boxes, dominant, error = validate_label(lbl_path, n_classes)
+    return name, {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'label_mtime': lbl_mtime,
+        'labelled': lbl_mtime is not None,
+        'sha1': file_digest(img_path),
+        'boxes': boxes,
+        'class': dominant,
+        'error': error,
+    }
+
+
+def group_keys(entries, mode):
+    """Map image name -> group so near-duplicate frames always land in the same split"""
+    if mode == 'none':
+        return {name: name for name in entries}
+    if mode == 'plate':
+        keys = {}
+        for name in entries:
+            match = PLATE_PREFIX.match(name)
+            keys[name] = match.group(1) if match else os.path.splitext(name)[0]
+        return keys
+
+    # mode == 'session': frames captured less than SESSION_GAP apart form one session
+    stamped, keys = [], {}
+    for name in entries:
+        match = TIMESTAMP.search(name)
+        if match:
+            stamped.append((datetime.strptime(match.group(1), '%Y%m%d_%H%M%S'), name))
+        else:
+            keys[name] = os.path.splitext(name)[0]
+    session, previous = None, None
+    for taken, name in sorted(stamped):
+        if previous is None or (taken - previous).total_seconds() > SESSION_GAP:
+            session = taken.strftime('session_%Y%m%d_%H%M%S')
+        keys[name] = session
+        previous = taken
+    return keys
+
+
+def assign_splits(entries, keys, val_fraction, seed, stratify):
+    """Deterministic group split, optionally stratified by dominant class or box count.
+
+    Within each stratum groups are ordered by a seeded hash of their key and the
+    first val_fraction of them go to val. The order does not depend on which
+    other files exist, so adding images rarely moves existing groups.
+    """
+    groups = defaultdict(list)
+    for name, key in keys.items():
+        groups[key].append(name)
+
+    strata = defaultdict(list)
+    for key, names in groups.items():
+        if stratify == 'class':
+            stratum = entries[names[0]]['class']
+        elif stratify == 'boxes':
+            stratum = min(max(entries[n]['boxes'] for n in names), 3)
+        else:
+            stratum = None
+        strata[stratum].append(key)
+
+    splits = {}
+    for stratum_keys in strata.values():
+        stratum_keys.sort(key=lambda k: hashlib.sha1(f'{seed}:{k}'.encode()).hexdigest())
+        n_val = round(len(stratum_keys) * val_fraction)
+        for i, key in enumerate(stratum_keys):
+            for name in groups[key]:
+                splits[name] = 'val' if i < n_val else 'train'
+    return splits
+
+
+def place(src, dst, mode):
+    """Hardlink, symlink or copy src to dst, falling back to a copy when linking fails"""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        if mode == 'hardlink':
+            os.link(src, dst)
+            return
+        if mode == 'symlink':
+            os.symlink(os.path.abspath(src), dst)
+            return
+    except OSError:
+        pass
+    shutil.copy2(src, dst)
+
+
+def remove_placed(dataset_dir, split, name):
+    lbl_name = os.path.splitext(name)[0] + '.txt'
+    for path in (os.path.join(dataset_dir, split, 'images', name),
+                 os.path.join(dataset_dir, split, 'labels', lbl_name)):
+        if os.path.lexists(path):
+            os.remove(path)
+
+
+def write_data_yaml(path, dataset_dir, names):
+    root = os.path.abspath(dataset_dir)
+    lines = [
+        f"path: {root}",
+        f"train: {os.path.join(root, 'train', 'images')}",
+        f"val: {os.path.join(root, 'val', 'images')}",
+        "",
+        "names:",
+    ]
+    lines += [f"  {i}: {name}" for i, name in enumerate(names)]
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def build_dataset(mixed_dir=MIXED_DIR, dataset_dir=DATASET_DIR, group_by='session', stratify='none',
+                  val_fraction=VAL_FRACTION, seed=SEED, link='hardlink', workers=8, data_yaml=DATA_YAML):
+    for split in ('train', 'val'):
+        for kind in ('images', 'labels'):
+            os.makedirs(os.path.join(dataset_dir, split, kind), exist_ok=True)
+
+    manifest_path = os.path.join(dataset_dir, MANIFEST_NAME)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    previous = manifest.get('files', {})
+
+    image_files = sorted(f for f in os.listdir(mixed_dir) if f.lower().endswith(IMAGE_EXTENSIONS))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        inspected = dict(pool.map(lambda name: inspect(mixed_dir, name, previous.get(name), len(CLASS_NAMES)),
+                                  image_files))
+
+    entries = {}
+    for name, info in inspected.items():
+        if info['error']:
+            print(f"⚠️  Skipping {name}: {info['error']}")
         else:
-            print(f"⚠️  Missing label for {img_file}, skipping label copy.")
+            entries[name] = info
+
+    splits = assign_splits(entries, group_keys(entries, group_by), val_fraction, seed, stratify)
+    if group_by != 'none' and entries and val_fraction > 0 and 'val' not in splits.values():
+        print(f"⚠️  Too few '{group_by}' groups for a validation split, splitting per image instead")
+        group_by = 'none'
+        splits = assign_splits(entries, group_keys(entries, group_by), val_fraction, seed, stratify)
+
+    placed = unchanged = 0
+    for name, info in entries.items():
+        split = splits[name]
+        lbl_name = os.path.splitext(name)[0] + '.txt'
+        img_dst = os.path.join(dataset_dir, split, 'images', name)
+        old = previous.get(name)
+        if (old and old.get('split') == split and old.get('sha1') == info['sha1']
+                and old.get('label_mtime') == info['label_mtime'] and os.path.exists(img_dst)):
+            info['split'] = split
+            unchanged += 1
+            continue
+        if old and old.get('split') and old['split'] != split:
+            remove_placed(dataset_dir, old['split'], name)
+        place(os.path.join(mixed_dir, name), img_dst, link)
+        if info.get('labelled', True):
+            place(os.path.join(mixed_dir, lbl_name), os.path.join(dataset_dir, split, 'labels', lbl_name), link)
+        else:
+            print(f"⚠️  Missing label for {name}, placing the image without one.")
+            stale = os.path.join(dataset_dir, split, 'labels', lbl_name)
+            if os.path.lexists(stale):
+                os.remove(stale)
+        info['split'] = split
+        placed += 1
+
+    removed = 0
+    for name, old in previous.items():
+        if name not in entries and old.get('split'):
+            remove_placed(dataset_dir, old['split'], name)
+            removed += 1
+
+    if placed or removed:
+        # Ultralytics caches the label list per split; force a rescan after any change
+        for split in ('train', 'val'):
+            cache = os.path.join(dataset_dir, split, 'labels.cache')
+            if os.path.exists(cache):
+                os.remove(cache)
+
+    with open(manifest_path, 'w') as f:
+        json.dump({'group_by': group_by, 'stratify': stratify, 'seed': seed, 'files': entries}, f)
+    write_data_yaml(data_yaml, dataset_dir, CLASS_NAMES)
+
+    n_val = sum(1 for s in splits.values() if s == 'val')
+    print(f"📊 Total: {len(entries)} | Train: {len(entries) - n_val} | Val: {n_val} "
+          f"| placed {placed}, unchanged {unchanged}, removed {removed}")
+    if entries and n_val == 0:
+        print("⚠️  Validation split is empty")
+    print(f"✅ Dataset ready in '{dataset_dir}', config written to {data_yaml}")
 
-# Move files
-move_files(train_images, train_img_dir, train_lbl_dir)
-move_files(val_images, val_img_dir, val_lbl_dir)
 
-print("✅ Dataset split complete: Check 'dataset/train' and 'dataset/val'.")
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Incrementally split labelled images into a YOLO dataset")
+    parser.add_argument('--source', default=MIXED_DIR, help="directory with images and their .txt labels")
+    parser.add_argument('--dataset', default=DATASET_DIR)
+    parser.add_argument('--group-by', choices=['session', 'plate', 'none'], default='session',
+                        help="keep frames of one capture session or one plate in the same split")
+    parser.add_argument('--stratify', choices=['none', 'class', 'boxes'], default='none')
+    parser.add_argument('--val-fraction', type=float, default=VAL_FRACTION)
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--link', choices=['hardlink', 'symlink', 'copy'], default='hardlink')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4)
+    parser.add_argument('--yaml', default=DATA_YAML, help="data.yaml to write for training")
+    args = parser.parse_args()
+    build_dataset(args.source, args.dataset, args.group_by, args.stratify, args.val_fraction,
+                  args.seed, args.link, args.workers, args.yaml)
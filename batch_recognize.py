@@ -0,0 +1,214 @@
+"""Offline re-recognition of archived crops, frame folders or videos.
+
+    python batch_recognize.py plates --crops -o audit.csv
+    python batch_recognize.py footage.mp4 -o footage.jsonl
+
+Frames go through the detector in batches and every crop is read by the OCR
+process pool, so all cores are busy. Rows are appended to the output (CSV or
+JSONL, picked by extension) as soon as every crop of their frame has been read,
+so a frame is either fully in the output or not at all. Re-running with the
+same output skips the frames already in it and resumes a video at the first
+frame that is missing. When a file name carries the plate
+(RAF287E_20250602_121513.jpg) it is used as ground truth and accuracy is
+reported at the end.
+"""
+import argparse
+import csv
+import json
+import os
+import re
+from collections import Counter
+import cv2
+from plate_reader import crop_plates, normalize_plate, MIN_PLATE_HEIGHT, MIN_PLATE_WIDTH
+from ocr_pool import OcrPool, OCR_WORKERS
+
+GROUND_TRUTH = re.compile(r'^(RA[A-Z]\d{3}[A-Z])_')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+FIELDS = ['source', 'frame', 'box', 'plate', 'conf', 'variant', 'raw', 'truth', 'correct']
+BATCH_SIZE = 16
+
+
+class ResultWriter:
+    """Appends result rows to a CSV or JSONL file and remembers what is already done"""
+
+    def __init__(self, path):
+        self.path = path
+        self.jsonl = path.endswith('.jsonl')
+        self.done = set()
+        self.rows = []
+        if os.path.exists(path):
+            for row in self._read_existing():
+                self.done.add((row['source'], int(row['frame'])))
+                self.rows.append(row)
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'a', newline='')
+        self.csv = None if self.jsonl else csv.DictWriter(self.file, fieldnames=FIELDS)
+        if self.csv and is_new:
+            self.csv.writeheader()
+
+    def _read_existing(self):
+        with open(self.path, newline='') as f:
+            if self.jsonl:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+            else:
+                yield from csv.DictReader(f)
+
+    def write_frame(self, rows):
+        """Append every row of one frame; the frame counts as done only once all are written"""
+        for row in rows:
+            if self.jsonl:
+                self.file.write(json.dumps(row) + '\n')
+            else:
+                self.csv.writerow(row)
+        self.file.flush()
+        self.rows.extend(rows)
+        for row in rows:
+            self.done.add((row['source'], int(row['frame'])))
+
+    def close(self):
+        self.file.close()
+
+
+def iter_frames(path, writer):
+    """Yield (source, frame index, image) for a directory of images or a video, skipping finished ones"""
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if not name.lower().endswith(IMAGE_EXTENSIONS) or (name, 0) in writer.done:
+                continue
+            image = cv2.imread(os.path.join(path, name))
+            if image is not None:
+                yield name, 0, image
+        return
+
+    source = os.path.basename(path)
+    cap = cv2.VideoCapture(path)
+    done_frames = {frame for src, frame in writer.done if src == source}
+    index = 0
+    while index in done_frames:
+        index += 1
+    if index:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+        print(f"[RESUME] {source}: continuing at frame {index}")
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if index not in done_frames:
+            yield source, index, frame
+        index += 1
+    cap.release()
+
+
+def batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def make_row(source, frame, box, read, truth):
+    plate, conf, variant, raw = read
+    return {
+        'source': source, 'frame': frame, 'box': box,
+        'plate': plate or '', 'conf': round(conf, 1), 'variant': variant or '', 'raw': raw,
+        'truth': truth or '', 'correct': '' if not truth else int(plate == truth),
+    }
+
+
+class FrameRows:
+    """Rows of the frames whose crops are still being read, written out once a frame is complete"""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.frames = {}            # (source, frame) -> [rows, crops still at OCR]
+
+    def add(self, source, frame, rows, outstanding):
+        if outstanding:
+            self.frames[source, frame] = [rows, outstanding]
+        else:
+            self.writer.write_frame(rows)
+
+    def flush(self, pool, timeout=0):
+        for _, _, read, (source, frame, box, truth) in pool.poll(timeout=timeout):
+            entry = self.frames[source, frame]
+            entry[0].append(make_row(source, frame, box, read, truth))
+            entry[1] -= 1
+            if not entry[1]:
+                del self.frames[source, frame]
+                self.writer.write_frame(sorted(entry[0], key=lambda row: row['box']))
+
+
+def run(path, output, crops=False, workers=OCR_WORKERS, batch_size=BATCH_SIZE):
+    writer = ResultWriter(output)
+    pool = OcrPool(workers=workers)
+    detector = None
+    if not crops:
+        from detector import SharedDetector
+        detector = SharedDetector(max_batch=batch_size)
+
+    pending = FrameRows(writer)
+    try:
+        for batch in batches(iter_frames(path, writer), batch_size):
+            if crops:
+                found = [[(0, image)] for _, _, image in batch]
+            else:
+                results = detector.detect([image for _, _, image in batch])
+                found = [list(enumerate(plate_img for _, plate_img in crop_plates(image, result)))
+                         for (_, _, image), result in zip(batch, results)]
+
+            for (source, frame, image), plates in zip(batch, found):
+                match = GROUND_TRUTH.match(source)
+                truth = match.group(1) if match else None
+                rows, reading = [], []
+                for box, plate_img in plates:
+                    if plate_img.shape[0] < MIN_PLATE_HEIGHT or plate_img.shape[1] < MIN_PLATE_WIDTH:
+                        if crops:
+                            rows.append(make_row(source, frame, box, (None, 0.0, None, ''), truth))
+                        continue
+                    reading.append((box, plate_img))
+                if not rows and not reading:
+                    rows.append(make_row(source, frame, -1, (None, 0.0, None, ''), truth))
+                pending.add(source, frame, rows, len(reading))
+                for box, plate_img in reading:
+                    pool.submit('batch', normalize_plate(plate_img), payload=(source, frame, box, truth))
+                    pending.flush(pool)
+
+        while pool.pending():
+            pending.flush(pool, timeout=0.5)
+        pending.flush(pool)
+    except KeyboardInterrupt:
+        print("\n[BATCH] Interrupted, re-run with the same output to resume.")
+    finally:
+        pool.close()
+        writer.close()
+
+    report(writer.rows)
+
+
+def report(rows):
+    labelled = [r for r in rows if r['truth'] and str(r['box']) in ('0', '-1')]
+    print(f"[BATCH] {len(rows)} rows, {sum(1 for r in rows if r['plate'])} with a valid plate")
+    if not labelled:
+        return
+    correct = sum(int(r['correct'] or 0) for r in labelled)
+    print(f"[ACCURACY] {correct}/{len(labelled)} = {100 * correct / len(labelled):.1f}% against file names")
+    variants = Counter(r['variant'] for r in labelled if str(r['correct']) == '1')
+    for variant, count in variants.most_common():
+        print(f"  {variant:<16}{count}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-run plate recognition over archived images or video")
+    parser.add_argument('input', help="directory of images or a video file")
+    parser.add_argument('-o', '--output', default='recognitions.csv', help="results file (.csv or .jsonl)")
+    parser.add_argument('--crops', action='store_true', help="inputs are already plate crops, skip the detector")
+    parser.add_argument('--workers', type=int, default=OCR_WORKERS)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+    run(args.input, args.output, args.crops, args.workers, args.batch_size)
@@ -0,0 +1,76 @@
+import argparse
+import os
+import re
+import time
+from collections import defaultdict
+import cv2
+from plate_reader import (normalize_plate, make_variants, ocr_with_confidence, extract_plate_number,
+                          preprocess_plate, ocr_plate, read_plate, VARIANTS)
+
+# Saved crops are named <PLATE>_<YYYYmmdd>_<HHMMSS>.jpg by car_entry.py
+LABELLED_CROP = re.compile(r'^(RA[A-Z]\d{3}[A-Z])_\d{8}_\d{6}')
+
+
+def labelled_crops(image_dir, limit=None):
+    """Yield (path, ground truth plate) for every crop whose filename carries the plate"""
+    count = 0
+    for name in sorted(os.listdir(image_dir)):
+        match = LABELLED_CROP.match(name)
+        if not match:
+            continue
+        yield os.path.join(image_dir, name), match.group(1)
+        count += 1
+        if limit and count >= limit:
+            return
+
+
+def run_benchmark(image_dir, limit=None):
+    hits = defaultdict(int)
+    seconds = defaultdict(float)
+    total = 0
+
+    for path, truth in labelled_crops(image_dir, limit):
+        plate_img = cv2.imread(path)
+        if plate_img is None:
+            continue
+        total += 1
+
+        # Baseline: the original single Otsu pass
+        start = time.perf_counter()
+        plate = extract_plate_number(ocr_plate(preprocess_plate(plate_img)))
+        seconds['baseline'] += time.perf_counter() - start
+        hits['baseline'] += plate == truth
+
+        start = time.perf_counter()
+        gray = normalize_plate(plate_img)
+        variants = make_variants(gray)
+        seconds['preprocess (all variants)'] += time.perf_counter() - start
+
+        for name, image in variants.items():
+            start = time.perf_counter()
+            text, _ = ocr_with_confidence(image)
+            seconds[name] += time.perf_counter() - start
+            hits[name] += extract_plate_number(text) == truth
+
+        start = time.perf_counter()
+        plate, _, _, _ = read_plate(gray)
+        seconds['read_plate (best of variants)'] += time.perf_counter() - start
+        hits['read_plate (best of variants)'] += plate == truth
+
+    if not total:
+        print(f"[BENCH] No labelled crops found in {image_dir}")
+        return
+
+    print(f"[BENCH] {total} labelled crops from {image_dir}")
+    print(f"{'stage':<32}{'hit rate':>10}{'ms/crop':>10}")
+    for name in ['baseline', 'preprocess (all variants)', *VARIANTS, 'read_plate (best of variants)']:
+        rate = f"{100 * hits[name] / total:.1f}%" if name in hits else '-'
+        print(f"{name:<32}{rate:>10}{1000 * seconds[name] / total:>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure OCR hit rate and time per preprocessing variant")
+    parser.add_argument('image_dir', nargs='?', default='plates')
+    parser.add_argument('--limit', type=int, default=None, help="only use the first N crops")
+    args = parser.parse_args()
+    run_benchmark(args.image_dir, args.limit)
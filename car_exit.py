@@ -1,19 +1,27 @@
+import startup
 import cv2
-from ultralytics import YOLO
-import pytesseract
 import os
 import time
 import serial
-import serial.tools.list_ports
 import csv
-from collections import Counter
-from web.db import is_payment_complete_db, update_exit_status_db, is_already_exited, log_unauthorized_exit
+from detector import attach_detector
+from plate_reader import read_plate, PlateVote
+from crop_quality import CropSelector
+from plate_index import OpenPlateIndex
+from harvest import RecognitionLog
+from frame_ring import FrameRing, ClipWriter
+from presence import CameraPresence, fuse, needs_camera
+from serial_link import GateLink, detect_arduino_port, OPEN, CLOSE, ALERT
+from web.db import is_payment_complete_db, update_exit_status_db, is_already_exited, log_unauthorized_exit, get_open_plates, plate_is_known
+from applog import get_logger, setup as setup_logging
 
+log = get_logger('car_exit')
+setup_logging('car_exit')
 
-pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
 
-# Load YOLOv8 model (same model as entry)
-model = YOLO('best.pt')
+# YOLOv8 model (same model as entry): the warm detector service, or loaded
+# in the background while the Arduino and camera come up
+detector = attach_detector()
 
 # CSV log file
 csv_file = 'plates_log.csv'
@@ -26,236 +34,201 @@ if not os.path.exists(csv_file):
         writer = csv.writer(f)
         writer.writerow(['Plate Number', 'Payment Status', 'Timestamp'])
 
-def detect_arduino_port():
-    """Detect Arduino port with better error handling"""
-    ports = list(serial.tools.list_ports.comports())
-    for port in ports:
-        if "Arduino" in port.description or "USB-SERIAL" in port.description:
-            return port.device
-    # If no Arduino found, try common COM ports
-    for port_name in ['COM3', 'COM4', 'COM5', 'COM6']:
-        try:
-            test_serial = serial.Serial(port_name, 9600, timeout=1)
-            test_serial.close()
-            return port_name
-        except:
-            continue
-    return None
-
-def connect_arduino(max_retries=3):
-    """Connect to Arduino with retry logic"""
-    arduino_port = detect_arduino_port()
-    
-    if not arduino_port:
-        print("[ERROR] No Arduino port detected.")
-        return None
-    
-    for attempt in range(max_retries):
-        try:
-            print(f"[CONNECTING] Attempting to connect to Arduino on {arduino_port} (attempt {attempt + 1})")
-            arduino = serial.Serial(arduino_port, 9600, timeout=1)
-            time.sleep(2)  # Wait for Arduino to initialize
-            print(f"[CONNECTED] Arduino successfully connected on {arduino_port}")
-            return arduino
-        except serial.SerialException as e:
-            print(f"[ERROR] Connection attempt {attempt + 1} failed: {e}")
-            if "Access is denied" in str(e):
-                print("[HELP] Port may be in use. Try:")
-                print("- Close Arduino IDE")
-                print("- Unplug and replug Arduino")
-                print("- Check Device Manager for correct COM port")
-            time.sleep(1)
-    
-    print("[ERROR] Failed to connect to Arduino after all attempts.")
-    return None
-
-def read_distance(arduino):
-    """Read distance from Arduino with proper error handling"""
-    if not arduino:
-        return 150  # Default safe distance when no Arduino
-    
-    try:
-        if arduino.in_waiting > 0:
-            val = arduino.readline().decode('utf-8').strip()
-            if val:
-                distance = float(val)
-                # Validate reasonable distance range
-                if 0 <= distance <= 400:  # HC-SR04 max range is ~400cm
-                    return distance
-                else:
-                    print(f"[WARNING] Invalid distance reading: {distance}")
-                    return 150
-            else:
-                return 150  # No data available
-        else:
-            return 150  # No data waiting
-    except (UnicodeDecodeError, ValueError, serial.SerialException) as e:
-        print(f"[ERROR] Reading distance: {e}")
-        return 150
-    except Exception as e:
-        print(f"[UNEXPECTED ERROR] {e}")
-        return 150
+def read_distance(gate):
+    """Median of the recent distances drained by the gate reader thread, None when there are none"""
+    if not gate:
+        return None  # No Arduino: presence comes from the camera
+    return gate.median_distance()
 
 def is_payment_complete(plate_number):
     return is_payment_complete_db(plate_number)
 
 # Connect to Arduino
-arduino = connect_arduino()
+arduino_port = detect_arduino_port()
+if not arduino_port:
+    log.error("[ERROR] No Arduino port detected.")
+gate = GateLink.open(arduino_port)
 
 # Initialize camera
 cap = cv2.VideoCapture(0)
 if not cap.isOpened():
-    print("[ERROR] Could not open camera")
+    log.error("[ERROR] Could not open camera")
     exit()
 
-plate_buffer = []
+plate_vote = PlateVote()
+crops = CropSelector()
+presence = CameraPresence()
+open_plates = OpenPlateIndex(get_open_plates, is_known=plate_is_known)
+recognitions = RecognitionLog()
+ring = FrameRing()
+clips = ClipWriter()
+vehicle_reads = []
 exit_cooldown = 60  # 1 minute cooldown between exits for same plate
 last_exited_plate = None
 last_exit_time = 0
 
-print("[EXIT SYSTEM] Ready. Press 'q' to quit.")
-print("[INFO] Distance threshold: 50cm")
+startup.mark('gate_ready')
+log.info("[EXIT SYSTEM] Ready. Press 'q' to quit.")
+log.info("[INFO] Distance threshold: 50cm")
 
 try:
     while True:
         ret, frame = cap.read()
         if not ret:
-            print("[ERROR] Could not read frame from camera")
+            log.error("[ERROR] Could not read frame from camera")
             break
+        now = time.time()
+        ring.push(frame, now)
+        for name, clip in ring.poll(now):
+            clips.write(name, clip)
 
         # Read distance from Arduino
-        distance = read_distance(arduino)
-        print(f"[SENSOR] Distance: {distance} cm")
+        distance = read_distance(gate)
+        log.debug("[SENSOR] Distance: %s cm", distance)
 
-        # Only process if vehicle is close enough
-        if distance and distance <= 50:
-            results = model(frame)
+        # The gate is blind until the model has loaded
+        if detector.ready:
+            startup.mark('detector_ready')
 
-            for result in results:
-                for box in result.boxes:
-                    x1, y1, x2, y2 = map(int, box.xyxy[0])
-                    plate_img = frame[y1:y2, x1:x2]
-                    
-                    # Skip if plate image is too small
-                    if plate_img.shape[0] < 20 or plate_img.shape[1] < 50:
-                        continue
+        # The camera stands in for the sensor while it is silent
+        if needs_camera(distance) and presence.due(now):
+            presence.update(frame, now)
 
-                    # Preprocessing
-                    gray = cv2.cvtColor(plate_img, cv2.COLOR_BGR2GRAY)
-                    blur = cv2.GaussianBlur(gray, (5, 5), 0)
-                    thresh = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
-
-                    # OCR
-                    plate_text = pytesseract.image_to_string(
-                        thresh, config='--psm 8 --oem 3 -c tessedit_char_whitelist=ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
-                    ).strip().replace(" ", "")
-
-                    if "RA" in plate_text:
-                        start_idx = plate_text.find("RA")
-                        plate_candidate = plate_text[start_idx:]
-                        if len(plate_candidate) >= 7:
-                            plate_candidate = plate_candidate[:7]
-                            prefix, digits, suffix = plate_candidate[:3], plate_candidate[3:6], plate_candidate[6]
-                            if (prefix.isalpha() and prefix.isupper() and
-                                digits.isdigit() and suffix.isalpha() and suffix.isupper()):
-                                print(f"[VALID] Plate Detected: {plate_candidate}")
-                                plate_buffer.append(plate_candidate)
-
-                                if len(plate_buffer) >= 3:
-                                    most_common = Counter(plate_buffer).most_common(1)[0][0]
-                                    plate_buffer.clear()
-                                    
-                                    current_time = time.time()
-                                    
-                                    # Check cooldown to prevent multiple exits for same vehicle
-                                    if (most_common == last_exited_plate and 
-                                        (current_time - last_exit_time) < exit_cooldown):
-                                        print(f"[SKIPPED] {most_common} recently exited, cooldown active")
-                                        continue
-
-                                    if is_payment_complete(most_common):
-                                        print(f"[ACCESS GRANTED] Payment complete for {most_common}")
-                                        
-                                        update_exit_status_db(most_common)
-                                        
-                                        # Log exit to CSV
-                                        with open(csv_file, 'a', newline='') as f:
-                                            writer = csv.writer(f)
-                                            writer.writerow([most_common, '2', time.strftime('%Y-%m-%d %H:%M:%S')])
-                                        print(f"[LOGGED] Exit recorded in CSV for {most_common}")
-                                        
-                                        # Control gate
-                                        if arduino:
-                                            try:
-                                                arduino.write(b'1')  # Open gate
-                                                print("[GATE] Opening gate (sent '1')")
-                                                time.sleep(15)
-                                                arduino.write(b'0')  # Close gate
-                                                print("[GATE] Closing gate (sent '0')")
-                                            except serial.SerialException as e:
-                                                print(f"[ERROR] Gate control failed: {e}")
-                                        
-                                        last_exited_plate = most_common
-                                        last_exit_time = current_time
-                                        
-                                        time.sleep(5)
-                                        
-                                    else:
-                                        if is_already_exited(most_common):
-                                            print(f"[ACCESS DENIED] Car with plate {most_common} can't exit twice")
-                                            if arduino:
-                                                try:
-                                                    arduino.write(b'2')  # Alert
-                                                    print("[Alert] Alerting unauthorised exit (sent '2')")
-                                                except serial.SerialException as e:
-                                                    print(f"[ERROR] Gate control failed: {e}")
-                                            time.sleep(5)
-                                        else:
-                                            print(f"[ACCESS DENIED] Payment NOT complete for {most_common}")
-                                            log_unauthorized_exit(most_common)
-                                            if arduino:
-                                                try:
-                                                    arduino.write(b'2')  # Alert
-                                                    print("[Alert] Alerting unauthorised exit (sent '2')")
-                                                except serial.SerialException as e:
-                                                    print(f"[ERROR] Gate control failed: {e}")
-                                            time.sleep(5)
-                                            
-                                        if arduino:
-                                            try:
-                                                arduino.write(b'2')  # Trigger warning buzzer
-                                                print("[ALERT] Buzzer triggered (sent '2')")
-                                            except serial.SerialException as e:
-                                                print(f"[ERROR] Buzzer control failed: {e}")
-
-                    # Display processed images
-                    cv2.imshow("Plate", plate_img)
-                    cv2.imshow("Processed", thresh)
-                    time.sleep(0.1)  # Reduced sleep time
+        # Only process if vehicle is close enough
+        if fuse(distance, presence.present(now), 50) and detector.ready:
+            results = detector.detect([frame])
 
+            for result in results:
+                crops.add(frame, result, lambda box, plate_img: (frame, plate_img, tuple(map(int, box.xyxy[0]))), now)
+            
             # Show annotated frame when vehicle is detected
             annotated_frame = results[0].plot() if results else frame
         else:
             # Show regular frame when no vehicle nearby
             annotated_frame = frame
 
+        # OCR only the best crops of each selection window
+        for gray, (seen_frame, plate_img, (x1, y1, x2, y2)) in crops.take(now):
+            plate_candidate, conf, variant, _ = read_plate(gray)
+
+            if plate_candidate:
+                log.info("[VALID] Plate Detected: %s (%s, conf %.0f)", plate_candidate, variant, conf)
+                vehicle_reads.append((plate_candidate, conf, variant))
+
+                most_common = plate_vote.add(plate_candidate, conf)
+                if most_common:
+                    current_time = time.time()
+
+                    # Check cooldown to prevent multiple exits for same vehicle
+                    if (most_common == last_exited_plate and 
+                        (current_time - last_exit_time) < exit_cooldown):
+                        log.info("[SKIPPED] %s recently exited, cooldown active", most_common)
+                        vehicle_reads = []
+                        continue
+
+                    # Resolve near-miss reads (one OCR error) to the open session they belong to
+                    matched, candidates = open_plates.match(most_common)
+                    if matched is None and len(candidates) > 1:
+                        log.warning("[AMBIGUOUS] %s could be %s, reading again",
+                                    most_common, ', '.join(p for _, p in candidates))
+                        vehicle_reads = []
+                        crops.clear()
+                        continue
+                    if matched and matched != most_common:
+                        log.info("[MATCHED] Read %s resolved to open session %s", most_common, matched)
+                        most_common = matched
+
+                    if is_payment_complete(most_common):
+                        log.info("[ACCESS GRANTED] Payment complete for %s", most_common)
+
+                        update_exit_status_db(most_common)
+
+                        # Log exit to CSV
+                        with open(csv_file, 'a', newline='') as f:
+                            writer = csv.writer(f)
+                            writer.writerow([most_common, '2', time.strftime('%Y-%m-%d %H:%M:%S')])
+                        log.info("[LOGGED] Exit recorded in CSV for %s", most_common)
+
+                        # Control gate
+                        if gate:
+                            try:
+                                opened = gate.send(OPEN)  # Open gate
+                                log.info("[GATE] Opening gate (sent '1')")
+                                if not (opened and opened.wait()):
+                                    log.warning("[WARNING] Gate did not confirm opening")
+                                time.sleep(15)
+                                gate.send(CLOSE)  # Close gate
+                                log.info("[GATE] Closing gate (sent '0')")
+                            except serial.SerialException as e:
+                                log.error("[ERROR] Gate control failed: %s", e)
+
+                        last_exited_plate = most_common
+                        last_exit_time = current_time
+                        outcome = 'granted'
+
+                        time.sleep(5)
+
+                    else:
+                        if is_already_exited(most_common):
+                            log.warning("[ACCESS DENIED] Car with plate %s can't exit twice", most_common)
+                            outcome = 'denied_exited'
+                            ring.alert(f"exit_{outcome}_{most_common}", time.time())
+                            if gate:
+                                try:
+                                    alert = gate.send(ALERT)  # Alert, which also sounds the buzzer
+                                    log.info("[Alert] Alerting unauthorised exit (sent '2')")
+                                    if not (alert and alert.wait()):
+                                        log.warning("[WARNING] Gate did not confirm the alert")
+                                except serial.SerialException as e:
+                                    log.error("[ERROR] Gate control failed: %s", e)
+                            time.sleep(5)
+                        else:
+                            log.warning("[ACCESS DENIED] Payment NOT complete for %s", most_common)
+                            outcome = 'denied_unpaid'
+                            log_unauthorized_exit(most_common)
+                            ring.alert(f"exit_{outcome}_{most_common}", time.time())
+                            if gate:
+                                try:
+                                    alert = gate.send(ALERT)  # Alert, which also sounds the buzzer
+                                    log.info("[Alert] Alerting unauthorised exit (sent '2')")
+                                    if not (alert and alert.wait()):
+                                        log.warning("[WARNING] Gate did not confirm the alert")
+                                except serial.SerialException as e:
+                                    log.error("[ERROR] Gate control failed: %s", e)
+                            time.sleep(5)
+
+                    startup.mark('first_decision')
+                    # Keep the decision for the nightly training-data harvest
+                    recognitions.record('exit', 'exit', seen_frame, (x1, y1, x2, y2), vehicle_reads, most_common, outcome)
+                    vehicle_reads = []
+                    crops.clear()
+
+            # Display processed images
+            cv2.imshow("Plate", plate_img)
+            cv2.imshow("Processed", gray)
+            time.sleep(0.1)  # Reduced sleep time
+
         cv2.imshow("Exit Webcam Feed", annotated_frame)
 
         if cv2.waitKey(1) & 0xFF == ord('q'):
             break
 
 except KeyboardInterrupt:
-    print("\n[SYSTEM] Shutting down...")
+    log.info("[SYSTEM] Shutting down...")
 except Exception as e:
-    print(f"[ERROR] Unexpected error: {e}")
+    log.exception("[ERROR] Unexpected error: %s", e)
 finally:
     # Cleanup
+    for name, clip in ring.poll(float('inf')):
+        clips.write(name, clip)
+    clips.close()
     cap.release()
-    if arduino:
+    if gate:
         try:
-            arduino.close()
-            print("[SYSTEM] Arduino connection closed.")
+            gate.close()
+            log.info("[SYSTEM] Arduino connection closed.")
         except:
             pass
+    recognitions.close()
     cv2.destroyAllWindows()
-    print("[SYSTEM] Exit system shutdown complete.")
\ No newline at end of file
+    log.info("[SYSTEM] Exit system shutdown complete.")
\ No newline at end of file
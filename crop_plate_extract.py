@@ -3,7 +3,7 @@ from ultralytics import YOLO
 import pytesseract
 import os
 import time
-import re
+from plate_grammar import DEFAULT_GRAMMAR
 
 # Load YOLOv8 model (update path if needed)
 model = YOLO('best.pt')
@@ -47,26 +47,11 @@ while True:
                 config='--psm 8 --oem 3 -c tessedit_char_whitelist=ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
             ).strip()
 
-            # ===== Validation Logic with 8th Char Tolerance =====
-            match = re.search(r'RA[A-Z0-9 ]*', plate_text.upper())
-            if match:
-                plate_candidate = match.group()
-                plate_clean = plate_candidate.replace(" ", "")
-
-                if len(plate_clean) == 8:
-                    plate_clean = plate_clean[:7]  # Trim extra char
-
-                if len(plate_clean) == 7:
-                    first_three = plate_clean[:3]
-                    digits_part = plate_clean[3:6]
-                    last_char = plate_clean[6]
-
-                    if first_three.isalpha() and digits_part.isdigit() and last_char.isalpha():
-                        print(f"✅ Valid Plate: {plate_clean}")
-                    else:
-                        print(f"❌ Invalid Format: {plate_clean}")
-                else:
-                    print(f"❌ Incorrect Length after cleaning: {plate_clean}")
+            # ===== Validation with plate grammar (corrects 0/O, 2/Z, ... and stray chars) =====
+            candidates = DEFAULT_GRAMMAR.candidates(plate_text)
+            if candidates:
+                plate_clean, score, _ = candidates[0]
+                print(f"✅ Valid Plate: {plate_clean} (score {score:.2f}, raw '{plate_text}')")
             else:
                 print(f"❌ No valid RA plate found in: '{plate_text}'")
 
@@ -0,0 +1,181 @@
+"""Rank plate crops by how likely they are to read, and send only the best to OCR.
+
+    selector = CropSelector()                       # one per track (lane)
+    selector.add(frame, result, payload_for, now)   # every detection result
+    for gray, payload in selector.take(now):        # once per WINDOW_SECONDS
+        ocr.submit(track, gray, payload=payload)
+
+A vehicle in front of the camera produces a plate crop on every detected
+frame, and most of them are near-duplicates; the motion-blurred and oblique
+ones rarely read at all. CropSelector collects a track's crops for
+WINDOW_SECONDS from the first one, then hands over the TOP_K best and drops
+the rest, so a vehicle costs TOP_K OCR calls per window instead of one per
+frame.
+
+score_crops() scores every crop of a batch at once. The normalized crops
+(PLATE_HEIGHT high) are padded into one array and the Laplacian, its variance
+and the gray-level spread are computed over the whole stack with a validity
+mask, without resampling anything. Each term is mapped to 0..1 and combined
+with WEIGHTS:
+
+    sharpness   variance of the Laplacian, saturating at SHARPNESS_GOOD
+    contrast    standard deviation of the gray levels, saturating at CONTRAST_GOOD
+    aspect      closeness of the box's width/height to PLATE_ASPECT
+    confidence  the detector's box confidence
+    angle       skew of the characters, 0 at MAX_SKEW_ANGLE or beyond
+
+Crops below MIN_QUALITY are never sent.
+
+    python crop_quality.py plates/ --top 10    # score saved crops, best and worst first
+"""
+import argparse
+import os
+import cv2
+import numpy as np
+from plate_reader import crop_plates, normalize_plate, skew_angle, MAX_SKEW_ANGLE
+
+# Configuration
+TOP_K = 2                   # crops per window sent to OCR; matches PlateVote's VOTES_REQUIRED
+WINDOW_SECONDS = 0.4        # how long a track collects crops before the best are picked
+MIN_QUALITY = 0.25
+SHARPNESS_GOOD = 400.0      # Laplacian variance of a crisp crop at PLATE_HEIGHT
+CONTRAST_GOOD = 50.0        # gray-level standard deviation of a well lit crop
+PLATE_ASPECT = 4.5          # width / height of a single-row plate
+WEIGHTS = {'sharpness': 0.35, 'contrast': 0.2, 'aspect': 0.15, 'confidence': 0.2, 'angle': 0.1}
+
+
+def prepare(plate_img):
+    """(normalized gray, skew angle) of a BGR crop; the angle is measured once for both"""
+    gray = cv2.cvtColor(plate_img, cv2.COLOR_BGR2GRAY) if plate_img.ndim == 3 else plate_img
+    angle = skew_angle(gray)
+    return normalize_plate(gray, angle=angle), angle
+
+
+def score_crops(grays, sizes, confidences, angles):
+    """Quality 0..1 of each normalized crop.
+
+    grays are normalized crops of equal height; sizes the (w, h) of the
+    original boxes; confidences the detector's; angles from skew_angle().
+    Returns (scores, terms) where terms maps each WEIGHTS name to its array.
+    """
+    n = len(grays)
+    if not n:
+        return np.zeros(0), {name: np.zeros(0) for name in WEIGHTS}
+    height = grays[0].shape[0]
+    widths = np.array([gray.shape[1] for gray in grays])
+    stack = np.zeros((n, height, widths.max()), dtype=np.float32)
+    for i, gray in enumerate(grays):
+        stack[i, :, :gray.shape[1]] = gray
+    columns = np.arange(stack.shape[2])
+
+    # 4-neighbour Laplacian over the interior of every crop at once
+    inner = stack[:, 1:-1, 1:-1]
+    laplacian = stack[:, :-2, 1:-1] + stack[:, 2:, 1:-1] + stack[:, 1:-1, :-2] + stack[:, 1:-1, 2:] - 4 * inner
+    inner_mask = np.broadcast_to((columns[1:-1] < widths[:, None] - 1)[:, None, :], laplacian.shape)
+    sharpness = masked_std(laplacian, inner_mask) ** 2
+
+    mask = np.broadcast_to((columns < widths[:, None])[:, None, :], stack.shape)
+    contrast = masked_std(stack, mask)
+
+    sizes = np.asarray(sizes, dtype=np.float64).reshape(n, 2)
+    aspect = sizes[:, 0] / np.maximum(sizes[:, 1], 1)
+    terms = {
+        'sharpness': np.minimum(sharpness / SHARPNESS_GOOD, 1.0),
+        'contrast': np.minimum(contrast / CONTRAST_GOOD, 1.0),
+        'aspect': np.exp(-np.abs(np.log(np.maximum(aspect, 1e-3) / PLATE_ASPECT))),
+        'confidence': np.clip(np.asarray(confidences, dtype=np.float64), 0.0, 1.0),
+        'angle': np.clip(1.0 - np.abs(np.asarray(angles, dtype=np.float64)) / MAX_SKEW_ANGLE, 0.0, 1.0),
+    }
+    scores = sum(WEIGHTS[name] * term for name, term in terms.items()) / sum(WEIGHTS.values())
+    return scores, terms
+
+
+def masked_std(values, mask):
+    """Standard deviation over the last two axes, counting only where mask is set"""
+    count = np.maximum(mask.sum(axis=(1, 2)), 1)
+    mean = np.where(mask, values, 0).sum(axis=(1, 2)) / count
+    centred = np.where(mask, values - mean[:, None, None], 0)
+    return np.sqrt((centred ** 2).sum(axis=(1, 2)) / count)
+
+
+class CropSelector:
+    """Collects a track's crops over a short window and releases the TOP_K best"""
+
+    def __init__(self, top_k=TOP_K, window=WINDOW_SECONDS, min_quality=MIN_QUALITY):
+        self.top_k = top_k
+        self.window = window
+        self.min_quality = min_quality
+        self.candidates = []        # (score, gray, payload)
+        self.opened_at = None
+
+    def add(self, frame, result, payload_for, now):
+        """Score the crops of one detection result; payload_for(box, plate_img) is kept with each.
+
+        Returns how many crops were scored.
+        """
+        crops = list(crop_plates(frame, result))
+        if not crops:
+            return 0
+        prepared = [prepare(plate_img) for _, plate_img in crops]
+        grays = [gray for gray, _ in prepared]
+        sizes = [(plate_img.shape[1], plate_img.shape[0]) for _, plate_img in crops]
+        confidences = [float(box.conf[0]) if hasattr(box, 'conf') else 1.0 for box, _ in crops]
+        scores, _ = score_crops(grays, sizes, confidences, [angle for _, angle in prepared])
+        for score, gray, (box, plate_img) in zip(scores, grays, crops):
+            if score >= self.min_quality:
+                self.candidates.append((float(score), gray, payload_for(box, plate_img)))
+        if self.candidates and self.opened_at is None:
+            self.opened_at = now
+        return len(crops)
+
+    def take(self, now):
+        """[(gray, payload)] of the best crops once the window has closed, best first"""
+        if self.opened_at is None or now - self.opened_at < self.window:
+            return []
+        best = sorted(self.candidates, key=lambda candidate: candidate[0], reverse=True)[:self.top_k]
+        self.clear()
+        return [(gray, payload) for _, gray, payload in best]
+
+    def clear(self):
+        """Forget the pending crops, e.g. once the vehicle has been decided"""
+        self.candidates = []
+        self.opened_at = None
+
+
+def score_files(paths):
+    """Score saved crops; without the detection their box confidence is taken as 1"""
+    grays, sizes, angles, names = [], [], [], []
+    for path in paths:
+        plate_img = cv2.imread(path)
+        if plate_img is None:
+            continue
+        gray, angle = prepare(plate_img)
+        grays.append(gray)
+        angles.append(angle)
+        sizes.append((plate_img.shape[1], plate_img.shape[0]))
+        names.append(os.path.basename(path))
+    scores, terms = score_crops(grays, sizes, np.ones(len(grays)), angles)
+    return names, scores, terms
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Score plate crops the way the lanes rank them before OCR")
+    parser.add_argument('paths', nargs='+', help="crop images, or directories of them")
+    parser.add_argument('--top', type=int, default=10, help="show this many of the best and the worst")
+    args = parser.parse_args()
+
+    files = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if name.lower().endswith(('.jpg', '.jpeg', '.png')))
+        else:
+            files.append(path)
+    names, scores, terms = score_files(files)
+    order = np.argsort(scores)[::-1]
+    print(f"{len(names)} crops, {np.sum(scores >= MIN_QUALITY)} at or above MIN_QUALITY {MIN_QUALITY}")
+    header = f"{'score':>6} " + ' '.join(f"{name:>10}" for name in WEIGHTS) + "  file"
+    for title, picked in (('Best', order[:args.top]), ('Worst', order[::-1][:args.top])):
+        print(f"\n{title}:\n{header}")
+        for i in picked:
+            print(f"{scores[i]:6.2f} " + ' '.join(f"{terms[name][i]:10.2f}" for name in WEIGHTS) + f"  {names[i]}")
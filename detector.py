@@ -0,0 +1,198 @@
+import os
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+import cv2
+import numpy as np
+from metrics import histogram
+from applog import get_logger
+
+log = get_logger('detector')
+
+MODEL_PATH = 'best.pt'
+MAX_BATCH = 4               # frames per YOLO call
+WARMUP_SIZE = 640           # square blank frame run once after loading, so the first car isn't the warm-up
+SERVICE_ADDRESS = ('127.0.0.1', 6001)   # detector_service.py
+SERVICE_KEY_ENV = 'ANPR_DETECTOR_AUTHKEY'   # shared secret for the service; else read from SERVICE_KEY_FILE
+SERVICE_KEY_FILE = 'detector.key'           # created by detector_service.py on first start
+SERVICE_TIMEOUT = 5.0       # seconds to wait for the service's answer before detecting locally
+
+DETECT_SECONDS = histogram('anpr_detect_seconds', "YOLO inference time per model call", ['batch'])
+
+
+def service_authkey(create=False):
+    """The detector service's authkey: SERVICE_KEY_ENV, else SERVICE_KEY_FILE.
+
+    With create, a missing key file is filled with a random key, readable by
+    its owner only. Returns None when there is no key.
+    """
+    key = os.environ.get(SERVICE_KEY_ENV)
+    if key:
+        return key.encode()
+    try:
+        with open(SERVICE_KEY_FILE, 'rb') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        if not create:
+            return None
+    key = os.urandom(32).hex().encode()
+    fd = os.open(SERVICE_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    log.info("[MODEL] Wrote a new detector service key to %s", SERVICE_KEY_FILE)
+    return key
+
+
+class SharedDetector:
+    """A single YOLO model shared by every lane and fed in batches.
+
+    ultralytics (and with it torch) is only imported when the model loads. With
+    background=True that happens on a thread, so cameras, gates and the DB come
+    up meanwhile; check ready before detecting, or detect() waits for it.
+    """
+
+    def __init__(self, model_path=MODEL_PATH, max_batch=MAX_BATCH, background=False):
+        self.model_path = model_path
+        self.max_batch = max_batch
+        self.model = None
+        self.error = None
+        self.loaded = threading.Event()
+        if background:
+            threading.Thread(target=self._load, name='model-load', daemon=True).start()
+        else:
+            self._load()
+            if self.error:
+                raise self.error
+
+    def _load(self):
+        try:
+            log.info("[MODEL] Loading %s", self.model_path)
+            from ultralytics import YOLO
+            model = YOLO(self.model_path)
+            model(np.zeros((WARMUP_SIZE, WARMUP_SIZE, 3), dtype=np.uint8), verbose=False)
+            self.model = model
+            log.info("[MODEL] %s ready", self.model_path)
+        except Exception as e:
+            log.exception("[ERROR] Could not load %s: %s", self.model_path, e)
+            self.error = e
+        finally:
+            self.loaded.set()
+
+    @property
+    def ready(self):
+        return self.model is not None
+
+    def detect(self, frames):
+        """Run detection on a list of frames, max_batch frames per model call"""
+        self.loaded.wait()
+        if self.model is None:
+            raise RuntimeError(f"Model {self.model_path} failed to load: {self.error}")
+        results = []
+        for i in range(0, len(frames), self.max_batch):
+            chunk = frames[i:i + self.max_batch]
+            with DETECT_SECONDS.time(batch=len(chunk)):
+                results.extend(self.model(chunk, verbose=False))
+        return results
+
+
+# ---------- warm detector service ----------
+def result_boxes(result):
+    """An ultralytics result as plain (x1, y1, x2, y2, conf, cls) rows"""
+    boxes = result.boxes
+    if boxes is None or len(boxes) == 0:
+        return np.zeros((0, 6), dtype=np.float32)
+    return np.hstack([boxes.xyxy.cpu().numpy(), boxes.conf.cpu().numpy()[:, None],
+                      boxes.cls.cpu().numpy()[:, None]]).astype(np.float32)
+
+
+class Box:
+    """One detection, with the attributes the lane code reads from ultralytics boxes"""
+
+    def __init__(self, row):
+        self.xyxy = row[None, :4]
+        self.conf = row[4:5]
+        self.cls = row[5:6]
+
+
+class Detections:
+    """Stand-in for an ultralytics result rebuilt from the service's rows"""
+
+    def __init__(self, frame, rows):
+        self.orig_img = frame
+        self.boxes = [Box(row) for row in rows]
+
+    def plot(self):
+        annotated = self.orig_img.copy()
+        for box in self.boxes:
+            x1, y1, x2, y2 = map(int, box.xyxy[0])
+            cv2.rectangle(annotated, (x1, y1), (x2, y2), (0, 255, 0), 2)
+            cv2.putText(annotated, f"{float(box.conf[0]):.2f}", (x1, max(y1 - 5, 0)),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
+        return annotated
+
+
+class RemoteDetector:
+    """Detects through detector_service.py's already loaded model.
+
+    If the service goes away, or takes longer than timeout to answer, the
+    detector loads its own model once and carries on locally, so a dead or hung
+    service costs one cold start instead of the gate.
+    """
+
+    def __init__(self, address=SERVICE_ADDRESS, authkey=None, timeout=SERVICE_TIMEOUT):
+        self.address = address
+        self.timeout = timeout
+        self.conn = Client(address, authkey=authkey or service_authkey())
+        self.local = None
+        self.conn.send(('ping',))
+        try:
+            self.info = self._recv()
+        except TimeoutError:
+            self.close()
+            raise
+
+    @property
+    def ready(self):
+        return True if self.local is None else self.local.ready
+
+    def detect(self, frames):
+        if self.local is None:
+            try:
+                self.conn.send(('detect', frames))
+                rows = self._recv()
+            except (OSError, EOFError) as e:
+                log.error("[ERROR] Detector service at %s lost (%s); loading the model locally", self.address, e)
+                self.close()
+                self.local = SharedDetector()
+            else:
+                if isinstance(rows, Exception):
+                    raise rows
+                return [Detections(frame, boxes) for frame, boxes in zip(frames, rows)]
+        return self.local.detect(frames)
+
+    def _recv(self):
+        if not self.conn.poll(self.timeout):
+            raise TimeoutError(f"no answer within {self.timeout:.1f}s")
+        return self.conn.recv()
+
+    def close(self):
+        try:
+            self.conn.close()
+        except OSError:
+            pass
+
+
+def attach_detector(address=SERVICE_ADDRESS, background=True):
+    """The warm detector service if it is running, else a model loaded in this process"""
+    authkey = service_authkey()
+    if authkey is None:
+        log.info("[MODEL] No detector service key (%s or %s); loading locally", SERVICE_KEY_ENV, SERVICE_KEY_FILE)
+        return SharedDetector(background=background)
+    try:
+        detector = RemoteDetector(address, authkey)
+    except (OSError, EOFError, AuthenticationError) as e:
+        log.info("[MODEL] No detector service at %s:%s (%s); loading locally",
+                 address[0], address[1], e.__class__.__name__)
+        return SharedDetector(background=background)
+    log.info("[MODEL] Attached to the detector service at %s:%s (%s)", address[0], address[1], detector.info['model'])
+    return detector
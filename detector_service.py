@@ -0,0 +1,87 @@
+"""Keeps the YOLO model loaded and warm for the gate scripts.
+
+    python detector_service.py                  # start once, before the lanes
+    python detector_service.py --model best.pt --port 6001
+
+Importing ultralytics and torch and loading best.pt is most of the time a gate
+script needs before it can see a plate. This process pays it once and stays up;
+car_entry, car_exit and lane_service attach to it on startup
+(detector.attach_detector()) and send frames over a local socket, so restarting
+them after a crash takes about as long as opening the camera. Without the
+service they load the model themselves, as before.
+
+Clients must present the authkey from ANPR_DETECTOR_AUTHKEY or, without it,
+detector.key, which the service creates with a random key on first start.
+Each client gets its own thread; calls into the model are serialized by one
+lock, and every call is a batch of at most --max-batch frames.
+"""
+import startup
+import argparse
+import threading
+from multiprocessing.connection import Listener
+from detector import SharedDetector, result_boxes, MODEL_PATH, MAX_BATCH, SERVICE_ADDRESS, service_authkey
+from applog import get_logger, setup as setup_logging
+
+log = get_logger('detector_service')
+
+
+class DetectorService:
+    def __init__(self, model_path=MODEL_PATH, max_batch=MAX_BATCH, address=SERVICE_ADDRESS, authkey=None):
+        self.detector = SharedDetector(model_path, max_batch=max_batch)
+        self.loaded_in = startup.mark('detector_ready')
+        self.lock = threading.Lock()
+        self.listener = Listener(address, authkey=authkey or service_authkey(create=True))
+        self.address = address
+
+    def serve_forever(self):
+        log.info("[SERVICE] Detector listening on %s:%s", self.address[0], self.address[1])
+        while True:
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError) as e:
+                log.warning("[SERVICE] Rejected a connection: %s", e)
+                continue
+            threading.Thread(target=self.handle, args=(conn,), name='detector-client', daemon=True).start()
+
+    def handle(self, conn):
+        log.info("[SERVICE] Client attached")
+        try:
+            while True:
+                message = conn.recv()
+                if message[0] == 'ping':
+                    conn.send({'model': self.detector.model_path, 'loaded_in': self.loaded_in})
+                elif message[0] == 'detect':
+                    try:
+                        with self.lock:
+                            results = self.detector.detect(message[1])
+                        conn.send([result_boxes(result) for result in results])
+                    except Exception as e:
+                        log.exception("[ERROR] Detection failed: %s", e)
+                        conn.send(RuntimeError(f"Detection failed in the service: {e}"))
+                else:
+                    conn.send(ValueError(f"Unknown request {message[0]!r}"))
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+            log.info("[SERVICE] Client detached")
+
+    def close(self):
+        self.listener.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve YOLO plate detection from an already loaded model")
+    parser.add_argument('--model', default=MODEL_PATH)
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH)
+    parser.add_argument('--port', type=int, default=SERVICE_ADDRESS[1])
+    args = parser.parse_args()
+
+    setup_logging('detector_service')
+    service = DetectorService(args.model, args.max_batch, (SERVICE_ADDRESS[0], args.port))
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        log.info("[SERVICE] Shutting down...")
+    finally:
+        service.close()
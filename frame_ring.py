@@ -0,0 +1,150 @@
+"""The last few seconds of a lane's camera in memory, written out as a clip on alerts.
+
+    ring = FrameRing()                          # one per lane
+    ring.push(frame, now)                       # every frame; kept at most RING_FPS times a second
+    ring.alert('denied_unpaid_RAF287E', now)    # a denied exit
+    for name, frames in ring.poll(now):         # CLIP_POST_SECONDS later
+        clips.write(name, frames)
+
+Nothing is recorded to disk until an alert: a clip holds CLIP_PRE_SECONDS
+before the alert and CLIP_POST_SECONDS after it. All memory is allocated once,
+on the first frame: RING_SECONDS * RING_FPS slots of either raw frames or, by
+default, JPEGs in fixed-size slots of JPEG_SLOT_BYTES. At 720p that is ~30 MB
+per lane encoded against ~400 MB raw; raw saves the encoding time where memory
+is plentiful or frames are small. ClipWriter encodes the MP4 on its own thread
+so the lane loop only pays for copying the frames out of the ring.
+"""
+import os
+import queue
+import threading
+import time
+import cv2
+import numpy as np
+from applog import get_logger
+
+log = get_logger('frame_ring')
+
+# Configuration
+RING_SECONDS = 15
+RING_FPS = 10
+RING_ENCODED = True         # JPEG slots; False keeps raw frames
+JPEG_QUALITY = 80
+JPEG_SLOT_BYTES = 200 * 1024
+CLIP_PRE_SECONDS = 10
+CLIP_POST_SECONDS = 3
+CLIP_DIR = 'clips'
+
+
+class FrameRing:
+    def __init__(self, seconds=RING_SECONDS, fps=RING_FPS, encoded=RING_ENCODED):
+        self.fps = fps
+        self.capacity = int(seconds * fps)
+        self.encoded = encoded
+        self.slots = None               # allocated on the first frame, when its shape is known
+        self.sizes = np.zeros(self.capacity, dtype=np.int64)
+        self.times = np.full(self.capacity, -np.inf)
+        self.head = 0                   # next slot to write
+        self.last_push = -np.inf
+        self.alerts = []                # (name, alert time)
+        self.dropped = 0                # frames whose JPEG did not fit a slot
+
+    def due(self, now):
+        """True when the next frame would be kept; lets a lane skip decoding the others"""
+        return now - self.last_push >= 1.0 / self.fps
+
+    def push(self, frame, now):
+        if not self.due(now):
+            return False
+        if self.slots is None:
+            shape = (self.capacity, JPEG_SLOT_BYTES) if self.encoded else (self.capacity,) + frame.shape
+            self.slots = np.empty(shape, dtype=np.uint8)
+        if self.encoded:
+            ok, data = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+            if not ok or data.size > JPEG_SLOT_BYTES:
+                self.dropped += 1
+                return False
+            self.slots[self.head, :data.size] = data.ravel()
+            self.sizes[self.head] = data.size
+        elif frame.shape == self.slots.shape[1:]:
+            self.slots[self.head] = frame
+        else:
+            self.dropped += 1
+            return False
+        self.times[self.head] = now
+        self.head = (self.head + 1) % self.capacity
+        self.last_push = now
+        return True
+
+    def snapshot(self, since, until):
+        """Copies of the frames kept between since and until, oldest first, as (time, frame)"""
+        order = np.roll(np.arange(self.capacity), -self.head)   # oldest slot first
+        frames = []
+        for i in order:
+            t = self.times[i]
+            if since <= t <= until:
+                if self.encoded:
+                    frames.append((t, self.slots[i, :self.sizes[i]].copy()))
+                else:
+                    frames.append((t, self.slots[i].copy()))
+        return frames
+
+    def alert(self, name, now):
+        """Schedule a clip around now; it is collected by poll() once the post-roll has passed"""
+        self.alerts.append((name, now))
+
+    def poll(self, now):
+        """(name, frames) for every alert whose clip is complete"""
+        ready = [(name, at) for name, at in self.alerts if now >= at + CLIP_POST_SECONDS]
+        if not ready:
+            return []
+        self.alerts = [alert for alert in self.alerts if alert not in ready]
+        return [(name, self.snapshot(at - CLIP_PRE_SECONDS, at + CLIP_POST_SECONDS)) for name, at in ready]
+
+
+class ClipWriter:
+    """Writes clips as MP4 files on a background thread"""
+
+    def __init__(self, clip_dir=CLIP_DIR, fps=RING_FPS):
+        self.clip_dir = clip_dir
+        self.fps = fps
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='clip-writer', daemon=True)
+        self.thread.start()
+
+    def write(self, name, frames):
+        if frames:
+            self.jobs.put((name, frames))
+        else:
+            log.warning("[CLIP] %s: no frames in the ring to save", name)
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            try:
+                self._write(*job)
+            except Exception as e:
+                log.exception("[ERROR] Could not write clip %s: %s", job[0], e)
+
+    def _write(self, name, frames):
+        os.makedirs(self.clip_dir, exist_ok=True)
+        path = os.path.join(self.clip_dir, f"{name}_{time.strftime('%Y%m%d_%H%M%S', time.localtime(frames[0][0]))}.mp4")
+        writer = None
+        try:
+            for _, frame in frames:
+                if frame.ndim == 1:     # a JPEG slot
+                    frame = cv2.imdecode(frame, cv2.IMREAD_COLOR)
+                if writer is None:
+                    height, width = frame.shape[:2]
+                    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), self.fps, (width, height))
+                writer.write(frame)
+        finally:
+            if writer is not None:
+                writer.release()
+        log.info("[CLIP] Saved %s (%d frames, %.1f s)", path, len(frames), frames[-1][0] - frames[0][0])
+
+    def close(self):
+        """Finish the queued clips"""
+        self.jobs.put(None)
+        self.thread.join()
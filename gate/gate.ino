@@ -10,6 +10,14 @@
 #define GND_PIN_2 8
 #define BUZZER_PIN 12
 
+// Serial link (keep BAUD_RATE in serial_link.py in step; 115200 also works)
+#define SERIAL_BAUD 9600
+#define FRAME_START 0xAA
+#define FRAME_TIMEOUT 50 // ms allowed between the bytes of one frame
+// 1 accepts bare single-character commands from hosts that predate the framed
+// protocol, until the first valid frame arrives; 0 accepts frames only
+#define ACCEPT_LEGACY 1
+
 // System State
 bool gateOpen = false;
 unsigned long lastBuzzTime = 0;
@@ -21,12 +29,21 @@ bool alertActive = false;
 unsigned long alertStartTime = 0;
 const unsigned long alertDuration = 4000; // 4 seconds alert duration
 
+// Command frame parser: 0xAA, seq, cmd, crc8(seq, cmd)
+byte frameBytes[3];
+byte frameLength = 0;
+bool inFrame = false;
+unsigned long frameStartTime = 0;
+int lastFrameSeq = -1;
+char lastFrameCmd = 0;
+bool framedHost = false; // set by the first frame with a good CRC
+
 Servo barrierServo;
 
 // ================== INITIALIZATION ==================
 void initializeSerial()
 {
-  Serial.begin(9600);
+  Serial.begin(SERIAL_BAUD);
   while (!Serial) {
     ; // Wait for serial port to connect
   }
@@ -92,16 +109,17 @@ void setGatePosition(int angle)
 }
 
 // ================== GATE CONTROL ==================
-void openGate()
+bool openGate()
 {
   if (alertActive)
-    return; // Prevent opening during alerts
+    return false; // Prevent opening during alerts
     
   setGatePosition(90);
   gateOpen = true;
   digitalWrite(BLUE_LED_PIN, HIGH);
   digitalWrite(RED_LED_PIN, LOW);
   Serial.println("[GATE] Opened");
+  return true;
 }
 
 void closeGate()
@@ -158,34 +176,105 @@ void sendDistanceReading()
 }
 
 // ================== COMMAND HANDLER ==================
+byte crc8(byte seq, byte cmd)
+{
+  byte data[2] = {seq, cmd};
+  byte crc = 0;
+  for (byte i = 0; i < 2; i++)
+  {
+    crc ^= data[i];
+    for (byte bit = 0; bit < 8; bit++)
+      crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : crc << 1;
+  }
+  return crc;
+}
+
+// Returns "OK" or the reason the command was refused
+const char *executeCommand(char cmd)
+{
+  switch (cmd)
+  {
+  case '1': // Open gate
+    return openGate() ? "OK" : "BLOCKED";
+  case '0': // Close gate
+    closeGate();
+    return "OK";
+  case '2': // Trigger alert
+    triggerAlert();
+    return "OK";
+  case '3': // Stop alert (manual override)
+    stopAlert();
+    return "OK";
+  case 'P': // Ping, used by the host to measure round trips
+    return "OK";
+  default:
+    return "UNKNOWN";
+  }
+}
+
+void reply(byte seq, const char *status)
+{
+  Serial.print(strcmp(status, "OK") == 0 ? "[ACK] " : "[NACK] ");
+  Serial.print(seq);
+  Serial.print(' ');
+  Serial.println(status);
+}
+
+void handleFrame()
+{
+  byte seq = frameBytes[0];
+  char cmd = frameBytes[1];
+  if (crc8(seq, cmd) != frameBytes[2])
+  {
+    reply(seq, "BAD_CRC");
+    return;
+  }
+  framedHost = true;
+  if (seq == lastFrameSeq && cmd == lastFrameCmd)
+  {
+    reply(seq, "OK"); // Retransmission of a frame already executed
+    return;
+  }
+  const char *status = executeCommand(cmd);
+  if (strcmp(status, "OK") == 0)
+  {
+    lastFrameSeq = seq;
+    lastFrameCmd = cmd;
+  }
+  reply(seq, status);
+}
+
 void handleSerialCommands()
 {
-  if (Serial.available())
+  // Drop a frame whose remaining bytes never arrived
+  if (inFrame && millis() - frameStartTime > FRAME_TIMEOUT)
+    inFrame = false;
+
+  // Consume every waiting byte so back-to-back commands are all handled
+  while (Serial.available())
   {
-    char cmd = Serial.read();
-    
-    // Clear any remaining characters in buffer
-    while (Serial.available()) {
-      Serial.read();
+    byte b = Serial.read();
+    if (inFrame)
+    {
+      frameBytes[frameLength++] = b;
+      if (frameLength == 3)
+      {
+        inFrame = false;
+        handleFrame();
+      }
     }
-    
-    switch (cmd)
+    else if (b == FRAME_START)
     {
-    case '1': // Open gate
-      openGate();
-      break;
-    case '0': // Close gate
-      closeGate();
-      break;
-    case '2': // Trigger alert
-      triggerAlert();
-      break;
-    case '3': // Stop alert (manual override)
-      stopAlert();
-      break;
-    default:
-      // Ignore unknown commands silently to avoid cluttering serial output
-      break;
+      inFrame = true;
+      frameLength = 0;
+      frameStartTime = millis();
+    }
+    else if (ACCEPT_LEGACY && !framedHost)
+    {
+      // Legacy single-character command, no reply beyond the status line.
+      // Once the host speaks frames, a stray byte is the remains of a frame
+      // whose start byte was lost (its seq or CRC) and is dropped.
+      executeCommand((char)b);
     }
   }
 }
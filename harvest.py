@@ -0,0 +1,230 @@
+"""Training-data harvesting from production recognitions.
+
+The lanes call RecognitionLog.record() once per decided vehicle. That queues
+the last full frame with its plate box for a background thread, which saves it
+and appends one JSON line (every read with its confidence, the decided plate
+and the gate outcome) to harvest/recognitions.jsonl. The lane loop pays for
+nothing but the queueing.
+
+The nightly batch job (python harvest.py) reads the new lines and picks the
+informative frames: low OCR confidence, disagreeing reads, and denied exits
+that a granted exit on the same lane corrected a few minutes later. It drops
+near-duplicates by perceptual hash and writes the frames with YOLO labels into
+images/cars, the mixed directory arrange_dataset.py splits from. The plate
+text goes into images/cars/ocr_labels.csv as OCR ground truth. Saved frames
+are deleted FRAME_RETENTION_DAYS after capture once a run has looked at them,
+and only the newest MAX_HASHES perceptual hashes are kept for the duplicate
+check.
+"""
+import argparse
+import csv
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+from datetime import datetime
+import cv2
+import numpy as np
+from plate_index import BKTree, levenshtein
+from applog import get_logger, setup as setup_logging
+
+log = get_logger('harvest')
+
+HARVEST_DIR = 'harvest'
+RECOGNITIONS_FILE = os.path.join(HARVEST_DIR, 'recognitions.jsonl')
+STATE_FILE = os.path.join(HARVEST_DIR, 'state.json')
+MIXED_DIR = 'images/cars'
+OCR_LABELS_FILE = 'ocr_labels.csv'
+
+LOW_CONFIDENCE = 70         # any read below this makes the vehicle informative
+CORRECTION_WINDOW = 600     # seconds in which a granted exit corrects an earlier denial
+DUPLICATE_DISTANCE = 6      # max Hamming distance between dHashes of near-identical frames
+FRAME_RETENTION_DAYS = 7    # harvested or passed-over frames are deleted after this long
+MAX_HASHES = 50000          # newest frame hashes kept for the duplicate check
+
+
+class RecognitionLog:
+    """Append-only record of decided vehicles, written by the lanes from a background thread"""
+
+    def __init__(self, harvest_dir=HARVEST_DIR):
+        self.frames_dir = os.path.join(harvest_dir, 'frames')
+        self.path = os.path.join(harvest_dir, 'recognitions.jsonl')
+        os.makedirs(self.frames_dir, exist_ok=True)
+        self.counter = 0
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='recognition-log', daemon=True)
+        self.thread.start()
+
+    def record(self, lane, direction, frame, box, reads, decided, outcome):
+        """Queue one decision; reads is a list of (plate, conf, variant). The frame must not be modified afterwards."""
+        self.counter += 1
+        stamp = time.strftime('%Y%m%d_%H%M%S')
+        entry = {
+            'time': time.time(),
+            'lane': lane,
+            'direction': direction,
+            'frame': f"{lane}_{stamp}_{self.counter}.jpg",
+            'frame_size': [int(frame.shape[1]), int(frame.shape[0])],
+            'box': [int(v) for v in box],
+            'reads': [{'plate': p, 'conf': round(float(c), 1), 'variant': v} for p, c, v in reads],
+            'decided': decided,
+            'outcome': outcome,
+        }
+        self.jobs.put((frame, entry))
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            frame, entry = job
+            try:
+                cv2.imwrite(os.path.join(self.frames_dir, entry['frame']), frame)
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+            except (OSError, ValueError, cv2.error) as e:
+                log.error("[HARVEST ERROR] Could not record %s: %s", entry['decided'], e)
+
+    def close(self):
+        """Write out the queued decisions"""
+        self.jobs.put(None)
+        self.thread.join()
+
+
+def dhash(image, size=8):
+    """64-bit difference hash of an image"""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def load_state():
+    if os.path.exists(STATE_FILE):
+        with open(STATE_FILE) as f:
+            return json.load(f)
+    return {'offset': 0, 'hashes': []}
+
+
+def read_new_records(offset):
+    """Records appended since the byte offset of the previous run"""
+    records = []
+    if not os.path.exists(RECOGNITIONS_FILE):
+        return records, offset
+    with open(RECOGNITIONS_FILE, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                break  # a lane is still writing this line; pick it up next run
+            offset += len(line)
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records, offset
+
+
+def select_informative(records):
+    """Return [(record, ground truth plate, reason)] worth labelling"""
+    selected = []
+    granted = [r for r in records if r['direction'] == 'exit' and r['outcome'] == 'granted']
+    for record in records:
+        reads = record['reads']
+        if record['direction'] == 'exit' and record['outcome'].startswith('denied'):
+            for later in granted:
+                if (later['lane'] == record['lane']
+                        and 0 < later['time'] - record['time'] <= CORRECTION_WINDOW
+                        and levenshtein(later['decided'], record['decided']) <= 1
+                        and later['decided'] != record['decided']):
+                    selected.append((record, later['decided'], 'corrected_denial'))
+                    break
+            continue
+        if len({r['plate'] for r in reads}) > 1:
+            selected.append((record, record['decided'], 'vote_disagreement'))
+        elif reads and min(r['conf'] for r in reads) < LOW_CONFIDENCE:
+            selected.append((record, record['decided'], 'low_confidence'))
+    return selected
+
+
+def expire_frames(frames_dir, days=FRAME_RETENTION_DAYS):
+    """Delete saved frames older than days; run after the harvest has read their records"""
+    if not os.path.isdir(frames_dir):
+        return 0
+    cutoff = time.time() - days * 86400
+    removed = 0
+    for name in os.listdir(frames_dir):
+        path = os.path.join(frames_dir, name)
+        if os.path.getmtime(path) < cutoff:
+            os.remove(path)
+            removed += 1
+    return removed
+
+
+def yolo_label(box, frame_size):
+    x1, y1, x2, y2 = box
+    width, height = frame_size
+    return (f"0 {(x1 + x2) / 2 / width:.6f} {(y1 + y2) / 2 / height:.6f} "
+            f"{(x2 - x1) / width:.6f} {(y2 - y1) / height:.6f}")
+
+
+def run_harvest(mixed_dir=MIXED_DIR, dry_run=False):
+    state = load_state()
+    records, offset = read_new_records(state['offset'])
+    selected = select_informative(records)
+    seen = BKTree(state['hashes'], distance=hamming)
+    frames_dir = os.path.join(HARVEST_DIR, 'frames')
+    os.makedirs(mixed_dir, exist_ok=True)
+
+    written = duplicates = 0
+    labels_path = os.path.join(mixed_dir, OCR_LABELS_FILE)
+    new_labels_file = not os.path.exists(labels_path)
+    with open(labels_path, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if new_labels_file:
+            writer.writerow(['Image', 'Plate Number', 'Box', 'Reason', 'Captured'])
+        for record, plate, reason in selected:
+            frame = cv2.imread(os.path.join(frames_dir, record['frame']))
+            if frame is None:
+                continue
+            frame_hash = dhash(frame)
+            if seen.search(frame_hash, DUPLICATE_DISTANCE):
+                duplicates += 1
+                continue
+            seen.add(frame_hash)
+            state['hashes'].append(frame_hash)
+            if dry_run:
+                written += 1
+                continue
+            image_name = f"harvest_{os.path.splitext(record['frame'])[0]}.jpg"
+            shutil.copy2(os.path.join(frames_dir, record['frame']), os.path.join(mixed_dir, image_name))
+            with open(os.path.join(mixed_dir, os.path.splitext(image_name)[0] + '.txt'), 'w') as lbl:
+                lbl.write(yolo_label(record['box'], record['frame_size']) + '\n')
+            captured = datetime.fromtimestamp(record['time']).strftime('%Y-%m-%d %H:%M:%S')
+            writer.writerow([image_name, plate, ' '.join(map(str, record['box'])), reason, captured])
+            written += 1
+
+    expired = 0
+    if not dry_run:
+        state['offset'] = offset
+        state['hashes'] = state['hashes'][-MAX_HASHES:]
+        with open(STATE_FILE, 'w') as f:
+            json.dump(state, f)
+        expired = expire_frames(frames_dir)
+    log.info("[HARVEST] %s new recognitions, %s informative, %s near-duplicates dropped, "
+             "%s added to %s, %s old frames deleted",
+             len(records), len(selected), duplicates, written, mixed_dir, expired)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Nightly harvest of informative production frames")
+    parser.add_argument('--mixed-dir', default=MIXED_DIR, help="where arrange_dataset.py picks images up")
+    parser.add_argument('--dry-run', action='store_true', help="only report what would be harvested")
+    args = parser.parse_args()
+    setup_logging('harvest')
+    run_harvest(args.mixed_dir, args.dry_run)
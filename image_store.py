@@ -0,0 +1,340 @@
+"""Content-addressed store for plate crops, indexed by plate and time.
+
+    store = ImageStore()
+    store.put(plate_img, 'RAF287E', lane='entry-1')        # array or JPEG bytes
+    for crop in store.find('RAF287E', day='2025-06-02'):
+        jpeg = store.get(crop['hash'])
+
+    python image_store.py find RAF287E --day 2025-06-02 --export evidence/
+    python image_store.py compact --every 3600      # keep packing, hourly
+    python image_store.py migrate plates            # copy the old loose JPEGs in (--delete to move)
+    python image_store.py stats
+
+A crop is stored once under the sha256 of its JPEG bytes; saving the same
+bytes again only adds an index row. New crops are loose files under
+objects/<2 hex>/<hash>.jpg. compact() packs them into append-only shard files
+(shards/NNNNNN.pack, up to SHARD_BYTES each) so the store is a few hundred
+large files instead of a file per crop. index.sqlite3 has where every blob
+lives and one row per sighting (hash, plate, time, lane), indexed on
+(plate, time) and time, so evidence lookups never list a directory.
+
+The index runs in WAL mode, so the lanes, a compaction and a lookup can use
+the store from different processes at once. A compaction batch appends its
+blobs to the shard and fsyncs it without touching the index, then takes the
+index write lock only to repoint them, so put() on a lane never waits behind
+the copying. Only then are the loose files deleted; a crash in between leaves
+unreferenced bytes in the shard, never a missing image. Compactions exclude
+each other through a lock held in compact.lock, a database of its own.
+"""
+import argparse
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+import cv2
+from applog import get_logger, setup as setup_logging
+
+log = get_logger('image_store')
+
+# Configuration
+STORE_DIR = 'image_store'
+SHARD_BYTES = 64 * 1024 * 1024
+COMPACT_BATCH = 500         # blobs packed per index transaction
+COMPACT_LOCK_TIMEOUT = 1    # seconds to wait for another compaction before giving up
+JPEG_QUALITY = 95
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Names of the files in plates/: <PLATE>_<YYYYmmdd>_<HHMMSS>.jpg from the lanes,
+# plate_<n>.jpg (or plate_<YYYYmmdd>_<n>.jpg) from the crop_plate_extract scripts
+NAMED_CROP = re.compile(r'^([A-Z0-9]+)_(\d{8}_\d{6})\.jpg$', re.IGNORECASE)
+NUMBERED_CROP = re.compile(r'^plate_(?:(\d{8})_)?\d+\.jpg$', re.IGNORECASE)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    shard INTEGER,                  -- NULL while the blob is a loose file
+    offset INTEGER
+);
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL REFERENCES blobs(hash),
+    plate TEXT,
+    taken_at TEXT NOT NULL,
+    lane TEXT,
+    source TEXT,
+    UNIQUE (hash, plate, taken_at)
+);
+CREATE INDEX IF NOT EXISTS idx_images_plate_time ON images (plate, taken_at);
+CREATE INDEX IF NOT EXISTS idx_images_time ON images (taken_at);
+CREATE INDEX IF NOT EXISTS idx_blobs_loose ON blobs (shard) WHERE shard IS NULL;
+'''
+
+
+class ImageStore:
+    def __init__(self, root=STORE_DIR):
+        self.root = root
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'shards'), exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(root, 'index.sqlite3'), timeout=30,
+                                  check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def loose_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], f"{digest}.jpg")
+
+    def shard_path(self, shard):
+        return os.path.join(self.root, 'shards', f"{shard:06d}.pack")
+
+    # ---------- writing ----------
+    def put(self, image, plate=None, taken_at=None, lane=None, source=None):
+        """Store a crop (BGR/gray array or encoded JPEG bytes) and index it; returns its hash"""
+        if isinstance(image, (bytes, bytearray)):
+            data = bytes(image)
+        else:
+            ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+            if not ok:
+                raise ValueError("could not encode image as JPEG")
+            data = encoded.tobytes()
+        digest = hashlib.sha256(data).hexdigest()
+        taken_at = taken_at or datetime.now()
+        with self.lock:
+            if self.db.execute('SELECT 1 FROM blobs WHERE hash = ?', (digest,)).fetchone() is None:
+                self.write_loose(digest, data)
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.execute('INSERT OR IGNORE INTO blobs (hash, size) VALUES (?, ?)', (digest, len(data)))
+                self.db.execute('INSERT OR IGNORE INTO images (hash, plate, taken_at, lane, source) VALUES (?, ?, ?, ?, ?)',
+                                (digest, plate, taken_at.strftime(TIME_FORMAT), lane, source))
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+        return digest
+
+    def write_loose(self, digest, data):
+        path = self.loose_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    # ---------- reading ----------
+    def get(self, digest):
+        """JPEG bytes of a blob, wherever it lives now"""
+        for attempt in range(2):
+            with self.lock:
+                row = self.db.execute('SELECT size, shard, offset FROM blobs WHERE hash = ?', (digest,)).fetchone()
+            if row is None:
+                raise KeyError(digest)
+            try:
+                if row['shard'] is None:
+                    with open(self.loose_path(digest), 'rb') as f:
+                        return f.read()
+                with open(self.shard_path(row['shard']), 'rb') as f:
+                    f.seek(row['offset'])
+                    return f.read(row['size'])
+            except FileNotFoundError:
+                if attempt:
+                    raise
+                # compacted between the lookup and the read; look again
+
+    def find(self, plate=None, day=None, since=None, until=None, limit=None):
+        """Index rows (hash, plate, taken_at, lane, source) in time order.
+
+        day is a date or 'YYYY-MM-DD' and sets since/until to that day;
+        since/until are datetimes or strings in TIME_FORMAT.
+        """
+        if day is not None:
+            start = day if isinstance(day, datetime) else datetime.strptime(str(day), '%Y-%m-%d')
+            since, until = start, start + timedelta(days=1)
+        conditions, params = [], []
+        if plate is not None:
+            conditions.append('plate = ?')
+            params.append(plate.upper())
+        if since is not None:
+            conditions.append('taken_at >= ?')
+            params.append(since.strftime(TIME_FORMAT) if isinstance(since, datetime) else since)
+        if until is not None:
+            conditions.append('taken_at < ?')
+            params.append(until.strftime(TIME_FORMAT) if isinstance(until, datetime) else until)
+        query = 'SELECT hash, plate, taken_at, lane, source FROM images'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY taken_at'
+        if limit:
+            query += f' LIMIT {int(limit)}'
+        with self.lock:
+            return [dict(row) for row in self.db.execute(query, params)]
+
+    def stats(self):
+        with self.lock:
+            images = self.db.execute('SELECT COUNT(*) FROM images').fetchone()[0]
+            blobs, size = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs').fetchone()
+            loose = self.db.execute('SELECT COUNT(*) FROM blobs WHERE shard IS NULL').fetchone()[0]
+        shards = len([name for name in os.listdir(os.path.join(self.root, 'shards')) if name.endswith('.pack')])
+        return {'images': images, 'blobs': blobs, 'bytes': size, 'loose': loose, 'shards': shards}
+
+    # ---------- compaction ----------
+    def current_shard(self):
+        """Number of the shard to append to, starting a new one once SHARD_BYTES is reached"""
+        numbers = [int(name[:-5]) for name in os.listdir(os.path.join(self.root, 'shards')) if name.endswith('.pack')]
+        if not numbers:
+            return 1
+        last = max(numbers)
+        return last if os.path.getsize(self.shard_path(last)) < SHARD_BYTES else last + 1
+
+    def compact(self, batch=COMPACT_BATCH):
+        """Pack loose blobs into shard files; returns how many were packed"""
+        guard = sqlite3.connect(os.path.join(self.root, 'compact.lock'), timeout=COMPACT_LOCK_TIMEOUT,
+                                isolation_level=None)
+        try:
+            guard.execute('BEGIN EXCLUSIVE')
+        except sqlite3.OperationalError:
+            guard.close()
+            log.info("[STORE] Another compaction is running; skipped")
+            return 0
+        packed = 0
+        try:
+            while True:
+                with self.lock:
+                    rows = self.db.execute('SELECT hash, size FROM blobs WHERE shard IS NULL LIMIT ?',
+                                           (batch,)).fetchall()
+                if not rows:
+                    break
+                moved = self.append_to_shard(rows)
+                if not moved:
+                    break
+                with self.lock:
+                    self.db.execute('BEGIN IMMEDIATE')
+                    try:
+                        self.db.executemany('UPDATE blobs SET shard = ?, offset = ? WHERE hash = ? AND shard IS NULL',
+                                            moved)
+                        self.db.execute('COMMIT')
+                    except Exception:
+                        self.db.execute('ROLLBACK')
+                        raise
+                for _, _, digest in moved:
+                    try:
+                        os.remove(self.loose_path(digest))
+                    except FileNotFoundError:
+                        pass
+                packed += len(moved)
+        finally:
+            guard.execute('ROLLBACK')
+            guard.close()
+        if packed:
+            log.info("[STORE] Compacted %s loose crops into shards", packed)
+        return packed
+
+    def append_to_shard(self, rows):
+        """Copy loose files onto the end of the current shard; (shard, offset, hash) per blob"""
+        moved = []
+        shard = self.current_shard()
+        f = open(self.shard_path(shard), 'ab')
+        try:
+            for row in rows:
+                if f.tell() >= SHARD_BYTES:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    f.close()
+                    shard += 1
+                    f = open(self.shard_path(shard), 'ab')
+                try:
+                    with open(self.loose_path(row['hash']), 'rb') as loose:
+                        data = loose.read()
+                except FileNotFoundError:
+                    log.warning("[STORE] Loose blob %s is missing; left unpacked", row['hash'])
+                    continue
+                moved.append((shard, f.tell(), row['hash']))
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        return moved
+
+    # ---------- migration ----------
+    def migrate(self, plates_dir='plates', keep=True):
+        """Copy the loose JPEGs of plates_dir into the store, deleting them unless keep; returns how many"""
+        count = 0
+        for entry in os.scandir(plates_dir):
+            if not entry.is_file() or not entry.name.lower().endswith('.jpg'):
+                continue
+            plate, taken_at = parse_crop_name(entry.name)
+            if taken_at is None:
+                taken_at = datetime.fromtimestamp(entry.stat().st_mtime)
+            with open(entry.path, 'rb') as f:
+                self.put(f.read(), plate, taken_at, source=entry.name)
+            if not keep:
+                os.remove(entry.path)
+            count += 1
+        log.info("[STORE] Migrated %s crops from %s", count, plates_dir)
+        return count
+
+    def close(self):
+        self.db.close()
+
+
+def parse_crop_name(name):
+    """(plate, time) from a plates/ file name; either may be None"""
+    match = NAMED_CROP.match(name)
+    if match and not match.group(1).lower() == 'plate':
+        return match.group(1).upper(), datetime.strptime(match.group(2), '%Y%m%d_%H%M%S')
+    match = NUMBERED_CROP.match(name)
+    if match and match.group(1):
+        return None, datetime.strptime(match.group(1), '%Y%m%d')
+    return None, None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Plate crop store: lookups, compaction and migration")
+    parser.add_argument('--store', default=STORE_DIR)
+    commands = parser.add_subparsers(dest='command', required=True)
+    find = commands.add_parser('find', help="list (and export) the crops of a plate")
+    find.add_argument('plate')
+    find.add_argument('--day', help="YYYY-MM-DD")
+    find.add_argument('--export', help="copy the crops into this directory")
+    compact = commands.add_parser('compact', help="pack loose crops into shard files")
+    compact.add_argument('--every', type=float, help="repeat every this many seconds")
+    migrate = commands.add_parser('migrate', help="copy a directory of loose crops into the store")
+    migrate.add_argument('plates_dir', nargs='?', default='plates')
+    migrate.add_argument('--delete', action='store_true',
+                         help="delete the originals once stored (benchmark_preprocess.py and crop_quality.py read plates/)")
+    commands.add_parser('stats')
+    args = parser.parse_args()
+
+    setup_logging('image_store', log_file=False)
+    store = ImageStore(args.store)
+    if args.command == 'find':
+        start = time.perf_counter()
+        crops = store.find(args.plate, day=args.day)
+        print(f"[STORE] {len(crops)} crops for {args.plate.upper()} in {(time.perf_counter() - start) * 1000:.1f} ms")
+        for crop in crops:
+            print(f"{crop['taken_at']}  {crop['lane'] or '-':<10}{crop['hash'][:16]}  {crop['source'] or ''}")
+            if args.export:
+                os.makedirs(args.export, exist_ok=True)
+                name = f"{crop['plate']}_{crop['taken_at'].replace(':', '').replace(' ', '_')}_{crop['hash'][:8]}.jpg"
+                with open(os.path.join(args.export, name), 'wb') as f:
+                    f.write(store.get(crop['hash']))
+    elif args.command == 'compact':
+        while True:
+            store.compact()
+            if not args.every:
+                break
+            time.sleep(args.every)
+    elif args.command == 'migrate':
+        store.migrate(args.plates_dir, keep=not args.delete)
+        store.compact()
+    else:
+        for name, value in store.stats().items():
+            print(f"{name:<8}{value}")
+    store.close()
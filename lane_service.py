@@ -0,0 +1,367 @@
+import startup
+import cv2
+import os
+import threading
+import time
+import csv
+from detector import attach_detector
+from plate_reader import PlateVote
+from crop_quality import CropSelector
+from ocr_pool import OcrPool, OCR_WORKERS
+from plate_index import OpenPlateIndex
+from harvest import RecognitionLog
+from image_store import ImageStore
+from frame_ring import FrameRing, ClipWriter
+from presence import CameraPresence, fuse, needs_camera
+from serial_link import GateLink, OPEN, CLOSE, ALERT
+from metrics import counter, gauge, histogram, start_http_server
+from web.db import (create_table_if_not_exists, log_plate_to_db, plate_exists_unpaid,
+                    is_payment_complete_db, update_exit_status_db, is_already_exited,
+                    log_unauthorized_exit, get_open_plates, plate_is_known)
+from applog import get_logger, setup as setup_logging
+
+log = get_logger('lane_service')
+
+# Configuration
+CSV_FILE = 'plates_log.csv'
+DISTANCE_THRESHOLD = 50     # cm
+GATE_OPEN_SECONDS = 15
+DECISION_PAUSE = 5          # seconds a lane ignores plates after a decision
+SHOW_WINDOWS = True
+METRICS_PORT = 9101         # /metrics for Prometheus, None to disable
+
+# One entry per lane: camera source (index, file or stream URL), serial device and direction
+LANES = [
+    {'name': 'entry-1', 'source': 0, 'serial_port': 'COM3', 'direction': 'entry'},
+    {'name': 'exit-1', 'source': 1, 'serial_port': 'COM4', 'direction': 'exit'},
+]
+
+FRAMES = counter('anpr_frames_total', "Camera frames grabbed", ['lane'])
+LOOP_SECONDS = histogram('anpr_loop_seconds', "One pass of the lane service loop over every camera")
+VOTE_READS = histogram('anpr_vote_reads', "Valid reads a plate vote took to reach a decision", ['lane'],
+                       buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15))
+DECISIONS = counter('anpr_decisions_total', "Plate decisions by outcome", ['lane', 'outcome'])
+CROPS = counter('anpr_crops_total', "Plate crops scored, and the ones of them sent to OCR", ['lane', 'stage'])
+GATE_OPEN_LATENCY = histogram('anpr_gate_open_seconds', "From the plate decision to the gate acknowledging OPEN",
+                              ['lane'])
+
+
+class Lane:
+    """Camera, gate Arduino and plate voting state for one entry or exit lane"""
+
+    def __init__(self, name, source, serial_port, direction, baud_rate=9600, open_plates=None, recognitions=None,
+                 images=None, clips=None):
+        if direction not in ('entry', 'exit'):
+            raise ValueError(f"Lane {name}: direction must be 'entry' or 'exit'")
+        self.name = name
+        self.direction = direction
+        self.open_plates = open_plates
+        self.recognitions = recognitions
+        self.images = images
+        self.clips = clips
+        # Only exits raise alerts, so only they keep the last seconds of video
+        self.ring = FrameRing() if clips is not None and direction == 'exit' else None
+        self.cap = cv2.VideoCapture(source)
+        if not self.cap.isOpened():
+            log.error("[ERROR] %s: could not open camera %s", name, source)
+        self.gate = GateLink.open(serial_port, baud_rate)
+        if serial_port and not self.gate:
+            log.error("[ERROR] %s: lane runs without sensor.", name)
+        self.presence = CameraPresence()
+        self.on_camera = False      # deciding presence from the camera while the sensor is silent
+        self.unacked = None         # last gate command still waiting for its ACK
+        self.vote = PlateVote()
+        self.crops = CropSelector()  # best crops of the vehicle in front of the camera
+        self.reads = []             # (plate, conf, variant) of the vehicle being voted on
+        self.last_sighting = None   # (frame, box) of its latest valid read
+        self.cooldown = 300 if direction == 'entry' else 60
+        self.last_plate = None
+        self.last_decision_time = 0
+        self.paused_until = 0
+        self.gate_close_at = None
+        self.opened_for = None      # decision time of the OPEN awaiting its ACK
+        self.epoch = 0
+
+    # ---------- sensors ----------
+    def grab(self):
+        """Grab the next frame without decoding it so all cameras are sampled together"""
+        grabbed = self.cap.grab()
+        if grabbed:
+            FRAMES.inc(lane=self.name)
+        return grabbed
+
+    def retrieve(self):
+        ret, frame = self.cap.retrieve()
+        return frame if ret else None
+
+    def read_distance(self):
+        """Median of the recent distances drained by the gate reader thread, None when the sensor is silent"""
+        distance = self.gate.median_distance() if self.gate else None
+        on_camera = needs_camera(distance)
+        if on_camera != self.on_camera:
+            self.on_camera = on_camera
+            if distance is None:
+                log.warning("[SENSOR] %s: no distance readings, detecting vehicles from the camera", self.name)
+            else:
+                log.info("[SENSOR] %s: distance readings back", self.name)
+        return distance
+
+    def wants_detection(self, now, distance):
+        return now >= self.paused_until and fuse(distance, self.presence.present(now), DISTANCE_THRESHOLD)
+
+    # ---------- gate ----------
+    def send(self, command, label):
+        if not self.gate:
+            return
+        pending = self.gate.send(command)
+        if pending:
+            log.info("[GATE] %s: %s (sent %r)", self.name, label, command)
+            self.unacked = pending
+
+    def open_gate(self, now):
+        """Open the gate and schedule the close instead of sleeping on the shared loop"""
+        self.send(OPEN, 'opening gate')
+        self.opened_for = now
+        self.gate_close_at = now + GATE_OPEN_SECONDS
+
+    def tick(self, now):
+        if self.ring is not None:
+            for name, frames in self.ring.poll(now):
+                self.clips.write(name, frames)
+        pending = self.unacked
+        if pending and pending.done:
+            if not pending.ok:
+                log.warning("[WARNING] %s: gate refused %r (%s)", self.name, pending.command, pending.status)
+            elif pending.command == OPEN and self.opened_for is not None:
+                GATE_OPEN_LATENCY.observe(pending.acked_at - self.opened_for, lane=self.name)
+            self.opened_for = None
+            self.unacked = None
+        if self.gate_close_at is not None and now >= self.gate_close_at:
+            self.send(CLOSE, 'closing gate')
+            self.gate_close_at = None
+
+    # ---------- decisions ----------
+    def process(self, frame, result, now):
+        """Score the plate crops in a detection result; submit_crops() sends the best to OCR"""
+        epoch = self.epoch
+        scored = self.crops.add(frame, result,
+                                lambda box, plate_img: (plate_img, epoch, frame, tuple(map(int, box.xyxy[0]))), now)
+        if scored:
+            CROPS.inc(scored, lane=self.name, stage='scored')
+
+    def submit_crops(self, now, ocr):
+        """Queue the best crops for OCR once the lane's selection window has closed"""
+        for gray, payload in self.crops.take(now):
+            if SHOW_WINDOWS:
+                cv2.imshow(f"{self.name} plate", gray)
+            if ocr.submit(self.name, gray, payload=payload, block=False) is None:
+                break
+            CROPS.inc(lane=self.name, stage='ocr')
+
+    def on_read(self, read, payload, now):
+        """Vote on an OCR result; reads queued before the last decision are dropped"""
+        plate_img, epoch, frame, box = payload
+        if epoch != self.epoch or now < self.paused_until:
+            return
+        plate, conf, variant, _ = read
+        if not plate:
+            return
+        log.info("[VALID] %s: plate detected %s (%s, conf %.0f)", self.name, plate, variant, conf)
+        if self.direction == 'entry' and self.images is not None:
+            self.images.put(plate_img, plate, lane=self.name)
+
+        self.reads.append((plate, conf, variant))
+        self.last_sighting = (frame, box)
+
+        decided = self.vote.add(plate, conf)
+        if decided:
+            VOTE_READS.observe(len(self.reads), lane=self.name)
+            self.epoch += 1
+            self.crops.clear()
+            if self.direction == 'entry':
+                outcome = self.handle_entry(decided, now)
+            else:
+                outcome = self.handle_exit(decided, now)
+            DECISIONS.inc(lane=self.name, outcome=outcome)
+            startup.mark('first_decision')
+            if self.recognitions is not None:
+                self.recognitions.record(self.name, self.direction, *self.last_sighting,
+                                         self.reads, decided, outcome)
+            self.reads = []
+
+    def handle_entry(self, plate, now):
+        if plate == self.last_plate and (now - self.last_decision_time) <= self.cooldown:
+            log.info("[SKIPPED] %s: duplicate %s within cooldown window.", self.name, plate)
+            return 'skipped'
+        if plate_exists_unpaid(plate):
+            log.info("[INFO] %s: duplicate entry blocked for %s.", self.name, plate)
+            self.paused_until = now + DECISION_PAUSE
+            return 'blocked'
+        append_csv(plate, 0)
+        log_plate_to_db(plate, payment_status=0, gate="entry")
+        self.open_gate(now)
+        self.last_plate = plate
+        self.last_decision_time = now
+        self.paused_until = now + DECISION_PAUSE
+        return 'entered'
+
+    def handle_exit(self, plate, now):
+        if self.open_plates is not None:
+            matched, candidates = self.open_plates.match(plate)
+            if matched is None and len(candidates) > 1:
+                options = ', '.join(p for _, p in candidates)
+                log.warning("[AMBIGUOUS] %s: %s could be %s, reading again", self.name, plate, options)
+                return 'ambiguous'
+            if matched and matched != plate:
+                log.info("[MATCHED] %s: read %s resolved to open session %s", self.name, plate, matched)
+                plate = matched
+        if plate == self.last_plate and (now - self.last_decision_time) < self.cooldown:
+            log.info("[SKIPPED] %s: %s recently exited, cooldown active", self.name, plate)
+            return 'skipped'
+        if is_payment_complete_db(plate):
+            log.info("[ACCESS GRANTED] %s: payment complete for %s", self.name, plate)
+            update_exit_status_db(plate)
+            append_csv(plate, 2)
+            self.open_gate(now)
+            self.last_plate = plate
+            self.last_decision_time = now
+            outcome = 'granted'
+        elif is_already_exited(plate):
+            log.warning("[ACCESS DENIED] %s: car with plate %s can't exit twice", self.name, plate)
+            self.send(ALERT, 'alerting unauthorised exit')
+            outcome = 'denied_exited'
+        else:
+            log.warning("[ACCESS DENIED] %s: payment NOT complete for %s", self.name, plate)
+            log_unauthorized_exit(plate)
+            self.send(ALERT, 'alerting unauthorised exit')
+            outcome = 'denied_unpaid'
+        if outcome.startswith('denied') and self.ring is not None:
+            self.ring.alert(f"{self.name}_{outcome}_{plate}", now)
+        self.paused_until = now + DECISION_PAUSE
+        return outcome
+
+    def close(self):
+        self.cap.release()
+        if self.gate:
+            self.gate.close()
+
+
+def append_csv(plate, status):
+    with open(CSV_FILE, 'a', newline='') as f:
+        csv.writer(f).writerow([plate, status, time.strftime('%Y-%m-%d %H:%M:%S')])
+
+
+class LaneService:
+    """Runs every configured lane in one process around a single shared detector.
+
+    Each loop grabs one frame from every camera, then batches the frames of lanes
+    that have a vehicle in front of them into one YOLO call. A lane contributes at
+    most one frame per batch and the lane order rotates every loop, so a busy lane
+    cannot starve the others of detector or OCR time. Crops are OCR'd by a
+    process pool; while its slots are all in flight no new frames are detected.
+
+    Startup is arranged around the model: it is attached from the detector
+    service or loaded on a thread (attach_detector()), and the DB check runs on
+    another while cameras, gates and OCR workers open. Lanes tick their gates
+    and show video from the first loop and start detecting once the model is
+    ready.
+    """
+
+    def __init__(self, lanes=LANES, ocr_workers=OCR_WORKERS):
+        schema = threading.Thread(target=create_table_if_not_exists, name='schema', daemon=True)
+        schema.start()
+        if not os.path.exists(CSV_FILE):
+            with open(CSV_FILE, 'w', newline='') as f:
+                csv.writer(f).writerow(['Plate Number', 'Payment Status', 'Timestamp'])
+        self.detector = attach_detector()
+        self.open_plates = OpenPlateIndex(get_open_plates, is_known=plate_is_known)
+        self.recognitions = RecognitionLog()
+        self.images = ImageStore()
+        self.clips = ClipWriter()
+        self.lanes = [Lane(**cfg, open_plates=self.open_plates, recognitions=self.recognitions, images=self.images,
+                           clips=self.clips)
+                      for cfg in lanes]
+        self.lanes_by_name = {lane.name: lane for lane in self.lanes}
+        self.ocr = OcrPool(workers=ocr_workers)
+        self.next_lane = 0
+        gauge('anpr_ocr_slots_busy', "OCR slots holding a crop in flight", function=self.ocr.pending)
+        if METRICS_PORT:
+            start_http_server(METRICS_PORT)
+        schema.join()
+        startup.mark('lanes_open')
+
+    def schedule(self):
+        """Lanes in round-robin order, starting one lane later on every call"""
+        order = self.lanes[self.next_lane:] + self.lanes[:self.next_lane]
+        self.next_lane = (self.next_lane + 1) % len(self.lanes)
+        return order
+
+    def step(self):
+        now = time.time()
+        order = self.schedule()
+        grabbed = [lane for lane in order if lane.grab()]
+
+        for track, seq, read, payload in self.ocr.poll():
+            self.lanes_by_name[track].on_read(read, payload, now)
+
+        detector_ready = self.detector.ready
+        if detector_ready:
+            startup.mark('detector_ready')
+        has_capacity = detector_ready and self.ocr.has_capacity()
+        batch = []
+        for lane in grabbed:
+            lane.tick(now)
+            distance = lane.read_distance()
+            looks = needs_camera(distance) and lane.presence.due(now)
+            records = lane.ring is not None and lane.ring.due(now)
+            wants = has_capacity and lane.wants_detection(now, distance)
+            if not wants and not looks and not records and not SHOW_WINDOWS:
+                continue
+            frame = lane.retrieve()
+            if frame is None:
+                continue
+            if looks:
+                lane.presence.update(frame, now)
+                wants = has_capacity and lane.wants_detection(now, distance)
+            if records:
+                lane.ring.push(frame, now)
+            if wants:
+                batch.append((lane, frame))
+            elif SHOW_WINDOWS:
+                cv2.imshow(f"{lane.name} feed", frame)
+
+        if batch:
+            results = self.detector.detect([frame for _, frame in batch])
+            for (lane, frame), result in zip(batch, results):
+                lane.process(frame, result, now)
+                if SHOW_WINDOWS:
+                    cv2.imshow(f"{lane.name} feed", result.plot())
+        for lane in order:
+            lane.submit_crops(now, self.ocr)
+
+    def run(self):
+        log.info("[SYSTEM] %s lanes ready. Press 'q' to exit.", len(self.lanes))
+        try:
+            while True:
+                with LOOP_SECONDS.time():
+                    self.step()
+                if SHOW_WINDOWS and cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
+        except KeyboardInterrupt:
+            log.info("[SYSTEM] Shutting down...")
+        finally:
+            for lane in self.lanes:
+                if lane.ring is not None:
+                    for name, frames in lane.ring.poll(float('inf')):
+                        self.clips.write(name, frames)
+                lane.close()
+            self.clips.close()
+            self.recognitions.close()
+            self.ocr.close()
+            cv2.destroyAllWindows()
+            log.info("[SYSTEM] Lane service shutdown complete.")
+
+
+if __name__ == "__main__":
+    setup_logging('lane_service')
+    LaneService().run()
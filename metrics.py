@@ -0,0 +1,280 @@
+"""Counters, gauges and histograms exposed in the Prometheus text format.
+
+    from metrics import counter, histogram
+    FRAMES = counter('anpr_frames_total', "Frames grabbed", ['lane'])
+    FRAMES.inc(lane='entry-1')
+    with DETECT_SECONDS.time():
+        ...
+
+Recording never takes a lock: every thread updates its own cell of each
+metric, and only the scrape (render()) walks the cells and sums them, so the
+instrumentation can stay on in production. Cells of threads that have ended
+are folded together at the next scrape. Values are per process; the lane
+service and the payment service serve theirs with start_http_server(), the
+dashboard on its /metrics route. Under gunicorn every worker counts for
+itself, so a scrape sees the worker that answered it; run one worker with more
+threads (serve.py --workers 1) where exact totals matter.
+"""
+import bisect
+import functools
+import inspect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from applog import get_logger
+
+log = get_logger('metrics')
+
+# Seconds; wide enough for a serial ACK (ms) and a slow DB query or YOLO batch (s)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._cells = []            # (thread, cell) for every thread that recorded
+        self._retired = {}
+        self._cells_lock = threading.Lock()
+
+    def _cell(self):
+        """This thread's {label values: value}, registered on first use"""
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = self._local.cell = {}
+            with self._cells_lock:
+                self._cells.append((threading.current_thread(), cell))
+            return cell
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _totals(self):
+        """Merge every thread's cell; cells of finished threads are folded in for good"""
+        with self._cells_lock:
+            live = []
+            for thread, cell in self._cells:
+                if thread.is_alive():
+                    live.append((thread, cell))
+                else:
+                    self._merge(self._retired, cell)
+            self._cells = live
+            totals = {}
+            self._merge(totals, self._retired)
+        for _, cell in live:
+            self._merge(totals, cell.copy())
+        return totals
+
+    def _merge(self, into, cell):
+        raise NotImplementedError
+
+    def _labels(self, key, extra=''):
+        pairs = [f'{name}="{escape(value)}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def samples(self):
+        return []
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        cell = self._cell()
+        key = self._key(labels)
+        cell[key] = cell.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._totals().get(self._key(labels), 0)
+
+    def _merge(self, into, cell):
+        for key, value in cell.items():
+            into[key] = into.get(key, 0) + value
+
+    def samples(self):
+        return [f"{self.name}{self._labels(key)} {number(value)}" for key, value in sorted(self._totals().items())]
+
+
+class Gauge(Metric):
+    """A value that is set, or read from function at scrape time"""
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), function=None):
+        super().__init__(name, help_text, labelnames)
+        self.values = {}
+        self.function = function
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                return [f"{self.name} {number(self.function())}"]
+            except Exception:
+                return []
+        return [f"{self.name}{self._labels(key)} {number(value)}" for key, value in sorted(self.values.copy().items())]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        cell = self._cell()
+        key = self._key(labels)
+        counts = cell.get(key)
+        if counts is None:
+            # one count per bucket, one for +Inf, then the running sum
+            counts = cell[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def time(self, **labels):
+        """Context manager observing the duration of its block"""
+        return Timer(self, labels)
+
+    def _merge(self, into, cell):
+        for key, counts in cell.items():
+            total = into.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, value in enumerate(list(counts)):
+                total[i] += value
+
+    def samples(self):
+        lines = []
+        for key, counts in sorted(self._totals().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts[:-1]):
+                cumulative += count
+                le = 'le="%s"' % (bound if bound == '+Inf' else number(bound))
+                lines.append(f"{self.name}_bucket{self._labels(key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {number(counts[-1])}")
+            lines.append(f"{self.name}_count{self._labels(key)} {cumulative}")
+        return lines
+
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+def _register(cls, name, *args, **kwargs):
+    with _registry_lock:
+        if name not in _registry:
+            _registry[name] = cls(name, *args, **kwargs)
+        return _registry[name]
+
+
+def counter(name, help_text, labelnames=()):
+    return _register(Counter, name, help_text, labelnames)
+
+
+def gauge(name, help_text, labelnames=(), function=None):
+    return _register(Gauge, name, help_text, labelnames, function=function)
+
+
+def histogram(name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+    return _register(Histogram, name, help_text, labelnames, buckets=buckets)
+
+
+def time_function(histogram, label='function'):
+    """Decorator observing every call under label=<function name>.
+
+    Generator functions are timed until the generator is exhausted or closed.
+    """
+    def decorator(func):
+        labels = {label: func.__name__}
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                with Timer(histogram, labels):
+                    yield from func(*args, **kwargs)
+            return generator_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Timer(histogram, labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def number(value):
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def render():
+    """Every registered metric in the Prometheus text exposition format"""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        samples = metric.samples()
+        if not samples:
+            continue
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_http_server(port, host='0.0.0.0'):
+    """Serve /metrics from a daemon thread, for processes without a web app"""
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        log.warning("[METRICS] Could not listen on %s:%s: %s", host, port, e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    log.info("[METRICS] Serving http://%s:%s/metrics", host, port)
+    return server
@@ -0,0 +1,234 @@
+import os
+import multiprocessing as mp
+import time
+from collections import defaultdict
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+import cv2
+import numpy as np
+from plate_reader import read_plate
+from metrics import counter, histogram
+from applog import get_logger
+
+log = get_logger('ocr_pool')
+
+# Configuration
+OCR_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+SLOTS_PER_WORKER = 3           # crops that may be queued per worker before submit() pushes back
+SLOT_SHAPE = (64, 512)         # largest normalized crop (h, w); bigger crops are scaled down
+CHECK_WORKERS_EVERY = 1.0      # seconds between liveness checks of the workers
+TASK_DEADLINE = 10.0           # seconds a worker may hold a crop before it is taken for hung
+
+OCR_SECONDS = histogram('anpr_ocr_seconds', "read_plate() time in an OCR worker")
+OCR_TURNAROUND_SECONDS = histogram('anpr_ocr_turnaround_seconds', "Time from submit() to the result being collected")
+OCR_REJECTED = counter('anpr_ocr_rejected_total', "Crops not queued because every OCR slot was busy")
+OCR_WORKER_RESTARTS = counter('anpr_ocr_worker_restarts_total', "OCR workers found dead or stuck and replaced")
+OCR_LOST = counter('anpr_ocr_lost_total', "Crops given up on because their worker was replaced")
+
+
+def _ocr_worker(shm_name, n_slots, slot_shape, conn):
+    """Worker process: read plates straight out of the shared memory slots"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    slots = np.ndarray((n_slots,) + slot_shape, dtype=np.uint8, buffer=shm.buf)
+    try:
+        while True:
+            try:
+                task = conn.recv()
+            except EOFError:
+                break
+            if task is None:
+                break
+            slot, h, w, track, seq = task
+            start = time.perf_counter()
+            try:
+                read = read_plate(np.ascontiguousarray(slots[slot, :h, :w]))
+            except Exception as e:
+                log.error("[OCR ERROR] %s#%s: %s", track, seq, e)
+                read = (None, 0.0, None, '')
+            conn.send((slot, track, seq, read, time.perf_counter() - start))
+    finally:
+        del slots
+        shm.close()
+
+
+class OcrWorker:
+    """One OCR process and the pipe it takes tasks from and answers on"""
+
+    def __init__(self, shm_name, n_slots, slot_shape):
+        self.conn, child = mp.Pipe()
+        self.process = mp.Process(target=_ocr_worker, args=(shm_name, n_slots, slot_shape, child), daemon=True)
+        self.process.start()
+        child.close()
+        self.slots = set()          # slots this worker is reading
+
+
+class OcrPool:
+    """Pool of OCR worker processes fed through a fixed set of shared memory slots.
+
+    Crops are copied once into a free slot and only the slot number travels
+    to a worker, so no image is ever pickled. When every slot is in flight
+    submit() blocks (or returns None with block=False), which is the
+    back-pressure signal for the recognition pipeline. Results are released per
+    track strictly in submission order.
+
+    Every worker has its own pipe, so the pool knows which slots each one
+    holds. A worker that dies (tesseract crashing, the OOM killer) or holds a
+    crop longer than TASK_DEADLINE is replaced; its crops get an empty read and
+    their slots are reused.
+    """
+
+    def __init__(self, workers=OCR_WORKERS, slots_per_worker=SLOTS_PER_WORKER, slot_shape=SLOT_SHAPE):
+        self.slot_shape = tuple(slot_shape)
+        self.n_slots = workers * slots_per_worker
+        self.shm = shared_memory.SharedMemory(create=True, size=self.n_slots * self.slot_shape[0] * self.slot_shape[1])
+        self.slots = np.ndarray((self.n_slots,) + self.slot_shape, dtype=np.uint8, buffer=self.shm.buf)
+        self.free = list(range(self.n_slots))
+        self.next_seq = defaultdict(int)      # next sequence number handed out per track
+        self.next_out = defaultdict(int)      # next sequence number released per track
+        self.finished = defaultdict(dict)     # track -> {seq: read} waiting for earlier reads
+        self.payloads = {}
+        self.submitted = {}                   # (track, seq) -> perf_counter() at submit
+        self.in_flight = {}                   # slot -> (track, seq) being read in it
+        self.workers = [self._start_worker() for _ in range(workers)]
+        self.checked_at = time.perf_counter()
+        log.info("[OCR] Started %s OCR workers with %s shared slots", workers, self.n_slots)
+
+    def _start_worker(self):
+        return OcrWorker(self.shm.name, self.n_slots, self.slot_shape)
+
+    def _replace(self, i, reason):
+        """Swap a dead or stuck worker for a new one and give up on the crops it held"""
+        worker = self.workers[i]
+        log.error("[OCR ERROR] Worker %d %s, starting a new one (%d crops lost)",
+                  worker.process.pid, reason, len(worker.slots))
+        OCR_WORKER_RESTARTS.inc()
+        if worker.process.is_alive():
+            worker.process.terminate()
+        worker.process.join(timeout=1)
+        worker.conn.close()
+        for slot in worker.slots:
+            OCR_LOST.inc()
+            self._finish(slot, (None, 0.0, None, ''))
+        self.workers[i] = self._start_worker()
+
+    def _check_workers(self, now):
+        self.checked_at = now
+        for i, worker in enumerate(self.workers):
+            if not worker.process.is_alive():
+                self._replace(i, f"died (exit code {worker.process.exitcode})")
+            elif any(now - self.submitted[self.in_flight[slot]] > TASK_DEADLINE for slot in worker.slots):
+                self._replace(i, f"held a crop for more than {TASK_DEADLINE:.0f} s")
+
+    def _finish(self, slot, read):
+        track, seq = self.in_flight.pop(slot)
+        OCR_TURNAROUND_SECONDS.observe(time.perf_counter() - self.submitted.pop((track, seq)))
+        self.free.append(slot)
+        self.finished[track][seq] = read
+
+    def has_capacity(self):
+        self._collect(timeout=0)
+        return bool(self.free)
+
+    def pending(self):
+        return self.n_slots - len(self.free)
+
+    def submit(self, track, image, payload=None, block=True, timeout=None):
+        """Queue a normalized grayscale crop for OCR, returns its sequence number or None when full"""
+        if not self.free:
+            self._collect(timeout=timeout if block else 0, until_free=True)
+            if not self.free:
+                OCR_REJECTED.inc()
+                return None
+        slot = self.free.pop()
+        h, w = self._fit(image, slot)
+        seq = self.next_seq[track]
+        self.next_seq[track] += 1
+        self.payloads[(track, seq)] = payload
+        self.submitted[(track, seq)] = time.perf_counter()
+        self.in_flight[slot] = (track, seq)
+        while True:
+            i = min(range(len(self.workers)), key=lambda i: len(self.workers[i].slots))
+            try:
+                self.workers[i].conn.send((slot, h, w, track, seq))
+            except OSError:
+                self._replace(i, "stopped taking work")
+                continue
+            self.workers[i].slots.add(slot)
+            return seq
+
+    def _fit(self, image, slot):
+        max_h, max_w = self.slot_shape
+        h, w = image.shape[:2]
+        if h > max_h or w > max_w:
+            scale = min(max_h / h, max_w / w)
+            image = cv2.resize(image, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+            h, w = image.shape[:2]
+        self.slots[slot, :h, :w] = image
+        return h, w
+
+    def _collect(self, timeout=0, until_free=False):
+        """Move finished results out of the worker pipes and free their slots.
+
+        Waits up to timeout (forever for None) for the first result, or with
+        until_free for a free slot; workers are checked at least every
+        CHECK_WORKERS_EVERY while waiting.
+        """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            now = time.perf_counter()
+            if now - self.checked_at >= CHECK_WORKERS_EVERY:
+                self._check_workers(now)
+            if until_free and self.free:
+                return
+            wait_for = CHECK_WORKERS_EVERY if deadline is None else min(max(0, deadline - now), CHECK_WORKERS_EVERY)
+            ready = wait([worker.conn for worker in self.workers], timeout=wait_for)
+            collected = False
+            for i, worker in enumerate(self.workers):
+                if worker.conn not in ready:
+                    continue
+                try:
+                    while worker.conn.poll():
+                        slot, track, seq, read, seconds = worker.conn.recv()
+                        worker.slots.discard(slot)
+                        OCR_SECONDS.observe(seconds)
+                        self._finish(slot, read)
+                        collected = True
+                except (EOFError, OSError):
+                    self._replace(i, "closed its pipe")
+            if until_free:
+                if self.free:
+                    return
+            elif collected:
+                return
+            if deadline is not None and time.perf_counter() >= deadline:
+                return
+
+    def poll(self, timeout=0):
+        """Return [(track, seq, read, payload)] ready to be consumed, in order per track.
+
+        read is the (plate, confidence, variant, raw text) tuple from read_plate().
+        """
+        self._collect(timeout=timeout)
+        ready = []
+        for track, done in self.finished.items():
+            seq = self.next_out[track]
+            while seq in done:
+                ready.append((track, seq, done.pop(seq), self.payloads.pop((track, seq))))
+                seq += 1
+            self.next_out[track] = seq
+        return ready
+
+    def close(self):
+        for worker in self.workers:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+        for worker in self.workers:
+            worker.process.join(timeout=2)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.conn.close()
+        del self.slots
+        self.shm.close()
+        self.shm.unlink()
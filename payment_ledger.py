@@ -0,0 +1,136 @@
+"""Local, durable record of every card payment.
+
+The card is debited by the kiosk before the database hears about it, so a
+failed DB write used to lose the payment. Each payment now gets a transaction
+id and moves through states appended to payments/ledger.jsonl, one fsync'd
+line per step:
+
+    intent     amount, plate and session chosen, before the amount is sent
+    debited    the reader answered DONE (money has left the card)
+    committed  parking_sessions updated
+    aborted    the reader refused or failed, nothing was taken
+
+A transaction whose last state is 'debited' is a payment the database still
+owes. reconcile() replays those with mark_session_paid(), which is idempotent.
+An 'intent' that never got an answer is in doubt (the reader may or may not
+have written the card) and is only reported, for a look at the card:
+
+    python payment_ledger.py            # replay debited payments
+    python payment_ledger.py --report   # list open transactions only
+"""
+import argparse
+import json
+import os
+import threading
+import time
+import uuid
+from applog import get_logger, setup as setup_logging
+
+log = get_logger('payment_ledger')
+
+LEDGER_FILE = os.path.join('payments', 'ledger.jsonl')
+IN_DOUBT_AFTER = 60         # seconds before an unanswered intent is reported
+
+
+class PaymentLedger:
+    """Append-only JSONL ledger; every append is fsync'd before it returns"""
+
+    def __init__(self, path=LEDGER_FILE):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.lock = threading.Lock()
+        self.file = open(path, 'a')
+
+    def append(self, txid, state, **fields):
+        entry = {'txid': txid, 'state': state, 'time': time.time(), **fields}
+        with self.lock:
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        return entry
+
+    def begin(self, kiosk, plate, session_id, amount):
+        """Record the intent to charge and return its transaction id"""
+        txid = uuid.uuid4().hex[:12]
+        self.append(txid, 'intent', kiosk=kiosk, plate=plate, session_id=session_id, amount=amount)
+        return txid
+
+    def debited(self, txid, amount, new_balance):
+        self.append(txid, 'debited', amount=amount, new_balance=new_balance)
+
+    def committed(self, txid, replayed=False):
+        self.append(txid, 'committed', replayed=replayed)
+
+    def aborted(self, txid, reason):
+        self.append(txid, 'aborted', reason=reason)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def load_transactions(path=LEDGER_FILE):
+    """Fold the ledger into {txid: merged fields}, the 'state' being the latest one"""
+    transactions = {}
+    if not os.path.exists(path):
+        return transactions
+    with open(path) as f:
+        for line in f:
+            if not line.endswith('\n'):
+                break  # torn last write; its step never completed
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            tx = transactions.setdefault(entry['txid'], {'started': entry['time']})
+            tx.update(entry)
+    return transactions
+
+
+def open_transactions(path=LEDGER_FILE, now=None):
+    """Return (debited but not committed, in-doubt intents)"""
+    now = now or time.time()
+    debited, in_doubt = [], []
+    for tx in load_transactions(path).values():
+        if tx['state'] == 'debited':
+            debited.append(tx)
+        elif tx['state'] == 'intent' and now - tx['started'] > IN_DOUBT_AFTER:
+            in_doubt.append(tx)
+    return debited, in_doubt
+
+
+def reconcile(ledger, mark_paid=None):
+    """Replay every debited payment against parking_sessions; returns how many were committed"""
+    if mark_paid is None:
+        from web.db import mark_session_paid as mark_paid
+    debited, in_doubt = open_transactions(ledger.path)
+    replayed = 0
+    for tx in debited:
+        if mark_paid(tx['session_id'], tx['amount']):
+            ledger.committed(tx['txid'], replayed=True)
+            replayed += 1
+            log.info("[LEDGER] Replayed %s: %s paid %.2f RWF", tx['txid'], tx['plate'], tx['amount'])
+        else:
+            log.warning("[LEDGER] %s for %s still not in the database, will retry", tx['txid'], tx['plate'])
+    for tx in in_doubt:
+        log.warning("[LEDGER] In doubt: %s %s %.2f RWF on %s, no answer from the reader; check the card balance",
+                    tx['txid'], tx['plate'], tx['amount'], tx['kiosk'])
+    return replayed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconcile the local payment ledger with parking_sessions")
+    parser.add_argument('--ledger', default=LEDGER_FILE)
+    parser.add_argument('--report', action='store_true', help="only list open transactions")
+    args = parser.parse_args()
+    setup_logging('payment_ledger')
+
+    if args.report:
+        debited, in_doubt = open_transactions(args.ledger)
+        print(f"[LEDGER] {len(debited)} debited but not committed, {len(in_doubt)} in doubt")
+        for tx in debited + in_doubt:
+            print(f"  {tx['txid']}  {tx['state']:<8} {tx['plate']}  session {tx['session_id']}  {tx['amount']:.2f} RWF")
+    else:
+        ledger = PaymentLedger(args.ledger)
+        print(f"[LEDGER] {reconcile(ledger)} payment(s) replayed")
+        ledger.close()
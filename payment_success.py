@@ -1,11 +1,14 @@
 import csv
 import os
+from applog import get_logger, setup as setup_logging
+
+log = get_logger('payment_success')
 
 csv_file = 'plates_log.csv'
 
 def mark_payment_success(plate_number):
     if not os.path.exists(csv_file):
-        print("[ERROR] Log file does not exist.")
+        log.error("[ERROR] Log file does not exist.")
         return
 
     updated = False
@@ -28,11 +31,12 @@ def mark_payment_success(plate_number):
             writer = csv.writer(f)
             writer.writerow(header)
             writer.writerows(rows)
-        print(f"[UPDATED] Payment status set to 1 for {plate_number}")
+        log.info("[UPDATED] Payment status set to 1 for %s", plate_number)
     else:
-        print(f"[INFO] No unpaid record found for {plate_number}")
+        log.info("[INFO] No unpaid record found for %s", plate_number)
 
 # ==== TESTING USAGE ====
 if __name__ == "__main__":
+    setup_logging('payment_success')
     plate = input("Enter plate number to mark as paid: ").strip().upper()
     mark_payment_success(plate)
\ No newline at end of file
@@ -0,0 +1,125 @@
+"""Plate format grammar with OCR confusion correction.
+
+A format is a pattern string where L stands for any letter, D for any digit and
+every other character must appear literally, e.g. 'RALDDDL' for RAF287E. Each
+format is compiled into one lookup table per position mapping every character
+Tesseract can return to (corrected character, cost), so a read that is nearly
+right (RAH97ZU, RA0287E) is repaired instead of being thrown away.
+"""
+import re
+import string
+
+PLATE_FORMATS = [
+    {'name': 'rw_private', 'pattern': 'RALDDDL'},
+]
+
+# Characters Tesseract confuses, as (read, meant) pairs with the cost of assuming the swap
+CONFUSIONS = {
+    ('0', 'O'): 0.2, ('O', '0'): 0.2,
+    ('1', 'I'): 0.2, ('I', '1'): 0.2,
+    ('2', 'Z'): 0.3, ('Z', '2'): 0.3,
+    ('5', 'S'): 0.3, ('S', '5'): 0.3,
+    ('8', 'B'): 0.3, ('B', '8'): 0.3,
+    ('D', '0'): 0.5, ('Q', '0'): 0.5,
+    ('6', 'G'): 0.5, ('G', '6'): 0.5,
+    ('7', 'T'): 0.6, ('T', '7'): 0.6,
+    ('4', 'A'): 0.6, ('A', '4'): 0.6,
+    ('L', '1'): 0.6,
+}
+DROP_COST = 0.5         # cost of discarding one stray character inside the plate
+MAX_COST = 1.0          # candidates costing more than this are rejected
+
+ALPHABET = string.ascii_uppercase + string.digits
+_NOT_ALNUM = re.compile(r'[^A-Z0-9]')
+
+
+def compile_pattern(pattern):
+    """Compile a pattern into one {read char: (plate char, cost)} table per position"""
+    tables = []
+    for symbol in pattern:
+        if symbol == 'L':
+            allowed = string.ascii_uppercase
+        elif symbol == 'D':
+            allowed = string.digits
+        else:
+            allowed = symbol
+        table = {}
+        for char in ALPHABET:
+            if char in allowed:
+                table[char] = (char, 0.0)
+                continue
+            options = [(cost, meant) for (read, meant), cost in CONFUSIONS.items()
+                       if read == char and meant in allowed]
+            if options:
+                cost, meant = min(options)
+                table[char] = (meant, cost)
+        tables.append(table)
+    return tables
+
+
+class PlateGrammar:
+    """Scores every way a raw OCR string can be read as one of the configured formats"""
+
+    def __init__(self, formats=PLATE_FORMATS, max_cost=MAX_COST, drop_cost=DROP_COST):
+        self.formats = [(fmt['name'], compile_pattern(fmt['pattern'])) for fmt in formats]
+        self.max_cost = max_cost
+        self.drop_cost = drop_cost
+
+    def _match(self, window, tables, base_cost):
+        cost = base_cost
+        plate = []
+        for char, table in zip(window, tables):
+            mapped = table.get(char)
+            if mapped is None:
+                return None
+            plate.append(mapped[0])
+            cost += mapped[1]
+            if cost > self.max_cost:
+                return None
+        return ''.join(plate), cost
+
+    def candidates(self, text, limit=5):
+        """Return up to limit (plate, score, format name) tuples, best first.
+
+        Windows of the format length are matched anywhere in the text, as are
+        windows one character longer with a single stray character dropped.
+        score is 1.0 for a clean read and falls with every correction.
+        """
+        text = _NOT_ALNUM.sub('', text.upper())
+        best = {}
+        for name, tables in self.formats:
+            n = len(tables)
+            for start in range(len(text) - n + 1):
+                found = self._match(text[start:start + n], tables, 0.0)
+                if found:
+                    self._keep(best, found, name, n)
+            for start in range(len(text) - n):
+                window = text[start:start + n + 1]
+                for skip in range(1, n):
+                    found = self._match(window[:skip] + window[skip + 1:], tables, self.drop_cost)
+                    if found:
+                        self._keep(best, found, name, n)
+        ranked = sorted(best.values(), key=lambda c: -c[1])
+        return ranked[:limit]
+
+    @staticmethod
+    def _keep(best, found, name, length):
+        plate, cost = found
+        score = round(1.0 - cost / length, 4)
+        if plate not in best or best[plate][1] < score:
+            best[plate] = (plate, score, name)
+
+    def parse(self, text):
+        """Return (plate, score) for the best candidate, or (None, 0.0)"""
+        ranked = self.candidates(text, limit=1)
+        if not ranked:
+            return None, 0.0
+        return ranked[0][0], ranked[0][1]
+
+
+DEFAULT_GRAMMAR = PlateGrammar()
+
+
+def parse_plate(text):
+    """Best plate in raw OCR text under the default grammar, or None"""
+    return DEFAULT_GRAMMAR.parse(text)[0]
@@ -0,0 +1,132 @@
+"""Fuzzy lookup of an OCR read against the plates that currently have an open session.
+
+A BK-tree over plain edit distance finds every open plate within one edit of
+the read. Those few candidates are then ranked by an edit distance whose
+substitution costs come from the OCR confusion table, so a read of RAF2B7E
+resolves to the open RAF287E. Only confusion-table substitutions are
+accepted: a plain substitution, insertion or deletion costs a full edit and
+could turn one car into another. A read that is as close to two open plates
+is reported as ambiguous instead of guessed: RA8287E with both RAB287E and
+RA82B7E open, say. Every confusion swaps a letter for a digit, so only plates
+outside PLATE_FORMATS (entered by hand) can set this up. A read of a plate the
+database already knows (one that has exited, say) is never rewritten at all.
+"""
+import time
+from plate_grammar import CONFUSIONS
+
+MAX_EDITS = 1               # BK-tree search radius
+MAX_WEIGHTED_COST = 1.0     # best candidate must cost less than this, i.e. confusions only
+AMBIGUITY_MARGIN = 0.3      # runner-up this close to the best makes the match ambiguous
+REFRESH_SECONDS = 10
+
+
+def levenshtein(a, b):
+    """Plain edit distance"""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+def confusion_distance(read, plate):
+    """Edit distance where substituting a commonly confused character is cheap"""
+    previous = [float(j) for j in range(len(plate) + 1)]
+    for i, cr in enumerate(read, 1):
+        current = [float(i)]
+        for j, cp in enumerate(plate, 1):
+            sub = 0.0 if cr == cp else CONFUSIONS.get((cr, cp), 1.0)
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + sub))
+        previous = current
+    return previous[-1]
+
+
+class BKTree:
+    """Burkhard-Keller tree for radius searches under an integer metric"""
+
+    def __init__(self, words=(), distance=levenshtein):
+        self.distance = distance
+        self.root = None
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        if self.root is None:
+            self.root = (word, {})
+            return
+        node = self.root
+        while True:
+            d = self.distance(word, node[0])
+            if d == 0:
+                return
+            child = node[1].get(d)
+            if child is None:
+                node[1][d] = (word, {})
+                return
+            node = child
+
+    def search(self, word, radius):
+        """Return [(distance, word)] for every word within radius"""
+        if self.root is None:
+            return []
+        found = []
+        stack = [self.root]
+        while stack:
+            node_word, children = stack.pop()
+            d = self.distance(word, node_word)
+            if d <= radius:
+                found.append((d, node_word))
+            for child_d, child in children.items():
+                if d - radius <= child_d <= d + radius:
+                    stack.append(child)
+        return found
+
+
+class OpenPlateIndex:
+    """Index of open-session plates, reloaded from the database every REFRESH_SECONDS.
+
+    is_known(plate) tells whether a plate not in the open set has any session
+    at all; such reads are taken as they are.
+    """
+
+    def __init__(self, loader, refresh_seconds=REFRESH_SECONDS, is_known=None):
+        self.loader = loader
+        self.is_known = is_known
+        self.refresh_seconds = refresh_seconds
+        self.plates = set()
+        self.tree = BKTree()
+        self.loaded_at = 0
+
+    def refresh(self, force=False):
+        if not force and time.time() - self.loaded_at < self.refresh_seconds:
+            return
+        plates = set(self.loader() or ())
+        if plates != self.plates:
+            self.plates = plates
+            self.tree = BKTree(sorted(plates))
+        self.loaded_at = time.time()
+
+    def match(self, read):
+        """Resolve a read to an open plate.
+
+        Returns (plate, candidates): plate is the matched open plate or None, and
+        candidates lists the (cost, plate) pairs considered. More than one
+        candidate with plate None means the read is ambiguous.
+        """
+        self.refresh()
+        if read in self.plates:
+            return read, [(0.0, read)]
+        if self.is_known is not None and self.is_known(read):
+            return None, []
+        candidates = sorted((confusion_distance(read, plate), plate)
+                            for _, plate in self.tree.search(read, MAX_EDITS))
+        candidates = [c for c in candidates if c[0] < MAX_WEIGHTED_COST]
+        if not candidates:
+            return None, []
+        if len(candidates) > 1 and candidates[1][0] - candidates[0][0] < AMBIGUITY_MARGIN:
+            return None, candidates
+        return candidates[0][1], candidates
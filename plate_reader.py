@@ -0,0 +1,170 @@
+import cv2
+import numpy as np
+import pytesseract
+from collections import Counter
+from plate_grammar import DEFAULT_GRAMMAR
+
+pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+
+OCR_CONFIG = '--psm 8 --oem 3 -c tessedit_char_whitelist=ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+MIN_PLATE_HEIGHT = 20
+MIN_PLATE_WIDTH = 50
+
+# Multi-variant preprocessing
+PLATE_HEIGHT = 64            # crops are scaled to this height before thresholding
+MAX_SKEW_ANGLE = 20          # degrees; larger minAreaRect angles are treated as noise
+VARIANTS = ('otsu', 'clahe_otsu', 'adaptive', 'otsu_inv', 'clahe_otsu_inv', 'adaptive_inv')
+EARLY_STOP_CONF = 85         # stop trying variants once a valid plate reads this confidently
+
+# Voting
+CONFIDENT_READ = 85          # a single valid read at or above this confidence decides the vehicle
+VOTES_REQUIRED = 2           # otherwise this many identical reads decide it
+MAX_READS = 3                # after this many reads the most common plate wins
+
+_clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(4, 4))
+
+
+def crop_plates(frame, result):
+    """Yield (box, plate_img) for every detection in a YOLO result"""
+    for box in result.boxes:
+        x1, y1, x2, y2 = map(int, box.xyxy[0])
+        plate_img = frame[y1:y2, x1:x2]
+
+        # Skip if plate image is too small
+        if plate_img.shape[0] < MIN_PLATE_HEIGHT or plate_img.shape[1] < MIN_PLATE_WIDTH:
+            continue
+        yield box, plate_img
+
+
+def preprocess_plate(plate_img):
+    """Grayscale, blur and Otsu-threshold a plate crop for OCR"""
+    gray = cv2.cvtColor(plate_img, cv2.COLOR_BGR2GRAY)
+    blur = cv2.GaussianBlur(gray, (5, 5), 0)
+    return cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+
+
+def skew_angle(gray):
+    """Angle in degrees the characters of a grayscale crop are rotated by (minAreaRect of the ink)"""
+    ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]
+    coords = cv2.findNonZero(ink)
+    if coords is None:
+        return 0.0
+    angle = cv2.minAreaRect(coords)[-1]
+    return (angle + 45) % 90 - 45   # OpenCV reports [-90, 0) or (0, 90] depending on version
+
+
+def deskew(gray, angle=None):
+    """Rotate a grayscale crop so the characters sit horizontally"""
+    if angle is None:
+        angle = skew_angle(gray)
+    if abs(angle) < 0.5 or abs(angle) > MAX_SKEW_ANGLE:
+        return gray
+    h, w = gray.shape
+    matrix = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+    return cv2.warpAffine(gray, matrix, (w, h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+
+def normalize_plate(plate_img, angle=None):
+    """Grayscale, deskew and scale a BGR crop to PLATE_HEIGHT; angle skips measuring the skew again"""
+    gray = cv2.cvtColor(plate_img, cv2.COLOR_BGR2GRAY) if plate_img.ndim == 3 else plate_img
+    gray = deskew(gray, angle)
+    h, w = gray.shape
+    width = max(1, int(round(w * PLATE_HEIGHT / h)))
+    interpolation = cv2.INTER_AREA if h > PLATE_HEIGHT else cv2.INTER_CUBIC
+    return cv2.resize(gray, (width, PLATE_HEIGHT), interpolation=interpolation)
+
+
+def make_variants(gray):
+    """Build every preprocessing variant of a normalized crop in one pass.
+
+    The three binarizations are stacked into one array so the inverted set is a
+    single vectorized subtraction. Returns {name: image} in VARIANTS order.
+    """
+    blur = cv2.GaussianBlur(gray, (5, 5), 0)
+    contrast = cv2.GaussianBlur(_clahe.apply(gray), (3, 3), 0)
+    base = np.stack([
+        cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1],
+        cv2.threshold(contrast, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1],
+        cv2.adaptiveThreshold(contrast, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 10),
+    ])
+    stacked = np.concatenate([base, 255 - base])
+    return dict(zip(VARIANTS, stacked))
+
+
+def ocr_plate(thresh):
+    """Run Tesseract on a preprocessed plate image"""
+    return pytesseract.image_to_string(thresh, config=OCR_CONFIG).strip().replace(" ", "")
+
+
+def ocr_with_confidence(image):
+    """Run Tesseract and return (text, mean word confidence 0-100)"""
+    data = pytesseract.image_to_data(image, config=OCR_CONFIG, output_type=pytesseract.Output.DICT)
+    words, confs = [], []
+    for word, conf in zip(data['text'], data['conf']):
+        conf = float(conf)
+        if word.strip() and conf >= 0:
+            words.append(word.strip())
+            confs.append(conf)
+    if not words:
+        return '', 0.0
+    return ''.join(words), sum(confs) / len(confs)
+
+
+def read_plate(gray, variants=VARIANTS, early_stop_conf=EARLY_STOP_CONF, grammar=DEFAULT_GRAMMAR):
+    """OCR the variants of a normalized crop and keep the most confident valid plate.
+
+    Returns (plate or None, confidence, variant name, raw text). The Tesseract
+    confidence is scaled by the grammar score, so corrected reads rank below
+    clean ones. Variants are tried in order and the search stops at the first
+    valid, confident read.
+    """
+    best = (None, 0.0, None, '')
+    for name, image in make_variants(gray).items():
+        if name not in variants:
+            continue
+        text, conf = ocr_with_confidence(image)
+        plate, score = grammar.parse(text)
+        conf *= score if plate else 1.0
+        if plate and (best[0] is None or conf > best[1]):
+            best = (plate, conf, name, text)
+            if conf >= early_stop_conf:
+                break
+        elif best[0] is None and conf > best[1]:
+            best = (None, conf, name, text)
+    return best
+
+
+def extract_plate_number(plate_text, grammar=DEFAULT_GRAMMAR):
+    """Return the best plate the grammar can salvage from raw OCR text, or None"""
+    return grammar.parse(plate_text)[0]
+
+
+class PlateVote:
+    """Collects the valid reads of one vehicle and decides once the evidence is enough.
+
+    A single read at CONFIDENT_READ decides immediately, otherwise VOTES_REQUIRED
+    identical reads do, and after MAX_READS the most common plate wins.
+    """
+
+    def __init__(self, confident_read=CONFIDENT_READ, votes_required=VOTES_REQUIRED, max_reads=MAX_READS):
+        self.confident_read = confident_read
+        self.votes_required = votes_required
+        self.max_reads = max_reads
+        self.reads = []
+
+    def add(self, plate, conf):
+        """Record a read; returns the decided plate (and resets) or None"""
+        self.reads.append(plate)
+        most_common, votes = Counter(self.reads).most_common(1)[0]
+        if conf >= self.confident_read:
+            most_common = plate
+        elif votes < self.votes_required and len(self.reads) < self.max_reads:
+            return None
+        self.reads.clear()
+        return most_common
+
+    def clear(self):
+        self.reads.clear()
+
+    def __len__(self):
+        return len(self.reads)
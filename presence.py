@@ -0,0 +1,118 @@
+"""Cheap vehicle presence from the camera, and its fusion with the ultrasonic sensor.
+
+    presence = CameraPresence()
+    presence.update(frame, now)             # PRESENCE_FPS times a second; ~0.1 ms at 720p
+    present = fuse(gate.median_distance(), presence.present(now), DISTANCE_THRESHOLD)
+
+CameraPresence shrinks each frame to PRESENCE_SIZE grayscale and compares it
+with a running-average background: when more than MOTION_FRACTION of the
+pixels differ by DIFF_THRESHOLD, something is in front of the camera. The
+background is learned quickly while the scene is empty and almost frozen while
+something is there, so a car waiting at the barrier is not absorbed into it
+before YOLO has seen it. Something that stays longer than ABSORB_SECONDS (a
+parked car, a moved cone) is learned at the normal rate again so presence
+clears; the flip side is that the spot a long-waiting car leaves can read as
+occupied for up to that long. Presence is held for HOLD_SECONDS after the last change. The frame is
+shrunk with bilinear sampling rather than area averaging: at 720p that is
+~0.03 ms against ~3.5 ms, and the noise it lets through is well under
+DIFF_THRESHOLD. All buffers are allocated on the first frame.
+
+fuse() decides from the median of the sensor's recent readings
+(GateLink.median_distance(), None when the sensor is silent) and the camera:
+
+    'sensor'    the ultrasonic sensor only, as before
+    'camera'    the camera only, for lanes without a sensor
+    'fallback'  the sensor while it reports, the camera when it goes quiet
+    'either'    whichever sees a vehicle first
+"""
+import cv2
+import numpy as np
+
+# Configuration
+PRESENCE_MODE = 'fallback'
+PRESENCE_SIZE = (96, 54)            # (w, h) of the frame the comparison runs on
+PRESENCE_FPS = 10                   # frames per second a lane checks at most
+DIFF_THRESHOLD = 25                 # gray levels a pixel must change by
+MOTION_FRACTION = 0.02              # share of changed pixels that means a vehicle
+BACKGROUND_RATE = 0.05              # background learning rate with nothing there...
+BACKGROUND_RATE_PRESENT = 0.002     # ...and while something is
+ABSORB_SECONDS = 30.0               # after this long, whatever is there becomes background
+HOLD_SECONDS = 2.0
+
+MODES = ('sensor', 'camera', 'fallback', 'either')
+
+
+class CameraPresence:
+    def __init__(self, size=PRESENCE_SIZE, fps=PRESENCE_FPS):
+        self.size = size
+        self.fps = fps
+        self.small = None
+        self.gray = None
+        self.background = None
+        self.background8 = None
+        self.diff = None
+        self.last_update = -np.inf
+        self.last_motion = -np.inf
+        self.present_since = None
+        self.fraction = 0.0
+
+    def due(self, now):
+        return now - self.last_update >= 1.0 / self.fps
+
+    def update(self, frame, now):
+        """Compare a frame with the background; returns whether something is moving in it"""
+        self.last_update = now
+        w, h = self.size
+        if self.small is None:
+            channels = frame.shape[2:] if frame.ndim == 3 else ()
+            self.small = np.empty((h, w) + channels, dtype=np.uint8)
+            self.gray = np.empty((h, w), dtype=np.uint8)
+            self.background8 = np.empty((h, w), dtype=np.uint8)
+            self.diff = np.empty((h, w), dtype=np.uint8)
+        cv2.resize(frame, self.size, dst=self.small, interpolation=cv2.INTER_LINEAR)
+        if self.small.ndim == 3:
+            cv2.cvtColor(self.small, cv2.COLOR_BGR2GRAY, dst=self.gray)
+        else:
+            self.gray[:] = self.small
+        if self.background is None:
+            self.background = self.gray.astype(np.float32)
+            return False
+        cv2.convertScaleAbs(self.background, dst=self.background8)
+        cv2.absdiff(self.gray, self.background8, dst=self.diff)
+        cv2.threshold(self.diff, DIFF_THRESHOLD, 255, cv2.THRESH_BINARY, dst=self.diff)
+        self.fraction = cv2.countNonZero(self.diff) / self.diff.size
+        moving = self.fraction >= MOTION_FRACTION
+        if moving:
+            self.last_motion = now
+        if not self.present(now):
+            self.present_since = None
+        elif self.present_since is None:
+            self.present_since = now
+        absorbing = self.present_since is None or now - self.present_since >= ABSORB_SECONDS
+        rate = BACKGROUND_RATE if absorbing else BACKGROUND_RATE_PRESENT
+        cv2.accumulateWeighted(self.gray, self.background, rate)
+        return moving
+
+    def present(self, now):
+        return now - self.last_motion <= HOLD_SECONDS
+
+
+def fuse(distance, camera, threshold, mode=PRESENCE_MODE):
+    """Whether a vehicle is at the lane.
+
+    distance is the median sensor reading in cm, None when the sensor is
+    silent; camera is CameraPresence.present(), None when it was not checked.
+    """
+    sensor = None if distance is None else distance <= threshold
+    if mode == 'sensor':
+        return bool(sensor)
+    if mode == 'camera':
+        return bool(camera)
+    if mode == 'either':
+        return bool(sensor) or bool(camera)
+    return sensor if sensor is not None else bool(camera)
+
+
+def needs_camera(distance, mode=PRESENCE_MODE):
+    """Whether fuse() will look at the camera for this sensor reading"""
+    return mode in ('camera', 'either') or (mode == 'fallback' and distance is None)
@@ -1,273 +1,320 @@
-import serial
+"""Parking payment service for one or more RFID kiosks.
+
+Every kiosk's serial port is drained by its own reader thread (see
+serial_link.SerialLineReader) and drives a small state machine:
+
+    IDLE --PLATE:--> LOOKUP --amount sent--> CHARGING --DONE:--> IDLE
+                       |                        |
+                       +--NO_ENTRY/INSUFFICIENT-+--INSUFFICIENT/ERROR/ABORTED/timeout--> IDLE
+
+The session lookup starts on a shared thread pool the moment the PLATE: line
+arrives, and the DB write after DONE: runs there too, so a slow database never
+stalls a reader thread and one kiosk waiting on a card never blocks another.
+process_payment.ino gives up after 5 seconds without an amount, so the lookup
+has to beat that.
+
+Every charge goes through the local payment ledger (payment_ledger.py): the
+intent is fsync'd before the amount and transaction id are sent, the debit as
+soon as DONE: comes back, and the commit once parking_sessions is updated.
+Debited payments the database missed are replayed every RECONCILE_SECONDS.
+"""
 import csv
-import time
 import os
-from datetime import datetime
-from web.db import update_payment_status_db, get_latest_unpaid_entry
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from serial_link import SerialLineReader, open_serial
+from tariff import get_tariff
+from payment_ledger import PaymentLedger, reconcile
+from metrics import histogram, start_http_server
+from web.db import get_latest_unpaid_session, mark_session_paid
+from applog import get_logger, setup as setup_logging
+
+log = get_logger('process_payment')
 
 # Configuration
 CSV_FILE = 'plates_log.csv'
-RATE_PER_HOUR = 500
-SERIAL_PORT = 'COM6'  # Change this to your Arduino port
 BAUD_RATE = 9600
-SERIAL_TIMEOUT = 5
-
-class ParkingPaymentSystem:
-    def __init__(self):
-        self.ser = None
-        self.initialize_csv()
-        self.connect_arduino()
-    
-    def initialize_csv(self):
-        """Initialize CSV file with headers if it doesn't exist"""
-        if not os.path.exists(CSV_FILE):
-            with open(CSV_FILE, 'w', newline='') as f:
-                writer = csv.writer(f)
-                writer.writerow(['Plate Number', 'Payment Status', 'Timestamp', 'Amount Paid'])
-            print(f"[INIT] Created new CSV file: {CSV_FILE}")
-        else:
-            print(f"[INIT] Using existing CSV file: {CSV_FILE}")
-    
-    def connect_arduino(self):
-        """Connect to Arduino with error handling"""
-        try:
-            self.ser = serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=SERIAL_TIMEOUT)
-            time.sleep(3)  # Wait for Arduino to initialize
-            print(f"[CONNECTED] Arduino connected on {SERIAL_PORT}")
-            
-            # Wait for Arduino ready signal
-            start_time = time.time()
-            while time.time() - start_time < 10:  # 10 second timeout
-                if self.ser.in_waiting:
-                    line = self.ser.readline().decode().strip()
-                    if line == "READY":
-                        print("[READY] Arduino is ready for payments")
-                        break
-                time.sleep(0.1)
-            else:
-                print("[WARNING] Arduino ready signal not received")
-                
-        except serial.SerialException as e:
-            print(f"[ERROR] Failed to connect to Arduino: {e}")
-            print("Please check:")
-            print("1. Arduino is connected to the correct port")
-            print("2. No other programs are using the serial port")
-            print("3. Arduino is running the payment processing code")
-            exit(1)
-    
-    def read_serial_line(self, timeout=10):
-        """Read a line from serial with timeout"""
-        start_time = time.time()
-        while time.time() - start_time < timeout:
-            if self.ser.in_waiting:
-                try:
-                    line = self.ser.readline().decode().strip()
-                    if line:
-                        return line
-                except UnicodeDecodeError:
-                    continue
-            time.sleep(0.01)
-        return None
-    
-    def parse_card_data(self, line):
-        """Parse card data from Arduino"""
-        try:
-            print(f"[PARSE] Parsing card data: {line}")
-            if not line.startswith("PLATE:") or ";BALANCE:" not in line:
-                return None, None
-            
-            parts = line.split(';')
-            plate = parts[0].split(':')[1].strip()
-            balance_str = parts[1].split(':')[1].strip()
-            balance = float(balance_str)
-            
-            # Validate plate format (should start with RA and be 7 chars)
-            if not plate.startswith('RA') or len(plate) != 7:
-                print(f"[ERROR] Invalid plate format: {plate}")
-                return None, None
-                
-            return plate, balance
-        except (ValueError, IndexError) as e:
-            print(f"[ERROR] Failed to parse card data '{line}': {e}")
+CHARGE_TIMEOUT = 15         # seconds to wait for DONE/INSUFFICIENT/ERROR after sending the amount
+DB_WORKERS = 4
+RECONCILE_SECONDS = 300
+METRICS_PORT = 9102         # /metrics for Prometheus, None to disable
+
+# One entry per RFID kiosk running process_payment.ino; 'lot' picks its tariff in tariff.py
+KIOSKS = [
+    {'name': 'kiosk-1', 'serial_port': 'COM6', 'lot': 'default'},
+]
+
+IDLE, LOOKUP, CHARGING = 'idle', 'lookup', 'charging'
+
+csv_lock = threading.Lock()
+
+PAYMENT_SECONDS = histogram('anpr_payment_seconds', "From the card tap to the reader's final answer",
+                            ['kiosk', 'outcome'], buckets=(0.5, 1, 2, 3, 5, 8, 12, 20, 30))
+
+
+def initialize_csv():
+    """Initialize CSV file with headers if it doesn't exist"""
+    if not os.path.exists(CSV_FILE):
+        with open(CSV_FILE, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Plate Number', 'Payment Status', 'Timestamp', 'Amount Paid'])
+        log.info("[INIT] Created new CSV file: %s", CSV_FILE)
+    else:
+        log.info("[INIT] Using existing CSV file: %s", CSV_FILE)
+
+
+def parse_card_data(line):
+    """Parse 'PLATE:RAB123C;BALANCE:1500.00' into (plate, balance)"""
+    try:
+        if not line.startswith("PLATE:") or ";BALANCE:" not in line:
             return None, None
-    
-    def lookup_unpaid_entry(self, plate):
-          """Look up the latest unpaid entry from DB (not CSV)"""
-          return get_latest_unpaid_entry(plate)
-
-    
-    def calculate_parking_fee(self, entry_time):
-        """Calculate parking fee based on duration"""
-        duration_seconds = (datetime.now() - entry_time).total_seconds()
-        duration_hours = max(1, int(duration_seconds / 3600))  # Minimum 1 hour
-        amount_due = duration_hours * RATE_PER_HOUR
-        return duration_hours, amount_due
-    
-    def update_payment_status(self, plate, amount_paid):
-        """Update DB and log to CSV"""
-        try:
-            # Update DB
-            update_payment_status_db(plate, amount_paid)
-    
-            # Append payment log to CSV for backup
-            with open(CSV_FILE, 'a', newline='') as f:
-                writer = csv.writer(f)
-                writer.writerow([plate, '1', time.strftime("%Y-%m-%d %H:%M:%S"), amount_paid])
-            print(f"[LOGGED] Backup written to CSV for {plate}")
-            return True
-    
-        except Exception as e:
-            print(f"[ERROR] Failed to update DB or log payment: {e}")
-            return False
 
-    
-    def process_payment(self, plate, balance, entry_time):
-        """Process payment for a specific plate"""
-        duration_hours, amount_due = self.calculate_parking_fee(entry_time)
-        
-        print(f"\n[PAYMENT INFO]")
-        print(f"Plate Number: {plate}")
-        print(f"Card Balance: {balance:.2f} RWF")
-        print(f"Parking Duration: {duration_hours} hours")
-        print(f"Amount Due: {amount_due:.2f} RWF")
-        
-        # Check if card has sufficient balance
-        if balance < amount_due:
-            print(f"[ERROR] Insufficient balance. Need {amount_due:.2f} RWF, have {balance:.2f} RWF")
-            self.ser.write("INSUFFICIENT_PYTHON\n".encode())
+        parts = line.split(';')
+        plate = parts[0].split(':')[1].strip()
+        balance = float(parts[1].split(':')[1].strip())
+
+        # Validate plate format (should start with RA and be 7 chars)
+        if not plate.startswith('RA') or len(plate) != 7:
+            log.error("[ERROR] Invalid plate format: %s", plate)
+            return None, None
+
+        return plate, balance
+    except (ValueError, IndexError) as e:
+        log.error("[ERROR] Failed to parse card data '%s': %s", line, e)
+        return None, None
+
+
+def record_payment(session_id, plate, amount_paid):
+    """Update DB and log to CSV"""
+    try:
+        if not mark_session_paid(session_id, amount_paid):
             return False
-        
-        # Send amount to Arduino
+
+        # Append payment log to CSV for backup
+        with csv_lock, open(CSV_FILE, 'a', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow([plate, '1', time.strftime("%Y-%m-%d %H:%M:%S"), amount_paid])
+        log.info("[LOGGED] Backup written to CSV for %s", plate)
+        return True
+    except Exception as e:
+        log.error("[ERROR] Failed to update DB or log payment: %s", e)
+        return False
+
+
+class Kiosk(SerialLineReader):
+    """State machine for one RFID payment reader"""
+
+    def __init__(self, name, device, executor, ledger, lot='default'):
+        super().__init__(device, name=name)
+        self.name = name
+        self.executor = executor
+        self.ledger = ledger
+        self.tariff = get_tariff(lot)
+        self.lock = threading.Lock()
+        self.state = IDLE
+        self.card = 0               # bumped per tap so stale lookups are ignored
+        self.plate = None
+        self.balance = None
+        self.session_id = None
+        self.amount_due = None
+        self.txid = None
+        self.in_doubt = {}          # txid -> (plate, session id, amount) of timed-out charges
+        self.deadline = None
+        self.tapped_at = None
+        self.start()
+
+    def set_state(self, state, deadline=None):
+        self.state = state
+        self.deadline = deadline
+
+    def finish(self, outcome):
+        """Record how long the payment that started with the last tap took"""
+        if self.tapped_at is not None:
+            PAYMENT_SECONDS.observe(time.perf_counter() - self.tapped_at, kiosk=self.name, outcome=outcome)
+            self.tapped_at = None
+
+    def abort(self, reason):
+        """The reader refused or failed; nothing was taken from the card"""
+        if self.state == CHARGING and self.txid:
+            self.ledger.aborted(self.txid, reason)
+        self.finish(reason.split(':')[0].lower())
+        self.set_state(IDLE)
+
+    def on_line(self, line):
+        with self.lock:
+            if line.startswith("PLATE:"):
+                self.on_card(line)
+            elif line.startswith("DONE:"):
+                self.on_done(line)
+            elif line == "INSUFFICIENT":
+                log.error("[ERROR] %s: reader reports insufficient balance", self.name)
+                self.abort(line)
+            elif line.startswith("ERROR:"):
+                log.error("[ARDUINO ERROR] %s: %s", self.name, line)
+                self.abort(line)
+            elif line == "ABORTED":
+                log.info("[INFO] %s: payment aborted by reader", self.name)
+                self.abort(line)
+            elif line == "READY":
+                log.info("[READY] %s is ready for payments", self.name)
+            elif line != "Remove card and place next card...":
+                log.info("[INFO] %s: %s", self.name, line)
+
+    def on_card(self, line):
+        log.info("[RECEIVED] %s: %s", self.name, line)
+        self.card += 1
+        self.tapped_at = time.perf_counter()
+        plate, balance = parse_card_data(line)
+        if not plate or balance is None:
+            self.write(b"NO_ENTRY\n")
+            self.finish('no_entry')
+            self.set_state(IDLE)
+            return
+        self.plate, self.balance = plate, balance
+        self.set_state(LOOKUP)
+        self.executor.submit(self.lookup, self.card, plate)
+
+    def lookup(self, card, plate):
+        """Runs on the pool: find the unpaid session, then quote and send the amount"""
         try:
-            self.ser.write(f"{amount_due:.2f}\n".encode())
-            print(f"[SENT] Payment amount {amount_due:.2f} RWF to Arduino")
-            
-            # Keep reading responses until we get DONE, INSUFFICIENT, or an ERROR
-            start_time = time.time()
-            timeout = 15  # Increased timeout to allow for Arduino processing
-            
-            while time.time() - start_time < timeout:
-                response = self.read_serial_line(timeout=2)
-                if not response:
-                    continue
-                
-                print(f"[RECEIVED] {response}")
-                
-                # Check for final responses
-                if response.startswith("DONE:"):
-                    # Parse response: DONE:amount_paid:new_balance
-                    parts = response.split(':')
-                    if len(parts) >= 3:
-                        try:
-                            amount_paid = float(parts[1])
-                            new_balance = float(parts[2])
-                            
-                            # Update payment status in DB
-                            if self.update_payment_status(plate, amount_paid):
-                                print(f"\n[SUCCESS] Payment processed successfully!")
-                                print(f"Amount Paid: {amount_paid:.2f} RWF")
-                                print(f"Remaining Balance: {new_balance:.2f} RWF")
-                                return True
-                            else:
-                                print("[WARNING] Payment deducted but DB update failed")
-                                return False
-                        except (ValueError, IndexError) as e:
-                            print(f"[ERROR] Failed to parse DONE response: {e}")
-                            return False
-                    else:
-                        print("[ERROR] Invalid DONE response format from Arduino")
-                        return False
-                
-                elif response == "INSUFFICIENT":
-                    print("[ERROR] Arduino reports insufficient balance")
-                    return False
-                
-                elif response.startswith("ERROR:"):
-                    print(f"[ERROR] Arduino error: {response}")
-                    return False
-                
-                elif response == "ABORTED":
-                    print("[INFO] Payment aborted by Arduino")
-                    return False
-                
-                # Handle info/debug messages (don't return, just log)
-                elif (response.startswith("Debug:") or 
-                      response.startswith("🔓") or 
-                      response.startswith("✅") or 
-                      response.startswith("❌") or
-                      "Authentication success" in response or
-                      "Data written successfully" in response or
-                      "New balance written" in response):
-                    print(f"[INFO] {response}")
-                    # Continue reading for the final response
-                
-                else:
-                    print(f"[INFO] {response}")
-                    # Continue reading for other messages
-            
-            # If we reach here, we timed out
-            print("[ERROR] Timeout waiting for Arduino response")
-            return False
-                    
+            session = get_latest_unpaid_session(plate)
         except Exception as e:
-            print(f"[ERROR] Communication error with Arduino: {e}")
-            return False
-    
+            log.error("[ERROR] %s: session lookup failed: %s", self.name, e)
+            session = None
+        with self.lock:
+            if card != self.card or self.state != LOOKUP:
+                return  # the reader timed out or another card was tapped meanwhile
+            plate, balance = self.plate, self.balance
+            if not session:
+                log.error("[ERROR] No unpaid parking record found for %s", plate)
+                self.write(b"NO_ENTRY\n")
+                self.finish('no_entry')
+                self.set_state(IDLE)
+                return
+
+            session_id, entry_time = session
+            minutes, amount_due = self.tariff.quote(entry_time)
+            # One record per payment so kiosks logging at once don't interleave
+            log.info("[PAYMENT INFO] %s: plate %s, card balance %.2f RWF, parked %dh %02dm, amount due %.2f RWF",
+                     self.name, plate, balance, minutes // 60, minutes % 60, amount_due,
+                     extra={'plate': plate, 'session_id': session_id, 'amount_due': amount_due})
+
+            if balance < amount_due:
+                log.error("[ERROR] Insufficient balance. Need %.2f RWF, have %.2f RWF", amount_due, balance)
+                self.write(b"INSUFFICIENT_PYTHON\n")
+                self.finish('insufficient')
+                self.set_state(IDLE)
+                return
+
+            txid = self.ledger.begin(self.name, plate, session_id, amount_due)
+            if self.write(f"{amount_due:.2f};{txid}\n".encode()):
+                log.info("[SENT] Payment amount %.2f RWF to %s (tx %s)", amount_due, self.name, txid)
+                self.session_id, self.amount_due, self.txid = session_id, amount_due, txid
+                self.set_state(CHARGING, deadline=time.time() + CHARGE_TIMEOUT)
+            else:
+                self.ledger.aborted(txid, 'write_failed')
+                self.finish('write_failed')
+                self.set_state(IDLE)
+
+    def on_done(self, line):
+        log.info("[RECEIVED] %s: %s", self.name, line)
+        # DONE:amount_paid:new_balance[:txid]
+        parts = line.split(':')
+        echoed = parts[3] if len(parts) > 3 else None
+        if self.state == CHARGING and echoed in (None, self.txid):
+            txid, plate, session_id, amount_due = self.txid, self.plate, self.session_id, self.amount_due
+            self.finish('paid')
+            self.set_state(IDLE)
+        elif echoed in self.in_doubt:
+            # Answer to a charge that had already timed out
+            txid = echoed
+            plate, session_id, amount_due = self.in_doubt.pop(echoed)
+        else:
+            log.warning("[WARNING] %s: unexpected %s while %s", self.name, line, self.state)
+            return
+        try:
+            amount_paid, new_balance = float(parts[1]), float(parts[2])
+        except (ValueError, IndexError) as e:
+            # The card was written but the reply is garbled; keep the quoted amount
+            log.error("[ERROR] %s: failed to parse DONE response: %s", self.name, e)
+            amount_paid, new_balance = amount_due, None
+        self.ledger.debited(txid, amount_paid, new_balance)
+        self.executor.submit(self.record, txid, session_id, plate, amount_paid, new_balance)
+
+    def record(self, txid, session_id, plate, amount_paid, new_balance):
+        """Runs on the pool: update parking_sessions, then commit the ledger entry"""
+        if record_payment(session_id, plate, amount_paid):
+            self.ledger.committed(txid)
+            remaining = f", remaining balance {new_balance:.2f} RWF" if new_balance is not None else ""
+            log.info("[SUCCESS] %s: payment processed for %s, amount paid %.2f RWF%s",
+                     self.name, plate, amount_paid, remaining, extra={'plate': plate, 'txid': txid})
+        else:
+            log.warning("[WARNING] %s: payment deducted but DB update failed for %s, tx %s will be replayed",
+                        self.name, plate, txid)
+
+    def on_idle(self, now):
+        if self.deadline is not None and now > self.deadline:
+            with self.lock:
+                if self.deadline is not None and now > self.deadline:
+                    log.error("[ERROR] %s: timeout waiting for reader response, tx %s in doubt", self.name, self.txid)
+                    self.in_doubt[self.txid] = (self.plate, self.session_id, self.amount_due)
+                    self.finish('timeout')
+                    self.set_state(IDLE)
+
+    def on_disconnect(self, error):
+        log.error("[ERROR] %s: serial link lost: %s", self.name, error)
+
+
+class PaymentService:
+    """Runs every configured kiosk from one process"""
+
+    def __init__(self, kiosks=KIOSKS, db_workers=DB_WORKERS):
+        initialize_csv()
+        self.executor = ThreadPoolExecutor(max_workers=db_workers, thread_name_prefix='payment-db')
+        self.ledger = PaymentLedger()
+        if METRICS_PORT:
+            start_http_server(METRICS_PORT)
+        self.kiosks = []
+        for config in kiosks:
+            device = open_serial(config['serial_port'], config.get('baud_rate', BAUD_RATE), settle=3)
+            if device:
+                self.kiosks.append(Kiosk(config['name'], device, self.executor, self.ledger,
+                                         config.get('lot', 'default')))
+            else:
+                log.error("[ERROR] %s: kiosk not started", config['name'])
+        if not self.kiosks:
+            log.error("Please check:\n"
+                      "1. Arduino is connected to the correct port\n"
+                      "2. No other programs are using the serial port\n"
+                      "3. Arduino is running the payment processing code")
+            exit(1)
+
     def run(self):
-        """Main payment processing loop"""
-        print("🚗 Welcome to Parking Payment System 🚗")
-        print("=" * 50)
-        print("Place RFID card on reader to process payment...")
-        print("Press Ctrl+C to exit")
-        
+        """Keep the process alive while the kiosk reader threads do the work"""
+        log.info("🚗 Welcome to Parking Payment System 🚗")
+        log.info("=" * 50)
+        log.info("Serving %s kiosk(s). Place RFID card on reader to process payment...", len(self.kiosks))
+        log.info("Press Ctrl+C to exit")
         try:
-            while True:
-                line = self.read_serial_line(timeout=1)
-                
-                if not line:
-                    continue
-                
-                print(f"[RECEIVED] {line}")
-                
-                # Handle different types of messages from Arduino
-                if line.startswith("PLATE:"):
-                    plate, balance = self.parse_card_data(line)
-                    
-                    if not plate or balance is None:
-                        self.ser.write("NO_ENTRY\n".encode())
-                        continue
-                    
-                    # Look up unpaid entry
-                    entry_time = self.lookup_unpaid_entry(plate)
-                    
-                    if not entry_time:
-                        print(f"[ERROR] No unpaid parking record found for {plate}")
-                        self.ser.write("NO_ENTRY\n".encode())
-                        continue
-                    
-                    # Process payment
-                    self.process_payment(plate, balance, entry_time)
-                
-                elif line.startswith("ERROR:"):
-                    print(f"[ARDUINO ERROR] {line}")
-                
-                elif line in ["READY", "Remove card and place next card..."]:
-                    # Arduino status messages
-                    pass
-                
-                else:
-                    # Other Arduino messages
-                    print(f"[INFO] {line}")
-        
+            next_reconcile = 0
+            while any(k.connected for k in self.kiosks):
+                if time.time() >= next_reconcile:
+                    self.executor.submit(reconcile, self.ledger)
+                    next_reconcile = time.time() + RECONCILE_SECONDS
+                time.sleep(0.5)
+            log.error("[FATAL ERROR] All kiosk connections lost")
         except KeyboardInterrupt:
-            print("\n[EXIT] Payment system stopped by user")
-        except Exception as e:
-            print(f"[FATAL ERROR] {e}")
+            log.info("[EXIT] Payment system stopped by user")
         finally:
-            if self.ser:
-                self.ser.close()
-                print("[DISCONNECTED] Serial connection closed")
+            for kiosk in self.kiosks:
+                kiosk.close()
+            self.executor.shutdown(wait=True)
+            self.ledger.close()
+            log.info("[DISCONNECTED] Serial connections closed")
+
 
 if __name__ == "__main__":
-    system = ParkingPaymentSystem()
-    system.run()
\ No newline at end of file
+    setup_logging('process_payment')
+    service = PaymentService()
+    service.run()
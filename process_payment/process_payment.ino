@@ -98,6 +98,14 @@ bool processPayment() {
     return false;
   }
   
+  // Python sends "amount;txid"; the txid is echoed in DONE for its payment ledger
+  String txid = "";
+  int separator = input.indexOf(';');
+  if (separator >= 0) {
+    txid = input.substring(separator + 1);
+    input = input.substring(0, separator);
+  }
+
   float amountDue = input.toFloat();
   
   // Validate amount
@@ -119,7 +127,12 @@ bool processPayment() {
     Serial.print("DONE:");
     Serial.print(amountDue, 2);
     Serial.print(":");
-    Serial.println(newBalance, 2);
+    Serial.print(newBalance, 2);
+    if (txid.length() > 0) {
+      Serial.print(":");
+      Serial.print(txid);
+    }
+    Serial.println();
     return true;
   } else {
     Serial.println("ERROR:WRITE_FAILED");
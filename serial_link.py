@@ -0,0 +1,532 @@
+"""Serial link to the gate Arduino, drained continuously by a reader thread.
+
+gate.ino prints a bare distance every 100 ms and status lines such as
+"[GATE] Opened" on the same stream. Reading one line per camera frame lets
+that stream back up, so GateLink owns the port from a background thread
+instead: every line is parsed into a typed message. The last DISTANCE_WINDOW
+distances are kept in a small ring so callers can take their median and
+ignore the odd echo off a passing person or a rain drop.
+
+Commands go out as 4-byte frames: 0xAA, sequence number, command, CRC-8 of
+sequence and command. The gate answers every frame with a text line on the
+same stream, "[ACK] <seq> OK" or "[NACK] <seq> <reason>", so a dropped,
+corrupted or refused command is known instead of guessed. Unanswered frames
+are retransmitted with the same sequence number, which the gate recognises
+and does not execute twice. The round trip of every acknowledged command is
+kept for latency statistics (python serial_link.py COM3 --pings 200).
+
+With framed=False the link talks to the old single-character sketch and
+takes the matching status line as the acknowledgement.
+
+SerialLineReader is the port-draining thread on its own; the payment kiosks in
+process_payment.py build on it as well.
+
+VirtualGate behaves like gate.ino behind a serial port and can stand in for
+the hardware in tests or dry runs (serial port 'virtual').
+"""
+import argparse
+import threading
+import time
+from collections import deque
+import numpy as np
+import serial
+import serial.tools.list_ports
+from metrics import counter, histogram
+from applog import get_logger, setup as setup_logging
+
+log = get_logger('serial_link')
+
+BAUD_RATE = 9600            # gate.ino SERIAL_BAUD; 115200 cuts a frame's wire time from ~4 ms to ~0.3 ms
+FRAMED = True               # False for gates still running the single-character sketch
+READ_TIMEOUT = 0.1          # seconds; bounds how long close() waits for the reader
+STALE_AFTER = 0.5           # distances older than this are treated as missing
+ACK_TIMEOUT = 1.0
+RETRY_AFTER = 0.25          # resend an unanswered frame after this long
+MAX_ATTEMPTS = 3
+NO_VEHICLE_DISTANCE = 150   # what callers get when there is no fresh reading
+DISTANCE_WINDOW = 5         # readings median_distance() filters over (~0.5 s at gate.ino's rate)
+
+FRAME_START = 0xAA
+
+# Single-byte commands understood by gate.ino and the status line each one produces
+OPEN = b'1'
+CLOSE = b'0'
+ALERT = b'2'
+STOP_ALERT = b'3'
+PING = b'P'
+EXPECTED_ACK = {
+    OPEN: ('gate', 'Opened'),
+    CLOSE: ('gate', 'Closed'),
+    ALERT: ('alert', 'Unpaid vehicle detected!'),
+    STOP_ALERT: ('alert', 'Cleared'),
+}
+COMMAND_NAMES = {OPEN: 'open', CLOSE: 'close', ALERT: 'alert', STOP_ALERT: 'stop_alert', PING: 'ping'}
+
+GATE_COMMAND_SECONDS = histogram('anpr_gate_command_seconds',
+                                 "Time from sending a gate command to its ACK, NACK or timeout",
+                                 ['command', 'status'])
+GATE_RETRANSMITS = counter('anpr_gate_retransmits_total', "Gate command frames sent again")
+
+
+def crc8(data):
+    """CRC-8, polynomial 0x07, as computed by gate.ino"""
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
+
+
+def build_frame(seq, command):
+    body = bytes([seq, command[0]])
+    return bytes([FRAME_START]) + body + bytes([crc8(body)])
+
+
+def parse_line(line):
+    """Turn one line from the gate into (kind, value)"""
+    try:
+        return 'distance', float(line)
+    except ValueError:
+        pass
+    for tag, kind in (('[ACK]', 'ack'), ('[NACK]', 'nack')):
+        if line.startswith(tag):
+            parts = line[len(tag):].split()
+            if parts and parts[0].isdigit():
+                return kind, (int(parts[0]), parts[1] if len(parts) > 1 else '')
+            return 'text', line
+    for tag, kind in (('[GATE]', 'gate'), ('[ALERT]', 'alert'), ('[SYSTEM]', 'system')):
+        if line.startswith(tag):
+            return kind, line[len(tag):].strip()
+    return 'text', line
+
+
+class PendingCommand:
+    """A command written to the gate, settled by its ACK/NACK or status line"""
+
+    def __init__(self, command, seq=None, expect=None):
+        self.command = command
+        self.seq = seq
+        self.expect = expect
+        self.sent_at = time.time()
+        self.last_sent_at = self.sent_at
+        self.attempts = 1
+        self.acked_at = None
+        self.status = None
+        self._event = threading.Event()
+
+    def settle(self, status):
+        self.acked_at = time.time()
+        self.status = status
+        self._event.set()
+        GATE_COMMAND_SECONDS.observe(self.acked_at - self.sent_at,
+                                     command=COMMAND_NAMES.get(self.command, '?'), status=status)
+
+    def wait(self, timeout=ACK_TIMEOUT):
+        """True once the gate confirmed the command, False on NACK or timeout"""
+        return self._event.wait(timeout) and self.ok
+
+    @property
+    def done(self):
+        return self._event.is_set()
+
+    @property
+    def ok(self):
+        return self.status == 'OK'
+
+    @property
+    def latency(self):
+        return None if self.acked_at is None else self.acked_at - self.sent_at
+
+
+def detect_arduino_port(baud_rate=BAUD_RATE):
+    """The first port that looks like an Arduino, else the first common COM port that opens"""
+    for port in serial.tools.list_ports.comports():
+        if "Arduino" in port.description or "USB-SERIAL" in port.description:
+            return port.device
+    for port_name in ['COM3', 'COM4', 'COM5', 'COM6']:
+        try:
+            serial.Serial(port_name, baud_rate, timeout=1).close()
+            return port_name
+        except (serial.SerialException, OSError):
+            continue
+    return None
+
+
+def open_serial(port, baud_rate=BAUD_RATE, max_retries=3, settle=2):
+    """Open a serial port with retry logic, None when it cannot be opened"""
+    for attempt in range(max_retries):
+        try:
+            device = serial.Serial(port, baud_rate, timeout=READ_TIMEOUT)
+            time.sleep(settle)  # Wait for Arduino to initialize
+            log.info("[CONNECTED] Arduino connected on %s", port)
+            return device
+        except serial.SerialException as e:
+            log.error("[ERROR] Connection attempt %s on %s failed: %s", attempt + 1, port, e)
+            if "Access is denied" in str(e):
+                log.info("[HELP] Port may be in use. Try:\n"
+                         "- Close Arduino IDE\n"
+                         "- Unplug and replug Arduino\n"
+                         "- Check Device Manager for correct COM port")
+            time.sleep(1)
+    log.error("[ERROR] Failed to connect to Arduino on %s.", port)
+    return None
+
+
+class SerialLineReader:
+    """Drains a serial device from a background thread and hands every line to on_line().
+
+    Subclasses set up their state, then call start(). on_idle() runs after each
+    read (at least every READ_TIMEOUT) for timeouts and retransmissions.
+    """
+
+    def __init__(self, device, name='serial-reader'):
+        self.ser = device
+        if hasattr(self.ser, 'timeout'):
+            self.ser.timeout = READ_TIMEOUT
+        self.write_lock = threading.Lock()
+        self.running = False
+        self.thread = threading.Thread(target=self._read_loop, name=name, daemon=True)
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def on_line(self, line):
+        raise NotImplementedError
+
+    def on_idle(self, now):
+        pass
+
+    def on_disconnect(self, error):
+        log.error("[ERROR] Serial link lost: %s", error)
+
+    def _read_loop(self):
+        buffer = b''
+        while self.running:
+            try:
+                data = self.ser.read(self.ser.in_waiting or 1)
+            except (serial.SerialException, OSError) as e:
+                if self.running:
+                    self.on_disconnect(e)
+                self.running = False
+                break
+            if data:
+                buffer += data
+                *lines, buffer = buffer.split(b'\n')
+                for raw in lines:
+                    line = raw.decode('utf-8', errors='replace').strip()
+                    if line:
+                        self.on_line(line)
+            self.on_idle(time.time())
+
+    def write(self, data):
+        """Write bytes from any thread, False if the port failed"""
+        try:
+            with self.write_lock:
+                self.ser.write(data)
+            return True
+        except (serial.SerialException, OSError) as e:
+            log.error("[ERROR] Serial write failed: %s", e)
+            return False
+
+    @property
+    def connected(self):
+        return self.running
+
+    def close(self):
+        self.running = False
+        if self.thread.is_alive():
+            self.thread.join(timeout=READ_TIMEOUT * 5)
+        try:
+            self.ser.close()
+        except (serial.SerialException, OSError):
+            pass
+
+
+class GateLink(SerialLineReader):
+    """Owns a gate Arduino's serial port; a reader thread parses everything it sends"""
+
+    def __init__(self, device, framed=FRAMED, stale_after=STALE_AFTER):
+        super().__init__(device, name='gate-link')
+        self.framed = framed
+        self.stale_after = stale_after
+        self.lock = threading.Lock()
+        self.distance = None
+        self.distance_at = 0
+        self.recent = np.full(DISTANCE_WINDOW, np.nan)
+        self.recent_at = np.zeros(DISTANCE_WINDOW)
+        self.recent_head = 0
+        self.events = deque(maxlen=100)
+        self.pending = []
+        self.seq = 0
+        self.latencies = deque(maxlen=1000)
+        self.timeouts = 0
+        self.nacks = 0
+        self.start()
+
+    @classmethod
+    def open(cls, port, baud_rate=BAUD_RATE, max_retries=3, framed=FRAMED):
+        """Open a port (or 'virtual') with retry logic, None when it cannot be opened"""
+        if not port:
+            return None
+        if port == 'virtual':
+            return cls(VirtualGate(), framed=framed)
+        device = open_serial(port, baud_rate, max_retries)
+        return cls(device, framed=framed) if device else None
+
+    def on_line(self, line):
+        self._handle(*parse_line(line))
+
+    def on_idle(self, now):
+        self._retransmit(now)
+
+    def on_disconnect(self, error):
+        log.error("[ERROR] Gate serial link lost: %s", error)
+
+    def _handle(self, kind, value):
+        now = time.time()
+        with self.lock:
+            if kind == 'distance':
+                if 0 <= value <= 400:  # HC-SR04 max range is ~400cm
+                    self.distance = value
+                    self.distance_at = now
+                    self.recent[self.recent_head] = value
+                    self.recent_at[self.recent_head] = now
+                    self.recent_head = (self.recent_head + 1) % DISTANCE_WINDOW
+                return
+            self.events.append((now, kind, value))
+            if kind in ('ack', 'nack'):
+                seq, status = value
+                for pending in self.pending:
+                    if pending.seq == seq:
+                        break
+                else:
+                    return  # late reply to a command already given up on
+                if kind == 'nack' and status == 'BAD_CRC' and pending.attempts < MAX_ATTEMPTS:
+                    pending.last_sent_at = 0  # garbled on the wire, resend right away
+                    return
+                self.pending.remove(pending)
+                if kind == 'nack':
+                    self.nacks += 1
+                pending.settle(status if kind == 'nack' else 'OK')
+                if pending.ok:
+                    self.latencies.append(pending.latency)
+            elif not self.framed:
+                for pending in self.pending:
+                    if pending.expect == (kind, value):
+                        self.pending.remove(pending)
+                        pending.settle('OK')
+                        self.latencies.append(pending.latency)
+                        break
+
+    def _retransmit(self, now):
+        resend, expired = [], []
+        with self.lock:
+            for pending in self.pending:
+                if now - pending.sent_at > ACK_TIMEOUT:
+                    expired.append(pending)
+                elif (self.framed and pending.attempts < MAX_ATTEMPTS
+                        and now - pending.last_sent_at > RETRY_AFTER):
+                    pending.attempts += 1
+                    pending.last_sent_at = now
+                    resend.append(pending)
+            for pending in expired:
+                self.pending.remove(pending)
+                self.timeouts += 1
+        for pending in expired:
+            pending.settle('TIMEOUT')
+        for pending in resend:
+            GATE_RETRANSMITS.inc()
+            self.write(build_frame(pending.seq, pending.command))
+
+    def latest_distance(self, default=NO_VEHICLE_DISTANCE):
+        """Newest distance in cm, or default when the sensor has gone quiet"""
+        with self.lock:
+            if self.distance is None or time.time() - self.distance_at > self.stale_after:
+                return default
+            return self.distance
+
+    def median_distance(self):
+        """Median of the fresh distances in the ring in cm, None when the sensor has gone quiet"""
+        with self.lock:
+            fresh = self.recent[self.recent_at >= time.time() - self.stale_after]
+        if not len(fresh):
+            return None
+        return float(np.median(fresh))
+
+    def send(self, command):
+        """Write a command without blocking; returns a PendingCommand, or None if the write failed"""
+        with self.lock:
+            if self.framed:
+                self.seq = self.seq % 255 + 1
+                pending = PendingCommand(command, seq=self.seq)
+            else:
+                pending = PendingCommand(command, expect=EXPECTED_ACK.get(command))
+            if pending.seq or pending.expect:
+                self.pending.append(pending)
+        data = build_frame(pending.seq, command) if self.framed else command
+        if not self.write(data):
+            with self.lock:
+                if pending in self.pending:
+                    self.pending.remove(pending)
+            return None
+        return pending
+
+    def ping(self, timeout=ACK_TIMEOUT):
+        """Round trip of a no-op command in seconds, None when unanswered"""
+        pending = self.send(PING) if self.framed else None
+        if pending and pending.wait(timeout):
+            return pending.latency
+        return None
+
+    def latency_stats(self):
+        """Round-trip statistics over the recent acknowledged commands, in milliseconds"""
+        with self.lock:
+            samples = np.array(self.latencies) * 1000
+            stats = {'count': len(samples), 'timeouts': self.timeouts, 'nacks': self.nacks}
+        if len(samples):
+            stats.update(mean=float(samples.mean()), p50=float(np.percentile(samples, 50)),
+                         p95=float(np.percentile(samples, 95)), max=float(samples.max()))
+        return stats
+
+
+class VirtualGate:
+    """In-memory stand-in for gate.ino behind a serial port.
+
+    Set .distance to move the simulated vehicle. Frames and legacy single
+    characters are handled like the sketch does, including refusing to open
+    during an alert and ignoring bare characters once a frame has arrived, and
+    a distance line is produced every 100 ms. Set .corrupt_next to garble the
+    next frame's checksum.
+    """
+
+    def __init__(self, distance=NO_VEHICLE_DISTANCE, interval=0.1, alert_duration=4.0):
+        self.distance = distance
+        self.interval = interval
+        self.alert_duration = alert_duration
+        self.gate_open = False
+        self.alert_until = 0
+        self.output = bytearray(b'[SYSTEM] Arduino Gate Controller Ready\r\n')
+        self.last_distance_at = 0
+        self.frame = None           # bytes of a frame being received
+        self.last_frame = None      # (seq, cmd) of the last executed frame
+        self.framed_host = False    # legacy characters are ignored after the first good frame
+        self.corrupt_next = False
+        self.written = []
+        self.timeout = READ_TIMEOUT
+        self.is_open = True
+        self.lock = threading.Lock()
+
+    def _println(self, text):
+        self.output += text.encode() + b'\r\n'
+
+    def _tick(self):
+        now = time.time()
+        if self.alert_until and now >= self.alert_until:
+            self.alert_until = 0
+            self._println('[ALERT] Cleared')
+            self._println('[ALERT] Auto-stopped after 4 seconds')
+        if now - self.last_distance_at >= self.interval:
+            self._println(f"{self.distance:.2f}")
+            self.last_distance_at = now
+
+    @property
+    def in_waiting(self):
+        with self.lock:
+            self._tick()
+            return len(self.output)
+
+    def read(self, size=1):
+        deadline = time.time() + (self.timeout or 0)
+        while True:
+            with self.lock:
+                self._tick()
+                if self.output:
+                    data = bytes(self.output[:size])
+                    del self.output[:size]
+                    return data
+            if not self.is_open or time.time() >= deadline:
+                return b''
+            time.sleep(0.01)
+
+    def write(self, data):
+        with self.lock:
+            self.written.append(bytes(data))
+            for byte in bytes(data):
+                self._receive(byte)
+        return len(data)
+
+    def _receive(self, byte):
+        if self.frame is None:
+            if byte == FRAME_START:
+                self.frame = []
+            elif not self.framed_host:
+                self._execute(bytes([byte]))
+            return
+        self.frame.append(byte)
+        if len(self.frame) < 3:
+            return
+        seq, cmd, crc = self.frame
+        self.frame = None
+        if self.corrupt_next or crc8(bytes([seq, cmd])) != crc:
+            self.corrupt_next = False
+            self._println(f'[NACK] {seq} BAD_CRC')
+            return
+        self.framed_host = True
+        if self.last_frame == (seq, cmd):
+            self._println(f'[ACK] {seq} OK')  # retransmission of an executed frame
+            return
+        status = self._execute(bytes([cmd]))
+        if status == 'OK':
+            self.last_frame = (seq, cmd)
+            self._println(f'[ACK] {seq} OK')
+        else:
+            self._println(f'[NACK] {seq} {status}')
+
+    def _execute(self, cmd):
+        if cmd == OPEN:
+            if self.alert_until:
+                return 'BLOCKED'
+            self.gate_open = True
+            self._println('[GATE] Opened')
+        elif cmd == CLOSE:
+            self.gate_open = False
+            self._println('[GATE] Closed')
+        elif cmd == ALERT:
+            self.alert_until = time.time() + self.alert_duration
+            self._println('[ALERT] Unpaid vehicle detected!')
+        elif cmd == STOP_ALERT:
+            self.alert_until = 0
+            self._println('[ALERT] Cleared')
+        elif cmd != PING:
+            return 'UNKNOWN'
+        return 'OK'
+
+    def close(self):
+        self.is_open = False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure command round-trip latency to a gate Arduino")
+    parser.add_argument('port', help="serial port, or 'virtual'")
+    parser.add_argument('--baud', type=int, default=BAUD_RATE)
+    parser.add_argument('--pings', type=int, default=100)
+    parser.add_argument('--interval', type=float, default=0.05, help="seconds between pings")
+    args = parser.parse_args()
+    setup_logging('serial_link', log_file=False)
+
+    link = GateLink.open(args.port, args.baud)
+    if not link:
+        raise SystemExit(1)
+    try:
+        for _ in range(args.pings):
+            link.ping()
+            time.sleep(args.interval)
+        stats = link.latency_stats()
+        print(f"[LATENCY] {stats['count']} acknowledged, {stats['timeouts']} timeouts, {stats['nacks']} NACKs")
+        if stats['count']:
+            print(f"[LATENCY] mean {stats['mean']:.1f} ms, p50 {stats['p50']:.1f} ms, "
+                  f"p95 {stats['p95']:.1f} ms, max {stats['max']:.1f} ms")
+    finally:
+        link.close()
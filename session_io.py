@@ -0,0 +1,228 @@
+"""Bulk export and import of parking_sessions.
+
+    python session_io.py export audit_2025.csv.gz --since 2025-01-01
+    python session_io.py import plates_log.csv old_logs/*.csv --batch 2000
+    python session_io.py migrate [--remove-duplicates]
+
+Export streams rows through an unbuffered cursor in fetchmany() chunks inside
+a consistent-snapshot transaction, writing gzip CSV when the name ends in .gz.
+Memory stays flat however many rows the table has, and the gates keep writing
+while it runs.
+
+Import folds the historical CSV logs back into sessions. Their rows are
+events in file order: car_entry writes (plate, 0, time), process_payment
+appends (plate, 1, time, amount), car_exit writes (plate, 2, time) and
+transactions.py rewrites the entry row in place with a 'Payment Timestamp'.
+Entries open a session, payments and exits update the plate's open session,
+and a payment or exit without one becomes a session of its own. Sessions are
+upserted in batches on the (plate_number, timestamp) unique key, so
+re-importing a file, or one that overlaps the database, changes nothing that
+is already there. Imported sessions then get their session_events and
+current_sessions is rebuilt (web.db.sync_session_projections()). Before the
+first row is written the monthly partitions are extended back to the oldest
+logged time, so history lands in its own months where archive.py can drop it.
+
+Migrate adds the parking_sessions indexes an older table is missing, the
+unique key import relies on included. Duplicate (plate, timestamp) rows are
+reported first; --remove-duplicates keeps the lowest id of each. It then
+partitions parking_sessions and session_events by month if they predate that,
+rewriting each once; the gate scripts only warn about it at startup.
+"""
+import argparse
+import csv
+import gzip
+from datetime import datetime
+from mysql.connector import Error
+from web.db import (connect_db, ensure_partitions, missing_session_indexes, migrate_partitions,
+                    migrate_session_indexes, sync_session_projections, PARTITIONED_TABLES)
+from applog import get_logger, setup as setup_logging
+
+log = get_logger('session_io')
+
+EXPORT_COLUMNS = ['id', 'plate_number', 'payment_status', 'amount', 'timestamp', 'gate']
+CHUNK_ROWS = 5000
+BATCH_ROWS = 1000
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+UPSERT_SQL = '''
+    INSERT INTO parking_sessions (plate_number, payment_status, amount, timestamp, gate)
+    VALUES (%s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        gate = IF(VALUES(payment_status) > payment_status, VALUES(gate), gate),
+        amount = GREATEST(amount, VALUES(amount)),
+        payment_status = GREATEST(payment_status, VALUES(payment_status))
+'''
+
+
+def open_text(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', newline='')
+    return open(path, mode, newline='')
+
+
+def export_sessions(path, since=None, until=None, chunk_rows=CHUNK_ROWS):
+    """Stream parking_sessions (optionally a timestamp range) to a CSV or .csv.gz file"""
+    conn = connect_db()
+    if not conn:
+        return 0
+    query = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM parking_sessions"
+    conditions, params = [], []
+    if since:
+        conditions.append("timestamp >= %s")
+        params.append(since)
+    if until:
+        conditions.append("timestamp < %s")
+        params.append(until)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+
+    written = 0
+    try:
+        conn.start_transaction(consistent_snapshot=True, readonly=True)
+        cursor = conn.cursor(buffered=False)
+        cursor.execute(query, params)
+        with open_text(path, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(EXPORT_COLUMNS)
+            while True:
+                rows = cursor.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                writer.writerows(rows)
+                written += len(rows)
+                if written % (chunk_rows * 20) < len(rows):
+                    log.info("[EXPORT] %s rows...", written)
+        cursor.close()
+        conn.commit()
+        log.info("[EXPORT] %s sessions written to %s", written, path)
+    except Error as e:
+        log.error("[DB ERROR] Export failed after %s rows: %s", written, e)
+    finally:
+        conn.close()
+    return written
+
+
+def parse_time(value):
+    return datetime.strptime(value.strip(), TIME_FORMAT)
+
+
+def read_events(path):
+    """Yield (plate, status, time, amount) from a log CSV of any of the three layouts"""
+    skipped = 0
+    with open_text(path, 'r') as f:
+        reader = csv.reader(f)
+        next(reader, None)  # header; the layout is recognised per row
+        for row in reader:
+            try:
+                plate, status, stamp = row[0].strip().upper(), int(row[1]), parse_time(row[2])
+            except (ValueError, IndexError):
+                skipped += 1
+                continue
+            amount = 0.0
+            if len(row) > 3 and row[3].strip():
+                try:
+                    amount = float(row[3])          # 'Amount Paid'
+                except ValueError:
+                    pass                            # 'Payment Timestamp'; the entry time stays the key
+            yield plate, status, stamp, amount
+    if skipped:
+        log.info("[IMPORT] %s: skipped %s malformed rows", path, skipped)
+
+
+def fold_sessions(events):
+    """Turn log events in time order into sessions (plate, status, amount, entry time, gate)"""
+    open_sessions = {}
+    for plate, status, stamp, amount in events:
+        session = open_sessions.get(plate)
+        if status == 0:
+            if session:
+                yield tuple(session)
+            open_sessions[plate] = [plate, 0, amount, stamp, 'entry']
+            continue
+        if session is None or session[3] > stamp:
+            # Payment or exit without a logged entry, or a row rewritten in place
+            yield (plate, status, amount, stamp, 'exit' if status == 2 else 'entry')
+            continue
+        session[1] = max(session[1], status)
+        session[2] = max(session[2], amount)
+        if status == 2:
+            session[4] = 'exit'
+            yield tuple(session)
+            del open_sessions[plate]
+    yield from (tuple(s) for s in open_sessions.values())
+
+
+def import_logs(paths, batch_rows=BATCH_ROWS, dry_run=False):
+    """Upsert the sessions found in the given log CSVs, committing every batch_rows"""
+    def events():
+        for path in paths:
+            yield from read_events(path)
+
+    conn = None if dry_run else connect_db()
+    if not dry_run and not conn:
+        return 0
+    total = 0
+    cursor = None
+    try:
+        if conn:
+            cursor = conn.cursor()
+            if 'uq_plate_timestamp' in missing_session_indexes(cursor):
+                log.error("[IMPORT] parking_sessions has no uq_plate_timestamp to upsert on; "
+                          "run 'python session_io.py migrate' first")
+                return 0
+            oldest = min((stamp for _, _, stamp, _ in events()), default=None)
+            if oldest:
+                for table in PARTITIONED_TABLES:
+                    ensure_partitions(cursor, table, oldest=oldest, rewrite=True)
+        batch = []
+        for plate, status, amount, stamp, gate in fold_sessions(events()):
+            batch.append((plate, status, amount, stamp.strftime(TIME_FORMAT), gate))
+            if len(batch) >= batch_rows:
+                total += flush_batch(conn, cursor, batch)
+                batch = []
+        total += flush_batch(conn, cursor, batch)
+        if conn:
+            sync_session_projections(cursor)
+            conn.commit()
+        log.info("[IMPORT] %s sessions %s from %s file(s)", total, 'found' if dry_run else 'upserted', len(paths))
+    except Error as e:
+        log.error("[DB ERROR] Import stopped after %s sessions: %s", total, e)
+    finally:
+        if cursor:
+            cursor.close()
+        if conn:
+            conn.close()
+    return total
+
+
+def flush_batch(conn, cursor, batch):
+    if batch and conn:
+        cursor.executemany(UPSERT_SQL, batch)
+        conn.commit()
+    return len(batch)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export or backfill parking_sessions")
+    sub = parser.add_subparsers(dest='command', required=True)
+    exp = sub.add_parser('export', help="stream the table to CSV (gzip when the name ends in .gz)")
+    exp.add_argument('output')
+    exp.add_argument('--since', help="YYYY-MM-DD[ HH:MM:SS], inclusive")
+    exp.add_argument('--until', help="YYYY-MM-DD[ HH:MM:SS], exclusive")
+    exp.add_argument('--chunk', type=int, default=CHUNK_ROWS)
+    imp = sub.add_parser('import', help="upsert sessions from historical plates_log CSVs")
+    imp.add_argument('files', nargs='+', help="CSV or .csv.gz logs, oldest first")
+    imp.add_argument('--batch', type=int, default=BATCH_ROWS)
+    imp.add_argument('--dry-run', action='store_true')
+    mig = sub.add_parser('migrate', help="add missing parking_sessions indexes, reporting duplicate sessions first, "
+                                         "and partition tables from before partitioning")
+    mig.add_argument('--remove-duplicates', action='store_true', help="keep the lowest id of each duplicate group")
+    args = parser.parse_args()
+    setup_logging('session_io')
+
+    if args.command == 'export':
+        export_sessions(args.output, args.since, args.until, args.chunk)
+    elif args.command == 'migrate':
+        raise SystemExit(0 if migrate_session_indexes(args.remove_duplicates) and migrate_partitions() else 1)
+    else:
+        import_logs(args.files, args.batch, args.dry_run)
@@ -0,0 +1,101 @@
+"""Startup timing: how long after launch a lane can make its first decision.
+
+    import startup                       # first import of the entry point
+    startup.mark('detector_ready')       # logs [STARTUP] and sets anpr_startup_seconds{phase}
+
+    python startup.py lane_service       # import-time profile of a module
+    python startup.py detector plate_reader --top 30
+
+Phases are measured from the import of this module, which the entry points do
+first, so they include every import after it. A restart is blind until
+'detector_ready'; READY_TARGET is the budget for that phase and
+FIRST_DECISION_TARGET for the first plate decision after launch (a car already
+waiting at the gate). Both are logged with a warning when exceeded.
+
+With detector_service.py running, the gate scripts attach to its warm model
+instead of importing ultralytics and torch and loading best.pt themselves,
+which is most of a cold start; see detector.attach_detector(). The profile
+imports the module in a fresh interpreter, so only profile modules that keep
+their work under `if __name__ == '__main__'` (not car_entry or car_exit).
+"""
+import time
+
+LAUNCHED = time.perf_counter()
+
+import argparse
+import re
+import subprocess
+import sys
+from metrics import gauge
+from applog import get_logger
+
+log = get_logger('startup')
+
+READY_TARGET = 3.0              # seconds from launch until the detector answers
+FIRST_DECISION_TARGET = 5.0     # seconds from launch until the first plate decision
+
+TARGETS = {'detector_ready': READY_TARGET, 'first_decision': FIRST_DECISION_TARGET}
+
+STARTUP_SECONDS = gauge('anpr_startup_seconds', "Seconds from process launch to each startup phase", ['phase'])
+
+_marked = set()
+
+
+def elapsed():
+    return time.perf_counter() - LAUNCHED
+
+
+def mark(phase):
+    """Record the first time a phase is reached; later calls are ignored"""
+    if phase in _marked:
+        return None
+    _marked.add(phase)
+    seconds = elapsed()
+    STARTUP_SECONDS.set(seconds, phase=phase)
+    target = TARGETS.get(phase)
+    if target is not None and seconds > target:
+        log.warning("[STARTUP] %s after %.2f s (target %.1f s)", phase, seconds, target)
+    else:
+        log.info("[STARTUP] %s after %.2f s", phase, seconds)
+    return seconds
+
+
+# ---------- import profile ----------
+IMPORT_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def import_profile(module):
+    """(cumulative us, self us, depth, module) for every import made by `import module`"""
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                               capture_output=True, text=True)
+    rows = []
+    for line in completed.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            own, cumulative, indent, name = match.groups()
+            rows.append((int(cumulative), int(own), len(indent) // 2, name))
+    if completed.returncode and not rows:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else
+                           f"python exited with {completed.returncode}")
+    return rows
+
+
+def report(module, top=20):
+    rows = import_profile(module)
+    total = max((row[0] for row in rows if row[2] == 0 and row[3] == module), default=0)
+    print(f"[STARTUP] import {module}: {total / 1e6:.2f} s")
+    print(f"{'cumulative s':>13}{'self s':>9}  module")
+    for cumulative, own, depth, name in sorted(rows, reverse=True)[:top]:
+        print(f"{cumulative / 1e6:>13.3f}{own / 1e6:>9.3f}  {'  ' * depth}{name}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Show which imports a script spends its startup on")
+    parser.add_argument('modules', nargs='+', help="module names, e.g. lane_service car_entry")
+    parser.add_argument('--top', type=int, default=20, help="slowest imports to list")
+    args = parser.parse_args()
+    for name in args.modules:
+        try:
+            report(name, args.top)
+        except RuntimeError as e:
+            print(f"[ERROR] import {name} failed: {e}")
@@ -0,0 +1,177 @@
+"""Parking tariffs compiled into per-minute fee tables.
+
+A tariff is a list of duration bands (a price per started or completed block
+of minutes from some point of the stay on), an optional grace period (stays
+no longer than it are free), a minimum charge, and a cap per 24 hours. Each
+lot has its own tariff and each vehicle class scales it.
+
+Tariff compiles all of that into the cumulative fee for every minute of the
+first TABLE_DAYS days, so quoting a stay is one array lookup. Longer stays add
+whole days at the steady day fee. rerate() does the same lookup for a whole
+numpy array of durations at once, which is what revenue what-ifs need:
+
+    python tariff.py sessions.csv --lot default --compare kiosk_half_hour
+"""
+import argparse
+import csv
+from datetime import datetime
+import numpy as np
+
+TABLE_DAYS = 7
+DAY = 1440                  # minutes
+
+# Lot name -> tariff. Bands: 'from' minute of the stay, optional 'to', price per
+# 'every' minutes, 'round' 'up' charges started blocks and 'down' only full ones.
+TARIFFS = {
+    # 500 RWF per full hour, at least one hour (the original kiosk pricing)
+    'default': {
+        'grace_minutes': 0,
+        'minimum_charge': 500,
+        'daily_cap': None,
+        'bands': [{'from': 0, 'every': 60, 'price': 500, 'round': 'down'}],
+    },
+    # First 30 minutes free, then 100 per started half hour (transactions.py)
+    'kiosk_half_hour': {
+        'grace_minutes': 0,
+        'minimum_charge': 0,
+        'daily_cap': None,
+        'bands': [{'from': 30, 'every': 30, 'price': 100, 'round': 'up'}],
+    },
+}
+
+# Multiplier on every price, minimum and cap of a tariff
+VEHICLE_CLASSES = {'car': 1.0, 'motorcycle': 0.5, 'bus': 2.0, 'truck': 2.0}
+
+
+class Tariff:
+    """One lot's tariff for one vehicle class, as a cumulative fee table"""
+
+    def __init__(self, config, vehicle_class='car', days=TABLE_DAYS):
+        if vehicle_class not in VEHICLE_CLASSES:
+            raise ValueError(f"Unknown vehicle class: {vehicle_class}")
+        factor = VEHICLE_CLASSES[vehicle_class]
+        minutes = np.arange(days * DAY + 1)
+
+        uncapped = np.zeros(len(minutes))
+        for band in config['bands']:
+            start = band['from']
+            end = band.get('to') or len(minutes)
+            in_band = np.clip(minutes - start, 0, end - start)
+            if band.get('round', 'up') == 'up':
+                blocks = -(-in_band // band['every'])
+            else:
+                blocks = in_band // band['every']
+            uncapped += blocks * band['price'] * factor
+
+        fees = uncapped
+        if config.get('daily_cap') is not None:
+            # Each 24 hours of the stay costs at most the cap
+            cap = config['daily_cap'] * factor
+            day = np.maximum(minutes - 1, 0) // DAY     # minute 1440 still belongs to day 0
+            boundaries = uncapped[::DAY]
+            earlier_days = np.concatenate([[0], np.cumsum(np.minimum(np.diff(boundaries), cap))])
+            fees = earlier_days[day] + np.minimum(uncapped - boundaries[day], cap)
+
+        fees = np.maximum(fees, config.get('minimum_charge', 0) * factor)
+        if config.get('grace_minutes'):
+            fees[:config['grace_minutes'] + 1] = 0
+        self.table = fees
+        self.last = len(fees) - 1
+        self.day_fee = fees[-1] - fees[-1 - DAY]
+
+    def quote_minutes(self, minutes):
+        """Fee for a stay of the given whole minutes"""
+        minutes = max(int(minutes), 0)
+        if minutes <= self.last:
+            return float(self.table[minutes])
+        extra_days, rest = divmod(minutes - self.last, DAY)
+        # Beyond the table every further day repeats the last one
+        return float(self.table[self.last - DAY + rest] + (extra_days + 1) * self.day_fee)
+
+    def quote(self, entry_time, exit_time=None):
+        """Return (minutes parked, fee) for a stay that started at entry_time"""
+        exit_time = exit_time or datetime.now()
+        minutes = int((exit_time - entry_time).total_seconds() // 60)
+        return minutes, self.quote_minutes(minutes)
+
+    def rerate(self, minutes):
+        """Vectorized quote_minutes over an array of durations"""
+        minutes = np.maximum(np.asarray(minutes, dtype=np.int64), 0)
+        inside = np.minimum(minutes, self.last)
+        fees = self.table[inside]
+        beyond = minutes > self.last
+        if beyond.any():
+            extra_days, rest = np.divmod(minutes[beyond] - self.last, DAY)
+            fees = fees.copy()
+            fees[beyond] = self.table[self.last - DAY + rest] + (extra_days + 1) * self.day_fee
+        return fees
+
+
+_compiled = {}
+
+
+def get_tariff(lot='default', vehicle_class='car'):
+    """Compiled tariff for a lot and vehicle class, built once per process"""
+    key = (lot, vehicle_class)
+    if key not in _compiled:
+        if lot not in TARIFFS:
+            raise ValueError(f"No tariff configured for lot: {lot}")
+        _compiled[key] = Tariff(TARIFFS[lot], vehicle_class)
+    return _compiled[key]
+
+
+def stay_minutes(entries, exits):
+    """Whole minutes between two arrays of timestamps (datetime64 or 'YYYY-MM-DD HH:MM:SS' strings)"""
+    entries = np.asarray(entries, dtype='datetime64[s]')
+    exits = np.asarray(exits, dtype='datetime64[s]')
+    return (exits - entries).astype(np.int64) // 60
+
+
+def rerate(minutes, lots=None, vehicle_classes=None, lot='default', vehicle_class='car'):
+    """Fees for many stays in one pass.
+
+    lots and vehicle_classes are optional arrays parallel to minutes; without
+    them every stay is rated under lot/vehicle_class.
+    """
+    minutes = np.asarray(minutes, dtype=np.int64)
+    if lots is None and vehicle_classes is None:
+        return get_tariff(lot, vehicle_class).rerate(minutes)
+    lots = np.full(len(minutes), lot, dtype=object) if lots is None else np.asarray(lots, dtype=object)
+    vehicle_classes = (np.full(len(minutes), vehicle_class, dtype=object) if vehicle_classes is None
+                       else np.asarray(vehicle_classes, dtype=object))
+    fees = np.zeros(len(minutes))
+    pairs = np.char.add(np.char.add(lots.astype(str), '|'), vehicle_classes.astype(str))
+    for pair in np.unique(pairs):
+        mask = pairs == pair
+        pair_lot, pair_class = pair.split('|')
+        fees[mask] = get_tariff(pair_lot, pair_class).rerate(minutes[mask])
+    return fees
+
+
+def load_stays(path):
+    """Read 'entry' and 'exit' timestamp columns (and optional 'lot', 'vehicle_class') from a CSV"""
+    entries, exits, lots, classes = [], [], [], []
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            if not row.get('entry') or not row.get('exit'):
+                continue
+            entries.append(row['entry'].replace(' ', 'T'))
+            exits.append(row['exit'].replace(' ', 'T'))
+            lots.append(row.get('lot') or 'default')
+            classes.append(row.get('vehicle_class') or 'car')
+    return stay_minutes(entries, exits), np.array(lots, dtype=object), np.array(classes, dtype=object)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-rate historical stays and compare tariff revenue")
+    parser.add_argument('stays', help="CSV with entry and exit timestamp columns")
+    parser.add_argument('--lot', default=None, help="rate every stay under this lot instead of its own")
+    parser.add_argument('--compare', nargs='*', default=[], help="other tariffs to price the same stays with")
+    args = parser.parse_args()
+
+    minutes, lots, classes = load_stays(args.stays)
+    print(f"[TARIFF] {len(minutes)} stays, median {np.median(minutes) if len(minutes) else 0:.0f} min")
+    for name in ([args.lot] if args.lot else [None]) + args.compare:
+        fees = rerate(minutes, lots=None if name else lots, vehicle_classes=classes, lot=name or 'default')
+        label = name or 'per-stay lot'
+        print(f"  {label:<20} revenue {fees.sum():>14,.0f} RWF, mean {fees.mean() if len(fees) else 0:,.0f}")
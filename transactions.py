@@ -2,20 +2,17 @@ import serial
 import time
 import csv
 from datetime import datetime
+from tariff import get_tariff
+from applog import get_logger, setup as setup_logging
+
+log = get_logger('transactions')
+setup_logging('transactions')
 
 # Configure the serial port (adjust 'COM14' to your Arduino's port)
 ser = serial.Serial('COM10', 9600, timeout=1)
 
 time.sleep(2)  # Wait for serial to initialize
 
-def print_boxed_message(message, border_char="=", width=50):
-    """Helper function to print a message in a boxed format."""
-    border = border_char * width
-    padding = " " * ((width - len(message) - 2) // 2)
-    print(border)
-    print(f"|{padding}{message}{padding}{' ' if len(message) % 2 else ''}|")
-    print(border)
-    
 def get_timestamp():
     """Return the current timestamp in a formatted string."""
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -30,15 +27,13 @@ def read_last_unpaid_entry(plate):
                 return None
             return entries[-1]  # Return the last unpaid entry
     except FileNotFoundError:
-        print_boxed_message("Error: File Not Found", "!")
-        print(f"[{get_timestamp()}] plates_log.csv not found. Creating a new one.\n")
+        log.warning("[ERROR] plates_log.csv not found. Creating a new one.")
         with open('plates_log.csv', 'w', newline='') as file:
             writer = csv.writer(file)
             writer.writerow(['Plate Number', 'Payment Status', 'Timestamp', 'Payment Timestamp'])
         return None
     except Exception as e:
-        print_boxed_message("Error: CSV Read Failed", "!")
-        print(f"[{get_timestamp()}] {e}\n")
+        log.error("[ERROR] CSV read failed: %s", e)
         return None
     
 def update_payment_status(plate, entry_timestamp):
@@ -59,35 +54,28 @@ def update_payment_status(plate, entry_timestamp):
             writer.writerows(rows)
         return payment_time
     except Exception as e:
-        print_boxed_message("Error: CSV Update Failed", "!")
-        print(f"[{get_timestamp()}] {e}\n")
+        log.error("[ERROR] CSV update failed: %s", e)
         return None
 try:
-    print_boxed_message("Python Parking System Ready", "=")
-    print(f"[{get_timestamp()}] Waiting for Arduino data...\n")
+    log.info("[SYSTEM] Python Parking System Ready. Waiting for Arduino data...")
     while True:
         if ser.in_waiting > 0:
             line = ser.readline().decode('utf-8').strip()
             if line.startswith("DATA:"):
-                print(line)
+                log.debug("[SERIAL] %s", line)
                 # Parse the data
                 plate, cash = line[5:].split(',')
                 cash = int(cash)
                 # Display received data
-                print_boxed_message("Data Received from Arduino", "-")
-                print(f"[{get_timestamp()}] Details:")
-                print(f"  License Plate: {plate}")
-                print(f"  Current Balance: {cash} units\n")
+                log.info("[RECEIVED] License Plate: %s, Current Balance: %s units", plate, cash)
                 # Check if cash is more than 200
                 if cash <= 200:
-                    print_boxed_message("Error: Insufficient Balance", "!")
-                    print(f"[{get_timestamp()}] Balance ({cash} units) must be > 200 units.\n")
+                    log.warning("[ERROR] Insufficient balance: %s units, must be > 200 units", cash)
                     continue
                 # Read the last unpaid entry for the plate
                 last_entry = read_last_unpaid_entry(plate)
                 if last_entry is None:
-                    print_boxed_message("Warning: No Unpaid Entry Found", "!")
-                    print(f"[{get_timestamp()}] No unpaid entry for plate {plate}. Assuming 0 hours.\n")
+                    log.warning("[WARNING] No unpaid entry for plate %s. Assuming 0 hours.", plate)
                     hours = 0
                 else:
                     entry_time = datetime.strptime(last_entry['Timestamp'], "%Y-%m-%d %H:%M:%S")
@@ -95,46 +83,29 @@ try:
                     time_diff = current_time - entry_time
                     hours = time_diff.total_seconds() / 3600  # Convert to hours
                 # Calculate charge (100 units per 30 min after first 30 min)
-                minutes = hours * 60
-                charge = 0
-                if minutes > 30:
-                    charge = ((minutes - 30 + 29) // 30) * 100
+                charge = int(get_tariff('kiosk_half_hour').quote_minutes(hours * 60))
                 if charge > cash:
-                    print_boxed_message("Error: Charge Exceeds Balance", "!")
-                    print(f"[{get_timestamp()}] Charge ({charge} units) exceeds balance ({cash} units).\n")
+                    log.warning("[ERROR] Charge (%s units) exceeds balance (%s units)", charge, cash)
                     continue
                 # Send charge to Arduino
                 ser.write(f"CHARGE:{charge}\n".encode())
-                print_boxed_message("Data Sent to Arduino", "-")
-                print(f"[{get_timestamp()}] Transaction Details:")
-                print(f"  License Plate: {plate}")
-                print(f"  Parking Duration: {hours:.2f} hours")
-                print(f"  Charge Amount: {charge} units\n")
+                log.info("[SENT] License Plate: %s, Parking Duration: %.2f hours, Charge Amount: %s units",
+                         plate, hours, charge)
                 # Wait for DONE signal
                 response = ser.readline().decode('utf-8').strip()
                 if response == "DONE":
                     if last_entry:
                         payment_time = update_payment_status(plate, last_entry['Timestamp'])
                         if payment_time:
-                            print_boxed_message("Payment Processed", "-")
-                            print(f"[{get_timestamp()}] Payment Details:")
-                            print(f"  Payment Timestamp: {payment_time}")
-                            print(f"  Updated Balance: {cash - charge} units\n")
-                    print_boxed_message("Transaction Successful", "=")
-                    print(f"[{get_timestamp()}] Gate is opening...\n")
+                            log.info("[PAID] Payment Timestamp: %s, Updated Balance: %s units",
+                                     payment_time, cash - charge)
+                    log.info("[SUCCESS] Transaction successful for %s. Gate is opening...", plate)
                 else:
-                    print_boxed_message("Error: Arduino Response", "!")
-                    print(f"[{get_timestamp()}] Unexpected response: {response}\n")
+                    log.error("[ERROR] Unexpected response from Arduino: %s", response)
         time.sleep(0.1)  # Small delay to prevent overwhelming the loop
 except KeyboardInterrupt:
-    print("\n" + "=" * 50)
-    print(f"[{get_timestamp()}] Program terminated by user.")
-    print("=" * 50)
-    ser.close()
+    log.info("[SYSTEM] Program terminated by user.")
 except Exception as e:
-    print("\n" + "=" * 50)
-    print(f"[{get_timestamp()}] An error occurred: {e}")
-    print("=" * 50)
-    ser.close()
+    log.exception("[ERROR] An error occurred: %s", e)
 finally:
     ser.close()
\ No newline at end of file
@@ -1,9 +1,88 @@
-from flask import Flask, render_template, jsonify, request
+import json
+import os
+import sys
+import time
+from itertools import chain
+from flask import Flask, render_template, jsonify, request, Response, stream_with_context, g
 from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # repo root: metrics.py
+from metrics import histogram, render as render_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
 from db import *
+from applog import get_logger, setup as setup_logging
+
+log = get_logger('web.app')
 
 app = Flask(__name__)
 
+HTTP_SECONDS = histogram('anpr_http_request_seconds', "Dashboard request latency up to the response headers",
+                         ['route', 'method', 'status'])
+
+MAX_RECENT = 100            # cap for the dashboard's recent-* lists
+MAX_PAGE_SIZE = 500         # cap for one page of /api/sessions
+GATES = ('entry', 'exit', 'unauthorized')
+
+
+def limit_arg(default, cap):
+    """The 'limit' query parameter, clamped to 1..cap"""
+    try:
+        value = int(request.args.get('limit', default))
+    except ValueError:
+        value = default
+    return max(1, min(value, cap))
+
+
+def date_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise ValueError(f"{name} must be YYYY-MM-DD or YYYY-MM-DD HH:MM:SS")
+
+
+def encode_cursor(row):
+    return f"{row['timestamp']:%Y%m%d%H%M%S}-{row['id']}"
+
+
+def decode_cursor(text):
+    try:
+        stamp, session_id = text.split('-')
+        return datetime.strptime(stamp, '%Y%m%d%H%M%S'), int(session_id)
+    except ValueError:
+        raise ValueError("invalid cursor")
+
+
+def session_json(row):
+    return {
+        'id': row['id'],
+        'plate_number': row['plate_number'],
+        'payment_status': row['payment_status'],
+        'amount': float(row['amount'] or 0),
+        'timestamp': str(row['timestamp']),
+        'gate': row['gate'],
+    }
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        HTTP_SECONDS.observe(time.perf_counter() - started, route=route,
+                             method=request.method, status=response.status_code)
+    return response
+
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
 # Route for the main dashboard
 @app.route('/')
 def dashboard():
@@ -16,7 +95,7 @@ def api_revenue():
         total_revenue = get_total_revenue()
         return jsonify({'total_revenue': total_revenue})
     except Exception as e:
-        print(f"[API ERROR] Revenue: {e}")
+        log.error("[API ERROR] Revenue: %s", e)
         return jsonify({'total_revenue': 0}), 500
 
 @app.route('/api/daily-stats')
@@ -34,52 +113,53 @@ def api_daily_stats():
             
         return jsonify(stats)
     except Exception as e:
-        print(f"[API ERROR] Daily stats: {e}")
+        log.error("[API ERROR] Daily stats: %s", e)
         return jsonify([]), 500
 
 @app.route('/api/recent-activity')
 def api_recent_activity():
     try:
-        limit = int(request.args.get('limit', 10))
+        limit = limit_arg(10, MAX_RECENT)
         conn = connect_db()
         if conn:
             cursor = conn.cursor(dictionary=True)
+            # Every entry, payment, exit and denial as it happened, newest first
             cursor.execute('''
-                SELECT plate_number, payment_status, amount, timestamp, gate
-                FROM parking_sessions
-                ORDER BY timestamp DESC
+                SELECT plate_number, event, amount, timestamp
+                FROM session_events
+                ORDER BY id DESC
                 LIMIT %s
             ''', (limit,))
-            sessions = cursor.fetchall()
+            events = cursor.fetchall()
             
             activities = []
-            for session in sessions:
-                if session['payment_status'] == 1:
+            for event in events:
+                if event['event'] == 'payment':
                     activities.append({
                         'type': 'payment',
-                        'title': f"Payment received from {session['plate_number']} - RWF {session['amount']:,.0f}",
-                        'time': format_time_ago(session['timestamp']),
+                        'title': f"Payment received from {event['plate_number']} - RWF {event['amount']:,.0f}",
+                        'time': format_time_ago(event['timestamp']),
                         'icon': 'fa-credit-card'
                     })
-                elif session['gate'] == 'unauthorized':
+                elif event['event'] == 'denied':
                     activities.append({
                         'type': 'alert',
-                        'title': f"Unauthorized exit attempt: {session['plate_number']}",
-                        'time': format_time_ago(session['timestamp']),
+                        'title': f"Unauthorized exit attempt: {event['plate_number']}",
+                        'time': format_time_ago(event['timestamp']),
                         'icon': 'fa-exclamation-triangle'
                     })
-                elif session['payment_status'] == 2:
+                elif event['event'] == 'exit':
                     activities.append({
                         'type': 'exit',
-                        'title': f"Vehicle {session['plate_number']} exited",
-                        'time': format_time_ago(session['timestamp']),
+                        'title': f"Vehicle {event['plate_number']} exited",
+                        'time': format_time_ago(event['timestamp']),
                         'icon': 'fa-sign-out-alt'
                     })
                 else:
                     activities.append({
                         'type': 'entry',
-                        'title': f"Vehicle {session['plate_number']} entered at {session['gate']}",
-                        'time': format_time_ago(session['timestamp']),
+                        'title': f"Vehicle {event['plate_number']} entered at entry",
+                        'time': format_time_ago(event['timestamp']),
                         'icon': 'fa-car'
                     })
             
@@ -88,13 +168,13 @@ def api_recent_activity():
             return jsonify(activities)
         return jsonify([]), 500
     except Exception as e:
-        print(f"[API ERROR] Recent activity: {e}")
+        log.error("[API ERROR] Recent activity: %s", e)
         return jsonify([]), 500
 
 @app.route('/api/recent-sessions')
 def api_recent_sessions():
     try:
-        limit = int(request.args.get('limit', 20))
+        limit = limit_arg(20, MAX_RECENT)
         conn = connect_db()
         if conn:
             cursor = conn.cursor(dictionary=True)
@@ -110,9 +190,60 @@ def api_recent_sessions():
             return jsonify(sessions)
         return jsonify([]), 500
     except Exception as e:
-        print(f"[API ERROR] Recent sessions: {e}")
+        log.error("[API ERROR] Recent sessions: %s", e)
         return jsonify([]), 500
 
+@app.route('/api/sessions')
+def api_sessions():
+    """Session history search, newest first, one keyset page at a time.
+
+    Filters: plate (prefix), from/to (entry time), status (0/1/2), gate.
+    limit is capped at MAX_PAGE_SIZE; pass the returned 'next' as 'after' for
+    the following page. The page is streamed as it is read from the database.
+    """
+    try:
+        status = request.args.get('status')
+        if status is not None and status not in ('0', '1', '2'):
+            raise ValueError("status must be 0, 1 or 2")
+        gate = request.args.get('gate')
+        if gate and gate not in GATES:
+            raise ValueError(f"gate must be one of {', '.join(GATES)}")
+        after = request.args.get('after')
+        filters = {
+            'plate': request.args.get('plate', '').strip().upper() or None,
+            'since': date_arg('from'),
+            'until': date_arg('to'),
+            'status': int(status) if status is not None else None,
+            'gate': gate,
+            'after': decode_cursor(after) if after else None,
+        }
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    limit = limit_arg(50, MAX_PAGE_SIZE)
+    try:
+        rows = iter_sessions(limit=limit + 1, **filters)
+        first = next(rows, None)    # run the query now so a DB failure is still a clean 503
+    except Error as e:
+        log.error("[API ERROR] Session search: %s", e)
+        return jsonify({'error': 'history unavailable'}), 503
+
+    def generate():
+        yield '{"sessions": ['
+        last, count, more = None, 0, False
+        try:
+            for row in chain([first], rows) if first else ():
+                if count == limit:
+                    more = True
+                    break
+                yield (',' if count else '') + json.dumps(session_json(row))
+                last, count = row, count + 1
+        finally:
+            rows.close()
+        yield f'], "next": {json.dumps(encode_cursor(last) if more else None)}}}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
 @app.route('/api/active-vehicles')
 def api_active_vehicles():
     try:
@@ -120,17 +251,7 @@ def api_active_vehicles():
         if conn:
             cursor = conn.cursor()
             # Count vehicles that entered but haven't paid or exited
-            cursor.execute('''
-                SELECT COUNT(DISTINCT plate_number) as count
-                FROM parking_sessions ps1
-                WHERE payment_status = 0
-                AND NOT EXISTS (
-                    SELECT 1 FROM parking_sessions ps2
-                    WHERE ps2.plate_number = ps1.plate_number
-                    AND ps2.timestamp > ps1.timestamp
-                    AND ps2.payment_status IN (1, 2)
-                )
-            ''')
+            cursor.execute("SELECT COUNT(*) as count FROM current_sessions WHERE payment_status = 0")
             result = cursor.fetchone()
             count = result[0] if result else 0
             cursor.close()
@@ -138,7 +259,7 @@ def api_active_vehicles():
             return jsonify({'count': count})
         return jsonify({'count': 0}), 500
     except Exception as e:
-        print(f"[API ERROR] Active vehicles: {e}")
+        log.error("[API ERROR] Active vehicles: %s", e)
         return jsonify({'count': 0}), 500
 
 @app.route('/api/occupancy-rate')
@@ -150,17 +271,7 @@ def api_occupancy_rate():
         conn = connect_db()
         if conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                SELECT COUNT(DISTINCT plate_number) as occupied
-                FROM parking_sessions ps1
-                WHERE payment_status = 0
-                AND NOT EXISTS (
-                    SELECT 1 FROM parking_sessions ps2
-                    WHERE ps2.plate_number = ps1.plate_number
-                    AND ps2.timestamp > ps1.timestamp
-                    AND ps2.payment_status IN (1, 2)
-                )
-            ''')
+            cursor.execute("SELECT COUNT(*) as occupied FROM current_sessions WHERE payment_status = 0")
             result = cursor.fetchone()
             occupied = result[0] if result else 0
             rate = round((occupied / TOTAL_CAPACITY) * 100, 1) if TOTAL_CAPACITY > 0 else 0
@@ -169,7 +280,7 @@ def api_occupancy_rate():
             return jsonify({'rate': rate, 'occupied': occupied, 'capacity': TOTAL_CAPACITY})
         return jsonify({'rate': 0}), 500
     except Exception as e:
-        print(f"[API ERROR] Occupancy rate: {e}")
+        log.error("[API ERROR] Occupancy rate: %s", e)
         return jsonify({'rate': 0}), 500
 
 @app.route('/api/active-alerts')
@@ -181,8 +292,8 @@ def api_active_alerts():
             # Count unauthorized exits in the last 24 hours
             cursor.execute('''
                 SELECT COUNT(*) as count
-                FROM parking_sessions
-                WHERE gate = 'unauthorized'
+                FROM session_events
+                WHERE event = 'denied'
                 AND timestamp >= DATE_SUB(NOW(), INTERVAL 24 HOUR)
             ''')
             result = cursor.fetchone()
@@ -192,7 +303,7 @@ def api_active_alerts():
             return jsonify({'count': count})
         return jsonify({'count': 0}), 500
     except Exception as e:
-        print(f"[API ERROR] Active alerts: {e}")
+        log.error("[API ERROR] Active alerts: %s", e)
         return jsonify({'count': 0}), 500
 
 @app.route('/api/system-alerts')
@@ -206,8 +317,8 @@ def api_system_alerts():
             # Check for unauthorized exits in last 24 hours
             cursor.execute('''
                 SELECT plate_number, timestamp
-                FROM parking_sessions
-                WHERE gate = 'unauthorized'
+                FROM session_events
+                WHERE event = 'denied'
                 AND timestamp >= DATE_SUB(NOW(), INTERVAL 24 HOUR)
                 ORDER BY timestamp DESC
                 LIMIT 5
@@ -224,17 +335,11 @@ def api_system_alerts():
             
             # Check for vehicles parked too long (over 24 hours)
             cursor.execute('''
-                SELECT plate_number, timestamp
-                FROM parking_sessions ps1
+                SELECT plate_number, entered_at AS timestamp
+                FROM current_sessions
                 WHERE payment_status = 0
-                AND timestamp <= DATE_SUB(NOW(), INTERVAL 24 HOUR)
-                AND NOT EXISTS (
-                    SELECT 1 FROM parking_sessions ps2
-                    WHERE ps2.plate_number = ps1.plate_number
-                    AND ps2.timestamp > ps1.timestamp
-                    AND ps2.payment_status IN (1, 2)
-                )
-                ORDER BY timestamp ASC
+                AND entered_at <= DATE_SUB(NOW(), INTERVAL 24 HOUR)
+                ORDER BY entered_at ASC
                 LIMIT 3
             ''')
             long_parked = cursor.fetchall()
@@ -260,7 +365,7 @@ def api_system_alerts():
             
         return jsonify(alerts)
     except Exception as e:
-        print(f"[API ERROR] System alerts: {e}")
+        log.error("[API ERROR] System alerts: %s", e)
         return jsonify([{
             'type': 'info',
             'title': 'No active alerts',
@@ -279,7 +384,7 @@ def api_revenue_breakdown():
                     DATE(timestamp) as date,
                     SUM(amount) as daily_revenue
                 FROM parking_sessions
-                WHERE payment_status = 1 OR payment_status = 2
+                WHERE payment_status IN (1, 2)
                 AND timestamp >= DATE_SUB(NOW(), INTERVAL 7 DAY)
                 GROUP BY DATE(timestamp)
                 ORDER BY DATE(timestamp) DESC
@@ -300,7 +405,7 @@ def api_revenue_breakdown():
             return jsonify(breakdown)
         return jsonify({'Today': 0}), 500
     except Exception as e:
-        print(f"[API ERROR] Revenue breakdown: {e}")
+        log.error("[API ERROR] Revenue breakdown: %s", e)
         return jsonify({'Today': 0}), 500
 
 def format_time_ago(timestamp):
@@ -326,6 +431,7 @@ def format_time_ago(timestamp):
         return f"{days} day{'s' if days != 1 else ''} ago"
 
 if __name__ == '__main__':
+    setup_logging('web')
     # Ensure database table exists
     create_table_if_not_exists()
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
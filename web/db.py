@@ -1,7 +1,11 @@
 import mysql.connector
 from mysql.connector import Error
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
+from metrics import counter, histogram, time_function
+from applog import get_logger
+
+log = get_logger('web.db')
 
 DB_CONFIG = {
     'host': '127.0.0.1',
@@ -12,35 +16,108 @@ DB_CONFIG = {
     'use_pure': True
 }
 
-def connect_db():
+# History searches can point at a replica so they never compete with the gates;
+# None uses the primary.
+DB_READ_CONFIG = None
+HISTORY_MAX_MS = 5000       # server-side time limit for one history query
+HISTORY_CHUNK = 200
+
+# Secondary indexes on parking_sessions. A new table is created with them; an
+# existing one gets them from `python session_io.py migrate`, which first deals
+# with duplicate (plate, timestamp) rows the unique key would reject.
+SESSION_INDEXES = {
+    'uq_plate_timestamp': 'UNIQUE KEY uq_plate_timestamp (plate_number, timestamp)',
+    'idx_timestamp': 'KEY idx_timestamp (timestamp, id)',
+    'idx_status_timestamp': 'KEY idx_status_timestamp (payment_status, timestamp, id)',
+    'idx_gate_timestamp': 'KEY idx_gate_timestamp (gate, timestamp, id)',
+}
+
+# parking_sessions and session_events are RANGE partitioned by month of their
+# timestamp (the entry time of a visit, the time of an event). Gate queries name
+# the session's entry time so they touch one partition; archive.py moves closed
+# sessions out of old partitions and drops them once empty.
+PARTITIONED_TABLES = ('parking_sessions', 'session_events')
+PARTITIONS_AHEAD = 2        # empty monthly partitions kept ready after the current month
+PAYMENT_LOOKBACK_DAYS = 62  # mark_session_paid() looks in the recent partitions first
+
+DB_QUERY_SECONDS = histogram('anpr_db_query_seconds', "Duration of each web/db.py function, connect included",
+                             ['function'])
+DB_CONNECT_ERRORS = counter('anpr_db_connect_errors_total', "Failed database connections")
+timed_query = time_function(DB_QUERY_SECONDS)
+
+def connect_db(read_only=False):
     try:
+        if read_only and DB_READ_CONFIG:
+            return mysql.connector.connect(**DB_READ_CONFIG)
         return mysql.connector.connect(**DB_CONFIG)
     except Error as e:
-        print(f"[DB ERROR] Could not connect: {e}")
+        DB_CONNECT_ERRORS.inc()
+        log.error("[DB ERROR] Could not connect: %s", e)
         return None
 
 def create_table_if_not_exists():
     try:
         conn = connect_db()
         if conn is None:
-            print("[DB ERROR] Connection is None.")
+            log.error("[DB ERROR] Connection is None.")
             return
 
         cursor = conn.cursor()
         cursor.execute('''CREATE TABLE IF NOT EXISTS parking_sessions (
-            id INT AUTO_INCREMENT PRIMARY KEY,
+            id INT AUTO_INCREMENT,
             plate_number VARCHAR(10),
             payment_status TINYINT,
             amount DECIMAL(10, 2) DEFAULT 0.00,
-            timestamp DATETIME,
-            gate VARCHAR(20)
+            timestamp DATETIME NOT NULL,
+            gate VARCHAR(20),
+            PRIMARY KEY (id, timestamp),
+            ''' + ',\n            '.join(SESSION_INDEXES.values()) + '''
+        ) PARTITION BY RANGE (TO_DAYS(timestamp)) (PARTITION pmax VALUES LESS THAN MAXVALUE)''')
+        missing = missing_session_indexes(cursor)
+        if missing:
+            log.warning("[DB] parking_sessions lacks %s; run 'python session_io.py migrate'", ', '.join(missing))
+        cursor.execute('''CREATE TABLE IF NOT EXISTS session_events (
+            id BIGINT AUTO_INCREMENT,
+            session_id INT NULL,
+            plate_number VARCHAR(10),
+            event VARCHAR(10) NOT NULL,
+            amount DECIMAL(10, 2) DEFAULT 0.00,
+            timestamp DATETIME NOT NULL,
+            PRIMARY KEY (id, timestamp),
+            KEY idx_session (session_id, id),
+            KEY idx_plate (plate_number, id),
+            KEY idx_event_timestamp (event, timestamp)
+        ) PARTITION BY RANGE (TO_DAYS(timestamp)) (PARTITION pmax VALUES LESS THAN MAXVALUE)''')
+        for table in PARTITIONED_TABLES:
+            try:
+                ensure_partitions(cursor, table)
+            except Error as e:
+                log.error("[DB ERROR] Could not partition %s: %s", table, e)
+        cursor.execute('''CREATE TABLE IF NOT EXISTS current_sessions (
+            plate_number VARCHAR(10) PRIMARY KEY,
+            session_id INT NOT NULL,
+            payment_status TINYINT,
+            amount DECIMAL(10, 2) DEFAULT 0.00,
+            entered_at DATETIME,
+            updated_at DATETIME,
+            KEY idx_status_entered (payment_status, entered_at)
         )''')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS session_archive (
+            month CHAR(7) PRIMARY KEY,
+            sessions INT DEFAULT 0,
+            revenue DECIMAL(12, 2) DEFAULT 0.00,
+            alerts INT DEFAULT 0,
+            archived_at DATETIME
+        )''')
+        cursor.execute('SELECT 1 FROM current_sessions LIMIT 1')
+        if cursor.fetchone() is None:
+            sync_session_projections(cursor)
         conn.commit()
-        print("[DB] Table 'parking_sessions' ensured.")
+        log.info("[DB] Session tables ensured.")
     except Error as e:
-        print(f"[DB ERROR] Table creation failed: {e}")
+        log.error("[DB ERROR] Table creation failed: %s", e)
     except Exception as ex:
-        print(f"[ERROR] Unexpected error during table creation: {ex}")
+        log.error("[ERROR] Unexpected error during table creation: %s", ex)
     finally:
         try:
             cursor.close()
@@ -49,182 +126,457 @@ def create_table_if_not_exists():
             pass
 
 
+def missing_session_indexes(cursor):
+    """Names from SESSION_INDEXES that parking_sessions does not have yet"""
+    cursor.execute('''
+        SELECT DISTINCT index_name FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = 'parking_sessions'
+    ''')
+    existing = {row[0] for row in cursor.fetchall()}
+    return [name for name in SESSION_INDEXES if name not in existing]
+
+
+def duplicate_sessions(cursor):
+    """[(plate, timestamp, [ids])] of the rows uq_plate_timestamp would reject, lowest id first"""
+    cursor.execute('''
+        SELECT plate_number, timestamp, GROUP_CONCAT(id ORDER BY id) FROM parking_sessions
+        GROUP BY plate_number, timestamp HAVING COUNT(*) > 1
+    ''')
+    return [(plate, stamp, [int(i) for i in ids.split(',')]) for plate, stamp, ids in cursor.fetchall()]
+
+
+def migrate_session_indexes(remove_duplicates=False):
+    """Add the missing SESSION_INDEXES to an existing parking_sessions.
+
+    Duplicate (plate, timestamp) rows block the unique key: they are reported
+    and nothing is changed, unless remove_duplicates, which keeps the lowest id
+    of each group and points its events and current session at it. Returns
+    True when every index is in place.
+    """
+    conn = connect_db()
+    if not conn:
+        return False
+    cursor = conn.cursor()
+    try:
+        missing = missing_session_indexes(cursor)
+        if not missing:
+            log.info("[DB] parking_sessions already has every index")
+            return True
+        if 'uq_plate_timestamp' in missing:
+            duplicates = duplicate_sessions(cursor)
+            if duplicates and not remove_duplicates:
+                for plate, stamp, ids in duplicates[:20]:
+                    log.warning("[DB] Duplicate session %s at %s: ids %s", plate, stamp, ids)
+                log.error("[DB] %s duplicate (plate, timestamp) groups block uq_plate_timestamp; "
+                          "re-run with --remove-duplicates to keep the lowest id of each", len(duplicates))
+                return False
+            for plate, stamp, ids in duplicates:
+                keep, drop = ids[0], ids[1:]
+                marks = ', '.join(['%s'] * len(drop))
+                cursor.execute(f'UPDATE session_events SET session_id = %s WHERE session_id IN ({marks})', [keep] + drop)
+                cursor.execute(f'UPDATE current_sessions SET session_id = %s WHERE session_id IN ({marks})',
+                               [keep] + drop)
+                cursor.execute(f'DELETE FROM parking_sessions WHERE timestamp = %s AND id IN ({marks})', [stamp] + drop)
+            if duplicates:
+                conn.commit()
+                log.info("[DB] Removed the duplicates of %s sessions", len(duplicates))
+        for name in missing:
+            log.info("[DB] Adding index %s to parking_sessions", name)
+            cursor.execute(f"ALTER TABLE parking_sessions ADD {SESSION_INDEXES[name]}")
+        return True
+    except Error as e:
+        conn.rollback()
+        log.error("[DB ERROR] Index migration failed: %s", e)
+        return False
+    finally:
+        cursor.close()
+        conn.close()
+
+
+# ---------- session events ----------
+# Every step of a visit is appended to session_events; parking_sessions (one row
+# per visit, the history and the dashboard read it) and current_sessions (the
+# latest visit of each plate, what the gates ask about) are projections of it,
+# updated by primary key in the same transaction as the append.
+SESSION_EVENTS = ('entry', 'payment', 'exit', 'denied')
+
+
+def append_session_event(cursor, event, plate_number, session_id=None, amount=0.00, at=None, entered_at=None):
+    """Append one event and apply it to the projections; the caller commits.
+
+    entered_at is the session's entry time, which picks its partition. Returns
+    the session id (a new one for 'entry'), or None when the session was not in
+    the state the event needs (already paid, not paid, ...), in which case
+    nothing is written.
+    """
+    if event not in SESSION_EVENTS:
+        raise ValueError(f"Unknown session event {event!r}")
+    at = at or time.strftime('%Y-%m-%d %H:%M:%S')
+    if event == 'entry':
+        cursor.execute('''
+            INSERT INTO parking_sessions (plate_number, payment_status, amount, timestamp, gate)
+            VALUES (%s, 0, %s, %s, 'entry')
+        ''', (plate_number, amount, at))
+        session_id = cursor.lastrowid
+        cursor.execute('''
+            INSERT INTO current_sessions (plate_number, session_id, payment_status, amount, entered_at, updated_at)
+            VALUES (%s, %s, 0, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE session_id = VALUES(session_id), payment_status = 0, amount = VALUES(amount),
+                                    entered_at = VALUES(entered_at), updated_at = VALUES(updated_at)
+        ''', (plate_number, session_id, amount, at, at))
+    elif event == 'payment':
+        cursor.execute('''
+            UPDATE parking_sessions SET payment_status = 1, amount = %s
+            WHERE id = %s AND timestamp = %s AND payment_status = 0
+        ''', (amount, session_id, entered_at))
+        if cursor.rowcount != 1:
+            return None
+        cursor.execute('''
+            UPDATE current_sessions SET payment_status = 1, amount = %s, updated_at = %s
+            WHERE plate_number = %s AND session_id = %s
+        ''', (amount, at, plate_number, session_id))
+    elif event == 'exit':
+        cursor.execute('''
+            UPDATE parking_sessions SET payment_status = 2, gate = 'exit'
+            WHERE id = %s AND timestamp = %s AND payment_status = 1
+        ''', (session_id, entered_at))
+        if cursor.rowcount != 1:
+            return None
+        cursor.execute('''
+            UPDATE current_sessions SET payment_status = 2, updated_at = %s
+            WHERE plate_number = %s AND session_id = %s
+        ''', (at, plate_number, session_id))
+    elif session_id is not None:
+        cursor.execute("UPDATE parking_sessions SET gate = 'unauthorized' WHERE id = %s AND timestamp = %s",
+                       (session_id, entered_at))
+    cursor.execute('''
+        INSERT INTO session_events (session_id, plate_number, event, amount, timestamp)
+        VALUES (%s, %s, %s, %s, %s)
+    ''', (session_id, plate_number, event, amount, at))
+    return session_id
+
+
+def current_session(cursor, plate_number, payment_status=None, lock=False):
+    """(session id, payment status, entry time) of the plate's latest visit, or None"""
+    query = 'SELECT session_id, payment_status, entered_at FROM current_sessions WHERE plate_number = %s'
+    params = [plate_number]
+    if payment_status is not None:
+        query += ' AND payment_status = %s'
+        params.append(payment_status)
+    cursor.execute(query + (' FOR UPDATE' if lock else ''), params)
+    return cursor.fetchone()
+
+
+def record_plate_event(event, plate_number, from_status=None, amount=0.00):
+    """Append event to the plate's current session (if it is in from_status) in one transaction"""
+    conn = connect_db()
+    if not conn:
+        return None
+    cursor = conn.cursor()
+    try:
+        conn.start_transaction()
+        session = current_session(cursor, plate_number, from_status, lock=True)
+        if session is None and event != 'denied':
+            conn.rollback()
+            return None
+        session_id, entered_at = (session[0], session[2]) if session else (None, None)
+        session_id = append_session_event(cursor, event, plate_number, session_id, amount, entered_at=entered_at)
+        conn.commit()
+        return session_id
+    except Error as e:
+        conn.rollback()
+        log.error("[DB ERROR] Could not record %s for %s: %s", event, plate_number, e)
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def sync_session_projections(cursor):
+    """Give sessions written straight to parking_sessions their events, and rebuild current_sessions.
+
+    For rows from before session_events existed, or backfilled by session_io,
+    every event is stamped with the session's entry time, the only one known.
+    Safe to run again; the caller commits.
+    """
+    cursor.execute('''
+        INSERT INTO session_events (session_id, plate_number, event, amount, timestamp)
+        SELECT ps.id, ps.plate_number, e.event, IF(e.event = 'payment', ps.amount, 0.00), ps.timestamp
+        FROM parking_sessions ps
+        JOIN (SELECT 'entry' AS event, 0 AS ord UNION ALL SELECT 'payment', 1
+              UNION ALL SELECT 'exit', 2 UNION ALL SELECT 'denied', 3) e
+          ON e.event = 'entry'
+          OR (e.event = 'payment' AND ps.payment_status >= 1)
+          OR (e.event = 'exit' AND ps.payment_status = 2)
+          OR (e.event = 'denied' AND ps.gate = 'unauthorized')
+        WHERE NOT EXISTS (SELECT 1 FROM session_events se WHERE se.session_id = ps.id)
+        ORDER BY ps.id, e.ord
+    ''')
+    backfilled = cursor.rowcount
+    cursor.execute('DELETE FROM current_sessions')
+    cursor.execute('''
+        INSERT INTO current_sessions (plate_number, session_id, payment_status, amount, entered_at, updated_at)
+        SELECT ps.plate_number, ps.id, ps.payment_status, ps.amount, ps.timestamp, ps.timestamp
+        FROM parking_sessions ps
+        JOIN (
+            SELECT plate_number, MAX(timestamp) AS latest
+            FROM parking_sessions
+            GROUP BY plate_number
+        ) last ON last.plate_number = ps.plate_number AND last.latest = ps.timestamp
+    ''')
+    log.info("[DB] Session projections rebuilt (%s events backfilled, %s plates)", backfilled, cursor.rowcount)
+
+
+def month_start(moment):
+    return datetime(moment.year, moment.month, 1)
+
+
+def add_months(month, n):
+    index = month.year * 12 + month.month - 1 + n
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"p{month:%Y%m}"
+
+
+def partition_definitions(first, last, catch_all=True):
+    """Monthly partitions from first through last, then the catch-all pmax"""
+    definitions = []
+    month = first
+    while month <= last:
+        definitions.append(f"PARTITION {partition_name(month)} "
+                           f"VALUES LESS THAN (TO_DAYS('{add_months(month, 1):%Y-%m-%d}'))")
+        month = add_months(month, 1)
+    return definitions + (['PARTITION pmax VALUES LESS THAN MAXVALUE'] if catch_all else [])
+
+
+def ensure_partitions(cursor, table, ahead=PARTITIONS_AHEAD, oldest=None, rewrite=False):
+    """Keep `ahead` future months of table ready as partitions of their own.
+
+    Without rewrite (process startup) this only ever splits new months off an
+    empty pmax, which is instant; an unpartitioned table or rows in pmax are
+    reported instead. rewrite (session_io.py migrate and import, archive.py)
+    also converts a table from before partitioning, splits a pmax that holds
+    rows, and with oldest splits the months back to that time off the first
+    partition; those copy rows. Returns False when the table is left unpartitioned.
+    """
+    cursor.execute('''
+        SELECT partition_name FROM information_schema.partitions
+        WHERE table_schema = DATABASE() AND table_name = %s AND partition_name IS NOT NULL
+    ''', (table,))
+    names = [name for (name,) in cursor.fetchall()]
+    months = sorted(name for name in names if name != 'pmax')
+    now = datetime.now()
+    last = add_months(month_start(now), ahead)
+    if not names:
+        if not rewrite:
+            log.warning("[DB] %s is not partitioned; run 'python session_io.py migrate'", table)
+            return False
+        cursor.execute(f"SELECT MIN(timestamp) FROM {table}")
+        first = month_start(min(t for t in (cursor.fetchone()[0], oldest, now) if t))
+        definitions = ', '.join(partition_definitions(first, last))
+        log.info("[DB] Partitioning %s by month from %s; this rewrites the table once", table, first.strftime('%Y-%m'))
+        cursor.execute(f"ALTER TABLE {table} DROP PRIMARY KEY, ADD PRIMARY KEY (id, timestamp) "
+                       f"PARTITION BY RANGE (TO_DAYS(timestamp)) ({definitions})")
+        return True
+
+    if months and oldest and rewrite and month_start(oldest) < datetime.strptime(months[0], 'p%Y%m'):
+        head = datetime.strptime(months[0], 'p%Y%m')
+        log.info("[DB] Adding partitions to %s back to %s", table, oldest.strftime('%Y-%m'))
+        definitions = ', '.join(partition_definitions(month_start(oldest), head, catch_all=False))
+        cursor.execute(f"ALTER TABLE {table} REORGANIZE PARTITION {months[0]} INTO ({definitions})")
+
+    if months:
+        first = add_months(datetime.strptime(months[-1], 'p%Y%m'), 1)
+    else:
+        first = month_start(min(oldest, now) if oldest else now)
+    if first > last or 'pmax' not in names:
+        return True
+    cursor.execute(f"SELECT MIN(timestamp) FROM {table} PARTITION (pmax)")
+    held = cursor.fetchone()[0]
+    if held is not None:
+        if not rewrite:
+            log.warning("[DB] %s has rows in pmax; run 'python archive.py run' to split them into months", table)
+            return True
+        first = min(first, month_start(held))
+    log.info("[DB] Adding partitions to %s up to %s", table, last.strftime('%Y-%m'))
+    definitions = ', '.join(partition_definitions(first, last))
+    cursor.execute(f"ALTER TABLE {table} REORGANIZE PARTITION pmax INTO ({definitions})")
+    return True
+
+
+def migrate_partitions():
+    """Convert parking_sessions and session_events to monthly partitions if they predate them"""
+    conn = connect_db()
+    if not conn:
+        return False
+    cursor = conn.cursor()
+    try:
+        return all([ensure_partitions(cursor, table, rewrite=True) for table in PARTITIONED_TABLES])
+    except Error as e:
+        log.error("[DB ERROR] Partitioning failed: %s", e)
+        return False
+    finally:
+        cursor.close()
+        conn.close()
+
+
+@timed_query
 def log_plate_to_db(plate_number, payment_status=0, amount=0.00, gate="entry"):
+    """Open a new session for the plate (its entry event).
+
+    A session always opens unpaid; payment_status is kept for the old callers.
+    """
     conn = connect_db()
     if conn:
         try:
             cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO parking_sessions (plate_number, payment_status, amount, timestamp, gate)
-                VALUES (%s, %s, %s, %s, %s)
-            ''', (plate_number, payment_status, amount, time.strftime('%Y-%m-%d %H:%M:%S'), gate))
+            conn.start_transaction()
+            session_id = append_session_event(cursor, 'entry', plate_number, amount=amount)
             conn.commit()
-            print(f"[DB] Logged to DB: {plate_number}, {payment_status}, {amount}, {gate}")
+            log.info("[DB] Logged to DB: %s, session %s, %s", plate_number, session_id, gate)
         except Error as e:
-            print(f"[DB ERROR] Insert failed: {e}")
+            conn.rollback()
+            log.error("[DB ERROR] Insert failed: %s", e)
         finally:
             cursor.close()
             conn.close()
 
-def plate_exists_unpaid(plate_number):
+def plate_status(plate_number):
+    """Payment status of the plate's latest session, or None if it never entered"""
     conn = connect_db()
     if conn:
         try:
             cursor = conn.cursor()
-            cursor.execute('''
-                SELECT id FROM parking_sessions
-                WHERE plate_number = %s AND payment_status = 0
-                ORDER BY timestamp DESC
-                LIMIT 1
-            ''', (plate_number,))
-            return cursor.fetchone() is not None
+            session = current_session(cursor, plate_number)
+            return session[1] if session else None
         except Error as e:
-            print(f"[DB ERROR] Query failed: {e}")
-            return False
+            log.error("[DB ERROR] Query failed: %s", e)
+            return None
         finally:
             cursor.close()
             conn.close()
+    return None
 
+@timed_query
+def plate_exists_unpaid(plate_number):
+    return plate_status(plate_number) == 0
+
+@timed_query
 def is_payment_complete_db(plate_number):
-    conn = connect_db()
-    if conn:
-        try:
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute('''
-                SELECT payment_status FROM parking_sessions
-                WHERE plate_number = %s
-                ORDER BY timestamp DESC
-                LIMIT 1
-            ''', (plate_number,))
-            result = cursor.fetchone()
-            return result and result["payment_status"] == 1
-        except Error as e:
-            print(f"[DB ERROR] is_payment_complete: {e}")
-            return False
-        finally:
-            cursor.close()
-            conn.close()
-    return False
+    return plate_status(plate_number) == 1
 
+@timed_query
 def is_already_exited(plate_number):
-    conn = connect_db()
-    if conn:
-        try:
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute('''
-                SELECT payment_status FROM parking_sessions
-                WHERE plate_number = %s
-                ORDER BY timestamp DESC
-                LIMIT 1
-            ''', (plate_number,))
-            result = cursor.fetchone()
-            return result and result["payment_status"] == 2
-        except Error as e:
-            print(f"[DB ERROR] is_payment_complete: {e}")
-            return False
-        finally:
-            cursor.close()
-            conn.close()
-    return False
+    return plate_status(plate_number) == 2
 
+@timed_query
+def plate_is_known(plate_number):
+    """True if the plate has any session, open or closed"""
+    return plate_status(plate_number) is not None
+
+@timed_query
 def update_exit_status_db(plate_number):
-    conn = connect_db()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE parking_sessions
-                SET payment_status = 2, gate = 'exit'
-                WHERE plate_number = %s AND payment_status = 1
-                ORDER BY timestamp DESC
-                LIMIT 1
-            ''', (plate_number,))
-            conn.commit()
-            print(f"[DB] Exit status updated for {plate_number}")
-        except Error as e:
-            print(f"[DB ERROR] Exit status update failed: {e}")
-        finally:
-            cursor.close()
-            conn.close()
+    if record_plate_event('exit', plate_number, from_status=1) is not None:
+        log.info("[DB] Exit status updated for %s", plate_number)
 
+@timed_query
 def get_latest_unpaid_entry(plate_number):
+    session = get_latest_unpaid_session(plate_number)
+    return session[1] if session else None
+
+
+@timed_query
+def update_payment_status_db(plate_number, amount_paid):
+    if record_plate_event('payment', plate_number, from_status=0, amount=amount_paid) is not None:
+        log.info("[DB] Payment updated for %s with %s RWF", plate_number, amount_paid)
+
+
+@timed_query
+def get_latest_unpaid_session(plate_number):
+    """Return (session id, entry time) of the latest unpaid session, or None"""
     conn = connect_db()
     if conn:
         try:
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute('''
-                SELECT timestamp FROM parking_sessions
-                WHERE plate_number = %s AND payment_status = 0
-                ORDER BY timestamp DESC
-                LIMIT 1
-            ''', (plate_number,))
-            result = cursor.fetchone()
-            if result:
-                return datetime.strptime(str(result['timestamp']), "%Y-%m-%d %H:%M:%S")
+            cursor = conn.cursor()
+            session = current_session(cursor, plate_number, payment_status=0)
+            if session:
+                return session[0], datetime.strptime(str(session[2]), "%Y-%m-%d %H:%M:%S")
             return None
         except Error as e:
-            print(f"[DB ERROR] Failed to fetch unpaid entry: {e}")
+            log.error("[DB ERROR] Failed to fetch unpaid session: %s", e)
             return None
         finally:
             cursor.close()
             conn.close()
 
 
-def update_payment_status_db(plate_number, amount_paid):
+@timed_query
+def mark_session_paid(session_id, amount_paid):
+    """Mark one session paid. True when it is paid afterwards, so replaying is safe"""
     conn = connect_db()
     if conn:
         try:
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE parking_sessions
-                SET payment_status = 1, amount = %s
-                WHERE plate_number = %s AND payment_status = 0
-                ORDER BY timestamp DESC
-                LIMIT 1
-            ''', (amount_paid, plate_number))
+            cursor = conn.cursor(dictionary=True)
+            conn.start_transaction()
+            # Ledger replays are for recent sessions; only search every partition if not found there
+            recent = datetime.now() - timedelta(days=PAYMENT_LOOKBACK_DAYS)
+            for bounded in (True, False):
+                cursor.execute('SELECT plate_number, payment_status, timestamp FROM parking_sessions WHERE id = %s'
+                               + (' AND timestamp >= %s' if bounded else '') + ' FOR UPDATE',
+                               (session_id, recent) if bounded else (session_id,))
+                session = cursor.fetchone()
+                if session is not None:
+                    break
+            if session is None:
+                conn.rollback()
+                return False
+            if session['payment_status'] != 0:
+                conn.rollback()
+                return session['payment_status'] in (1, 2)
+            append_session_event(cursor, 'payment', session['plate_number'], session_id, amount_paid,
+                                 entered_at=session['timestamp'])
             conn.commit()
-            print(f"[DB] Payment updated for {plate_number} with {amount_paid} RWF")
+            log.info("[DB] Session %s paid with %s RWF", session_id, amount_paid)
+            return True
         except Error as e:
-            print(f"[DB ERROR] Failed to update payment: {e}")
+            conn.rollback()
+            log.error("[DB ERROR] Failed to mark session %s paid: %s", session_id, e)
+            return False
         finally:
             cursor.close()
             conn.close()
+    return False
 
 
+@timed_query
 def log_unauthorized_exit(plate_number):
-    """Log a gate tampering or unpaid exit event"""
-    conn = connect_db()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE parking_sessions SET gate = 'unauthorized'
-                WHERE plate_number = %s AND payment_status = 0
-                ''', (plate_number,))
-            conn.commit()
-            print(f"[DB] Logged to DB tampering: {plate_number}")
-        except Error as e:
-            print(f"[DB ERROR] UPDATE failed: {e}")
-        finally:
-            cursor.close()
-            conn.close()
+    """Log a gate tampering or unpaid exit event against the plate's unpaid session"""
+    record_plate_event('denied', plate_number, from_status=0)
+    log.info("[DB] Logged to DB tampering: %s", plate_number)
 
 
+@timed_query
 def get_total_revenue():
     conn = connect_db()
     if conn:
         try:
             cursor = conn.cursor()
-            cursor.execute("SELECT SUM(amount) FROM parking_sessions WHERE payment_status = 1 OR payment_status = 2")
+            cursor.execute('''
+                SELECT (SELECT COALESCE(SUM(amount), 0) FROM parking_sessions WHERE payment_status IN (1, 2))
+                     + (SELECT COALESCE(SUM(revenue), 0) FROM session_archive)
+            ''')
             result = cursor.fetchone()
             return result[0] if result[0] else 0.0
         except Error as e:
-            print(f"[DB ERROR] Revenue query failed: {e}")
+            log.error("[DB ERROR] Revenue query failed: %s", e)
             return 0.0
         finally:
             cursor.close()
             conn.close()
 
+@timed_query
 def get_daily_stats():
     conn = connect_db()
     if conn:
@@ -237,14 +589,91 @@ def get_daily_stats():
                        SUM(CASE WHEN payment_status = 0 THEN 1 ELSE 0 END) AS unpaid_count,
                        SUM(CASE WHEN gate = 'unauthorized' THEN 1 ELSE 0 END) AS alerts
                 FROM parking_sessions
+                WHERE timestamp >= DATE_SUB(CURDATE(), INTERVAL 30 DAY)
                 GROUP BY DATE(timestamp)
                 ORDER BY DATE(timestamp) DESC
                 LIMIT 7
             ''')
             return cursor.fetchall()
         except Error as e:
-            print(f"[DB ERROR] Daily stats query failed: {e}")
+            log.error("[DB ERROR] Daily stats query failed: %s", e)
             return []
         finally:
             cursor.close()
             conn.close()
+
+
+@timed_query
+def get_open_plates():
+    """Plates whose latest session is an entry that has not exited yet"""
+    conn = connect_db()
+    if conn:
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT plate_number FROM current_sessions WHERE payment_status IN (0, 1)')
+            return [row[0] for row in cursor.fetchall()]
+        except Error as e:
+            log.error("[DB ERROR] Open plates query failed: %s", e)
+            return []
+        finally:
+            cursor.close()
+            conn.close()
+    return []
+
+
+@timed_query
+def iter_sessions(plate=None, since=None, until=None, status=None, gate=None, after=None, limit=50):
+    """Yield up to limit session rows, newest first, for the history search.
+
+    Keyset pagination: after is the (timestamp, id) of the last row of the
+    previous page, so every page is an index range scan on idx_timestamp (or
+    the status/gate/plate index) instead of an OFFSET over the whole table.
+    plate matches as a prefix. Rows are fetched in chunks from an unbuffered
+    cursor so large pages are never held in memory at once.
+    """
+    conditions, params = [], []
+    if plate:
+        conditions.append("plate_number LIKE %s")
+        params.append(plate.replace('%', '').replace('_', '') + '%')
+    if since:
+        conditions.append("timestamp >= %s")
+        params.append(since)
+    if until:
+        conditions.append("timestamp < %s")
+        params.append(until)
+    if status is not None:
+        conditions.append("payment_status = %s")
+        params.append(status)
+    if gate:
+        conditions.append("gate = %s")
+        params.append(gate)
+    if after:
+        conditions.append("(timestamp < %s OR (timestamp = %s AND id < %s))")
+        params.extend([after[0], after[0], after[1]])
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    conn = connect_db(read_only=True)
+    if not conn:
+        raise Error("history database unavailable")
+    cursor = conn.cursor(dictionary=True, buffered=False)
+    try:
+        cursor.execute(f'''
+            SELECT /*+ MAX_EXECUTION_TIME({int(HISTORY_MAX_MS)}) */
+                   id, plate_number, payment_status, amount, timestamp, gate
+            FROM parking_sessions
+            {where}
+            ORDER BY timestamp DESC, id DESC
+            LIMIT %s
+        ''', params + [limit])
+        while True:
+            rows = cursor.fetchmany(HISTORY_CHUNK)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        try:
+            cursor.fetchall()  # drain so the connection can close cleanly
+        except Error:
+            pass
+        cursor.close()
+        conn.close()
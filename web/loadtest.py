@@ -0,0 +1,183 @@
+"""Load test the dashboard with the polling pattern of static/dashboard.js.
+
+    python loadtest.py --dashboards 50 --duration 60
+    python loadtest.py http://10.0.0.5:5000 --dashboards 200 --speedup 60 --no-gzip
+
+Each simulated dashboard keeps one HTTP/1.1 connection open, as a browser
+does, and behaves like an open tab:
+
+    page load   /, styles.css and dashboard.js (the fingerprinted URLs from the
+                page), then fetchAllData(): every API call below
+    every 30 s  revenue, recent-activity, system-alerts, active-vehicles,
+                occupancy-rate, active-alerts
+    every 5 min daily-stats, revenue-breakdown
+
+--speedup divides those intervals so a minute of testing covers an hour of
+tabs; --reload-every makes a share of the tabs reload the page, which is where
+cached static files pay off. Requests/sec, latency percentiles and bytes
+transferred are reported per endpoint.
+"""
+import argparse
+import gzip
+import http.client
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+import numpy as np
+
+POLL_SECONDS = 30
+STATS_SECONDS = 300
+
+POLL = ['/api/revenue', '/api/recent-activity', '/api/system-alerts',
+        '/api/active-vehicles', '/api/occupancy-rate', '/api/active-alerts']
+STATS = ['/api/daily-stats?period=7d', '/api/revenue-breakdown']
+STATIC_URL = re.compile(r'''(?:href|src)="(/static/[^"]+)"''')
+
+
+class Results:
+    """Latency samples, bytes and errors per endpoint, shared by all dashboards"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = defaultdict(list)
+        self.bytes = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.not_modified = 0
+
+    def add(self, endpoint, seconds, size, status):
+        with self.lock:
+            self.latency[endpoint].append(seconds)
+            self.bytes[endpoint] += size
+            if status == 304:
+                self.not_modified += 1
+            elif status >= 400:
+                self.errors[endpoint] += 1
+
+    def error(self, endpoint):
+        with self.lock:
+            self.errors[endpoint] += 1
+
+
+class Dashboard(threading.Thread):
+    """One open dashboard tab"""
+
+    def __init__(self, base_url, results, until, speedup, use_gzip, reload_every):
+        super().__init__(daemon=True)
+        parts = urlsplit(base_url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.results = results
+        self.until = until
+        self.speedup = speedup
+        self.headers = {'Accept-Encoding': 'gzip'} if use_gzip else {}
+        self.reload_every = reload_every
+        self.cache = {}             # static path -> last URL, ETag and Cache-Control, like the browser cache
+        self.conn = None
+
+    def get(self, path, endpoint=None, headers=None):
+        endpoint = endpoint or path.split('?')[0]
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            start = time.perf_counter()
+            try:
+                self.conn.request('GET', path, headers={**self.headers, **(headers or {})})
+                response = self.conn.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException):
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    self.results.error(endpoint)
+                continue
+            self.results.add(endpoint, time.perf_counter() - start, len(body), response.status)
+            if response.getheader('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            if response.getheader('Connection', '').lower() == 'close':
+                self.conn.close()
+                self.conn = None
+            return response, body
+        return None, b''
+
+    def load_page(self):
+        response, body = self.get('/')
+        for url in STATIC_URL.findall(body.decode('utf-8', 'replace')):
+            path = url.split('?')[0]
+            if 'immutable' in self.cache.get(path, {}).get('cache', '') and self.cache[path]['url'] == url:
+                continue  # fingerprint unchanged: the browser doesn't even ask
+            etag = self.cache.get(path, {}).get('etag')
+            response, _ = self.get(url, endpoint=path, headers={'If-None-Match': etag} if etag else None)
+            if response is not None and response.status in (200, 304):
+                self.cache[path] = {'url': url, 'etag': response.getheader('ETag') or etag,
+                                    'cache': response.getheader('Cache-Control', '')}
+        for path in POLL + STATS:
+            self.get(path)
+
+    def run(self):
+        poll_every = POLL_SECONDS / self.speedup
+        stats_every = STATS_SECONDS / self.speedup
+        # Tabs were opened at different times
+        time.sleep(random.uniform(0, poll_every))
+        self.load_page()
+        now = time.time()
+        next_poll, next_stats = now + poll_every, now + stats_every
+        next_reload = now + self.reload_every / self.speedup if self.reload_every else None
+        while True:
+            wake = min(t for t in (next_poll, next_stats, next_reload) if t)
+            if wake >= self.until:
+                break
+            time.sleep(max(0, wake - time.time()))
+            if next_reload and time.time() >= next_reload:
+                self.load_page()
+                next_reload += self.reload_every / self.speedup
+                continue
+            if time.time() >= next_poll:
+                for path in POLL:
+                    self.get(path)
+                next_poll += poll_every
+            if time.time() >= next_stats:
+                for path in STATS:
+                    self.get(path)
+                next_stats += stats_every
+        if self.conn:
+            self.conn.close()
+
+
+def report(results, elapsed, dashboards):
+    total = sum(len(v) for v in results.latency.values())
+    errors = sum(results.errors.values())
+    print(f"\n[LOADTEST] {dashboards} dashboards, {elapsed:.1f} s: {total} requests, "
+          f"{total / elapsed:.1f} req/s, {errors} errors, {results.not_modified} not modified")
+    print(f"{'endpoint':<28}{'count':>8}{'req/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'max ms':>9}{'avg KB':>9}{'errors':>8}")
+    for endpoint in sorted(results.latency, key=lambda e: -len(results.latency[e])):
+        samples = np.array(results.latency[endpoint]) * 1000
+        print(f"{endpoint:<28}{len(samples):>8}{len(samples) / elapsed:>8.1f}"
+              f"{np.percentile(samples, 50):>9.1f}{np.percentile(samples, 95):>9.1f}{samples.max():>9.1f}"
+              f"{results.bytes[endpoint] / len(samples) / 1024:>9.1f}{results.errors[endpoint]:>8}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulate many open dashboards polling the web app")
+    parser.add_argument('url', nargs='?', default='http://127.0.0.1:5000')
+    parser.add_argument('--dashboards', type=int, default=50, help="concurrent open tabs")
+    parser.add_argument('--duration', type=float, default=60, help="seconds to run")
+    parser.add_argument('--speedup', type=float, default=30, help="divide the dashboard's poll intervals by this")
+    parser.add_argument('--reload-every', type=float, default=600,
+                        help="dashboard seconds between page reloads per tab, 0 for never")
+    parser.add_argument('--no-gzip', action='store_true', help="don't send Accept-Encoding: gzip")
+    args = parser.parse_args()
+
+    results = Results()
+    start = time.time()
+    tabs = [Dashboard(args.url, results, start + args.duration, args.speedup,
+                      not args.no_gzip, args.reload_every)
+            for _ in range(args.dashboards)]
+    print(f"[LOADTEST] {args.dashboards} dashboards against {args.url} for {args.duration:.0f} s "
+          f"(polling every {POLL_SECONDS / args.speedup:.1f} s)")
+    for tab in tabs:
+        tab.start()
+    for tab in tabs:
+        tab.join()
+    report(results, time.time() - start, args.dashboards)
@@ -0,0 +1,214 @@
+"""Production entry point for the dashboard.
+
+    python serve.py                         # gunicorn on Linux, waitress on Windows
+    python serve.py --workers 4 --threads 8 --port 8000
+    gunicorn -k gthread -w 2 --threads 8 serve:app   # or any WSGI server, from web/
+
+app.py's own __main__ is Flask's single-threaded debug server with the
+reloader; this wraps the same app for real traffic:
+
+- gunicorn runs WORKERS processes of THREADS threads each (gthread worker).
+  `kill -HUP <master pid>` is a graceful reload: new workers start with the
+  new code and fingerprints, old ones finish their requests and exit. Workers
+  are also recycled every MAX_REQUESTS requests.
+- waitress (pip install waitress) is used where gunicorn isn't available; it
+  is one process with THREADS threads, and a reload is a restart.
+- JSON and text responses larger than GZIP_MIN_SIZE are gzipped when the
+  client accepts it, streamed ones (/api/sessions) chunk by chunk.
+- Static files are read and gzipped once at startup. url_for('static', ...)
+  adds ?v=<content hash>, so dashboard.js and styles.css can be cached for a
+  year and a deploy still reaches every browser on its next page load.
+"""
+import argparse
+import gzip
+import hashlib
+import importlib.util
+import mimetypes
+import os
+import sys
+import zlib
+from flask import request, Response
+from app import app, create_table_if_not_exists
+from applog import get_logger, setup as setup_logging, shutdown as flush_logging
+
+log = get_logger('web.serve')
+
+# Configuration
+HOST = '0.0.0.0'
+PORT = 5000
+WORKERS = 2
+THREADS = 8
+TIMEOUT = 60                # seconds a gunicorn worker may spend on one request
+GRACEFUL_TIMEOUT = 30       # seconds old workers get to finish on reload/stop
+MAX_REQUESTS = 5000         # recycle a worker after this many requests (+ jitter)
+GZIP_MIN_SIZE = 500         # bytes; smaller bodies aren't worth compressing
+GZIP_LEVEL = 6
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+COMPRESSIBLE = ('application/json', 'text/html', 'text/css', 'text/plain',
+                'text/csv', 'application/javascript', 'text/javascript')
+
+
+def accepts_gzip():
+    return 'gzip' in request.headers.get('Accept-Encoding', '')
+
+
+def gzip_stream(chunks, level=GZIP_LEVEL):
+    """Gzip a streamed body without buffering it"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class StaticAssets:
+    """Content hash and precompressed bytes of every file under the static folder"""
+
+    def __init__(self, folder):
+        self.files = {}
+        for root, _, names in os.walk(folder):
+            for name in names:
+                path = os.path.join(root, name)
+                with open(path, 'rb') as f:
+                    data = f.read()
+                filename = os.path.relpath(path, folder).replace(os.sep, '/')
+                self.files[filename] = {
+                    'version': hashlib.sha256(data).hexdigest()[:12],
+                    'data': data,
+                    'gzipped': gzip.compress(data, GZIP_LEVEL, mtime=0),
+                }
+        log.info("[SERVE] Fingerprinted %s static file(s)", len(self.files))
+
+    def version(self, filename):
+        asset = self.files.get(filename)
+        return asset['version'] if asset else None
+
+    def response(self, filename):
+        """Serve an asset from memory, or None to fall through to Flask's static view"""
+        asset = self.files.get(filename)
+        if asset is None:
+            return None
+        compressed = accepts_gzip() and len(asset['gzipped']) < len(asset['data'])
+        response = Response(asset['gzipped'] if compressed else asset['data'],
+                            mimetype=guess_mimetype(filename))
+        if compressed:
+            response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+        response.set_etag(asset['version'] + ('-gz' if compressed else ''))
+        if request.args.get('v') == asset['version']:
+            response.headers['Cache-Control'] = f'public, max-age={STATIC_MAX_AGE}, immutable'
+        else:
+            response.headers['Cache-Control'] = 'no-cache'  # unversioned URL: revalidate by ETag
+        return response.make_conditional(request)
+
+
+def guess_mimetype(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def install_static_fingerprints(flask_app):
+    assets = StaticAssets(flask_app.static_folder)
+
+    @flask_app.url_defaults
+    def add_fingerprint(endpoint, values):
+        if endpoint == 'static' and 'v' not in values:
+            version = assets.version(values.get('filename'))
+            if version:
+                values['v'] = version
+
+    @flask_app.before_request
+    def serve_static_from_memory():
+        if request.endpoint == 'static':
+            return assets.response(request.view_args['filename'])
+
+    return assets
+
+
+def install_gzip(flask_app):
+    @flask_app.after_request
+    def compress(response):
+        if (response.status_code < 200 or response.status_code >= 300
+                or response.direct_passthrough
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE
+                or not accepts_gzip()):
+            return response
+        response.vary.add('Accept-Encoding')
+        if response.is_streamed:
+            response.response = gzip_stream(response.iter_encoded())
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < GZIP_MIN_SIZE:
+                return response
+            response.set_data(gzip.compress(data, GZIP_LEVEL))
+        response.headers['Content-Encoding'] = 'gzip'
+        return response
+
+
+def create_app():
+    # gunicorn workers share one stdout; a rotating file per process would not rotate safely
+    setup_logging('web', log_file='gunicorn' not in sys.modules)
+    install_static_fingerprints(app)
+    install_gzip(app)
+    return app
+
+
+app = create_app()
+
+
+def run_gunicorn(args):
+    """Hand this process over to a gunicorn master that serves serve:app.
+
+    The master never imports the app itself, so a HUP makes the new workers
+    load the code (and static files) from disk again.
+    """
+    command = [sys.executable, '-m', 'gunicorn', 'serve:app',
+               '--chdir', os.path.dirname(os.path.abspath(__file__)),
+               '--bind', f"{args.host}:{args.port}",
+               '--workers', str(args.workers),
+               '--threads', str(args.threads),
+               '--worker-class', 'gthread',
+               '--timeout', str(TIMEOUT),
+               '--graceful-timeout', str(GRACEFUL_TIMEOUT),
+               '--max-requests', str(MAX_REQUESTS),
+               '--max-requests-jitter', str(MAX_REQUESTS // 10)]
+    if args.access_log:
+        command += ['--access-logfile', '-']
+    log.info("[SERVE] gunicorn on %s:%s, %s worker(s) x %s thread(s)", args.host, args.port, args.workers, args.threads)
+    flush_logging()
+    sys.stdout.flush()
+    os.execv(sys.executable, command)
+
+
+def run_waitress(args):
+    from waitress import serve
+    if args.workers > 1:
+        log.info("[SERVE] waitress is single-process; --workers ignored, use --threads")
+    log.info("[SERVE] waitress on %s:%s, %s thread(s)", args.host, args.port, args.threads)
+    serve(app, host=args.host, port=args.port, threads=args.threads, ident='anpr-dashboard')
+
+
+def installed(module):
+    return importlib.util.find_spec(module) is not None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the parking dashboard with a production WSGI server")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=WORKERS, help="processes (gunicorn only)")
+    parser.add_argument('--threads', type=int, default=THREADS, help="threads per process")
+    parser.add_argument('--server', choices=['gunicorn', 'waitress'], default=None,
+                        help="default: gunicorn if installed and not on Windows, else waitress")
+    parser.add_argument('--access-log', action='store_true')
+    args = parser.parse_args()
+
+    create_table_if_not_exists()
+    server = args.server or ('gunicorn' if os.name != 'nt' and installed('gunicorn') else 'waitress')
+    if not installed(server):
+        log.error("[ERROR] %s is not installed (pip install %s)", server, server)
+        exit(1)
+    run_gunicorn(args) if server == 'gunicorn' else run_waitress(args)